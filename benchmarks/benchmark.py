@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# Times each phase of gbextractor on synthetic projects written by generate.py:
+# decoding the projectData plist, scanning for records, parsing them,
+# associating the MIDI with the folder tree and rendering each view.  Each
+# phase is run --repeat times on a fresh project and the fastest time is kept.
+# Peak memory is measured by one more run with tracemalloc, as tracemalloc slows
+# everything down.  Views are rendered to memory so disk speed is not measured.
+#
+# python3 benchmarks/benchmark.py                              run the default sizes
+# python3 benchmarks/benchmark.py --save benchmarks/baseline.json
+# python3 benchmarks/benchmark.py --compare benchmarks/baseline.json
+
+import os
+import sys
+import io
+import gc
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import gbextractor
+import generate
+
+# The projects that can be benchmarked, as arguments to generate.generateProject()
+PROJECT_SIZES = {"small": {"tracks": 4, "sections": 8, "takes": 3, "events": 200},
+                 "medium": {"tracks": 8, "sections": 20, "takes": 3, "events": 400},
+                 "large": {"tracks": 16, "sections": 60, "takes": 4, "events": 1000}}
+DEFAULT_SIZES = ["small", "medium"]
+RESULTS_VERSION = 1
+# Phases are not reported as slower unless they take at least this much longer,
+# as the times of the quickest phases are mostly noise
+MIN_SLOWDOWN_SECONDS = 0.002
+MB = 1 << 20
+
+# Run every phase on a fresh copy of the project at gbPath.  Returns the time
+# taken by each phase, how much work it did and, if bTraceMemory is set, the
+# most memory that it allocated at once.
+def runPhases(gbPath, bTraceMemory=False):
+  results = dict()
+  project = gbextractor.GBProject(os.path.basename(gbPath))
+  state = dict()
+
+  def decode():
+    state["data"] = gbextractor.readProjectData(os.path.join(gbPath, "projectData"))
+    project.decodedData = state["data"]
+    return os.path.getsize(os.path.join(gbPath, "projectData")) / MB, "MB"
+
+  def scan():
+    state["reader"] = gbextractor.createReader(state["data"])
+    project.readHeader(state["reader"])
+    state["offsets"] = project.scanRecords(state["data"])
+    return len(state["data"]) / MB, "MB"
+
+  def parse():
+    midiBlocks = project.processOffsetList(state["reader"], state["offsets"])
+    project.processMIDIBlocks(state["reader"], midiBlocks)
+    return sum(len(midiSection.midiEvents) for midiSection in project.recordHash.values() if midiSection.midiEvents), "events"
+
+  def associate():
+    project.associateMIDIEvents()
+    project.buildIndexes()
+    return len(project.recordIndex), "records"
+
+  phases = [("decode", decode), ("scan", scan), ("parse", parse), ("associate", associate)]
+  for viewName in gbextractor.VIEW_NAMES:
+    phases.append((viewName, lambda viewName=viewName: renderView(project, viewName)))
+
+  for phaseName, phase in phases:
+    gc.collect()
+    if(bTraceMemory):
+      tracemalloc.start()
+    startTime = time.perf_counter()
+    amount, unit = phase()
+    elapsed = time.perf_counter() - startTime
+    results[phaseName] = {"seconds": elapsed, "amount": amount, "unit": unit}
+    if(bTraceMemory):
+      results[phaseName]["peakMB"] = tracemalloc.get_traced_memory()[1] / MB
+      tracemalloc.stop()
+  return results
+
+# Render every job of one view to memory and return the number of files
+def renderView(project, viewName):
+  sink = gbextractor.MemorySink()
+  with contextlib.redirect_stdout(io.StringIO()):
+    for job in project.getRenderJobs(1, [viewName]):
+      project.renderView(sink, *job)
+  return len(sink.files), "files"
+
+# Benchmark one project size and return its results
+def benchmarkProject(sizeName, projectDir, repeat):
+  size = PROJECT_SIZES[sizeName]
+  gbPath = os.path.join(projectDir, "{}.band".format(sizeName))
+  generate.generateProject(gbPath, **size)
+
+  phases = dict()
+  for i in range(0, repeat):
+    for phaseName, result in runPhases(gbPath).items():
+      if(phaseName not in phases or result["seconds"] < phases[phaseName]["seconds"]):
+        phases[phaseName] = result
+  for phaseName, result in runPhases(gbPath, True).items():
+    phases[phaseName]["peakMB"] = result["peakMB"]
+  for result in phases.values():
+    result["throughput"] = result["amount"] / result["seconds"] if result["seconds"] > 0 else 0.0
+  return {"size": size, "projectDataMB": os.path.getsize(os.path.join(gbPath, "projectData")) / MB, "phases": phases}
+
+def printResults(sizeName, results):
+  size = results["size"]
+  print("{} ({} tracks, {} sections, {} takes, {} events per section), projectData {:.1f} MB".format(
+        sizeName, size["tracks"], size["sections"], size["takes"], size["events"], results["projectDataMB"]))
+  print("  {:<18}{:>10}{:>22}{:>10}".format("phase", "seconds", "throughput", "peak MB"))
+  for phaseName, result in results["phases"].items():
+    print("  {:<18}{:>10.3f}{:>22}{:>10.1f}".format(phaseName, result["seconds"],
+          "{:,.0f} {}/s".format(result["throughput"], result["unit"]), result["peakMB"]))
+
+# Print how the results compare with the baseline and return the number of
+# phases which are more than tolerance slower, see MIN_SLOWDOWN_SECONDS
+def compareResults(results, baseline, tolerance):
+  regressions = 0
+  print("Compared with the baseline from {}:".format(baseline["environment"]["date"]))
+  print("  {:<26}{:>10}{:>10}{:>9}".format("phase", "baseline", "now", "change"))
+  for sizeName, sizeResults in results.items():
+    baselinePhases = baseline["results"].get(sizeName, {}).get("phases", {})
+    for phaseName, result in sizeResults["phases"].items():
+      baselineResult = baselinePhases.get(phaseName)
+      if(baselineResult is None or baselineResult["seconds"] <= 0):
+        continue
+      change = result["seconds"] / baselineResult["seconds"] - 1
+      bSlower = change > tolerance and result["seconds"] - baselineResult["seconds"] > MIN_SLOWDOWN_SECONDS
+      regressions += bSlower
+      print("  {:<26}{:>10.3f}{:>10.3f}{:>8.0%}{}".format("{}/{}".format(sizeName, phaseName), baselineResult["seconds"],
+            result["seconds"], change, "  SLOWER" if bSlower else ""))
+  return regressions
+
+def getEnvironment():
+  try:
+    import numpy
+    numpyVersion = numpy.__version__
+  except ImportError:
+    numpyVersion = None
+  return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+          "python": platform.python_version(),
+          "platform": platform.platform(),
+          "cpus": os.cpu_count(),
+          "numpy": numpyVersion,
+          "decoderBackend": gbextractor.decoderBackend,
+          "bVectorizedMIDI": gbextractor.bVectorizedMIDI,
+          "midiWriter": gbextractor.midiWriter}
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark gbextractor on synthetic projects")
+  parser.add_argument("sizes", nargs="*", metavar="size", help="project sizes to run, from {}, by default {}".format(", ".join(PROJECT_SIZES), " and ".join(DEFAULT_SIZES)))
+  parser.add_argument("-r", "--repeat", type=int, default=3, help="number of times to run each phase, the fastest is kept")
+  parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+  parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline and exit with status 1 if any phase is slower")
+  parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower a phase can be than the baseline, by default 0.25 (25%%)")
+  parser.add_argument("--keep", metavar="DIR", help="write the projects to DIR and keep them")
+  options = parser.parse_args()
+  for sizeName in options.sizes:
+    if(sizeName not in PROJECT_SIZES):
+      parser.error("unknown size {}".format(sizeName))
+
+  results = dict()
+  with tempfile.TemporaryDirectory() as tempDir:
+    for sizeName in options.sizes or DEFAULT_SIZES:
+      results[sizeName] = benchmarkProject(sizeName, options.keep or tempDir, max(1, options.repeat))
+      printResults(sizeName, results[sizeName])
+
+  if(options.save):
+    with open(options.save, "w") as resultsFile:
+      json.dump({"version": RESULTS_VERSION, "environment": getEnvironment(), "results": results}, resultsFile, indent=2)
+      resultsFile.write("\n")
+    print("Saved the results to {}".format(options.save))
+
+  if(options.compare):
+    with open(options.compare) as baselineFile:
+      baseline = json.load(baselineFile)
+    if(baseline.get("version") != RESULTS_VERSION):
+      sys.exit("ERROR: {} was not saved by this version of the benchmark".format(options.compare))
+    if(compareResults(results, baseline, options.tolerance)):
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
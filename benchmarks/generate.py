@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Writes synthetic GarageBand projects for benchmarking gbextractor.  The
+# projectData plist holds the records that processOffsetList() reads: qSxT track
+# names, karT track references, type 2 section headers, 0x20 folders (the root
+# folder and one per multi-take section) and MIDI blocks with notes, CC,
+# channel pressure, pitch bend and the other commands that the parser skips.
+#
+# Every other section of each track is a multi-take section.  The events are
+# random but the same seed always writes the same project.
+#
+# python3 benchmarks/generate.py Synthetic.band --tracks 8 --sections 50 --takes 3 --events 500
+
+import os
+import sys
+import base64
+import random
+import struct
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import gbextractor
+
+PROJECT_HEADER_SIZE = 0x800
+ROOT_RECORD_NUMBER = 1
+ROOT_MIDI_ID = 2
+SECTION_MIDI_ID = 10
+MULTI_TAKE_MIDI_ID = 9
+TAKE_MIDI_ID = 11
+FIRST_SECTION_RECORD_NUMBER = 100
+TRACK_NAME_RECORD_BASE = 5000
+TRACK_REFERENCE_RECORD_BASE = 6000
+TRACK_ID_BASE = 7000
+BAR_TICKS = 3840
+PLIST_LINE_LENGTH = 68
+
+def createRecord(identity, recordType, recordNumber, midiID, data):
+  return gbextractor.RECORD_HEADER.pack(identity, recordType, 0, recordNumber, midiID, len(data)) + data
+
+def createTrackName(recordNumber, trackName):
+  name = trackName.encode("utf-8")
+  data = struct.pack("<I", 98 + len(name) + 6) + b"\x01" * 94 + name + b"\x00" + b"\x01" * 5
+  return createRecord(b'qSxT', 3, recordNumber, 0, data)
+
+def createTrackReference(recordNumber, trackNameRecordNumber, trackId):
+  data = gbextractor.TRACK_REFERENCE.pack(trackNameRecordNumber, trackId) + b"\x00" * 4
+  return createRecord(b'karT', 4, recordNumber, 0, data)
+
+# The length and start are found after the first 0x20 following the name
+def createSectionHeader(recordNumber, midiID, label, sectionLength, sectionStart):
+  name = label.encode("utf-8")
+  data = b"\x01\x01\x01" + gbextractor.SECTION_HEADER.pack(midiID, len(name)) + name
+  data += b"\x01\x02\x03\x20" + b"\x00" * 39 + struct.pack("<I", sectionLength)[:3]
+  data += b"\x00" * 161 + struct.pack("<I", sectionStart)[:3] + b"\x00" * 8
+  return createRecord(b'qSvE', 2, recordNumber, midiID, data)
+
+def createFolderEntry(timeStamp, folderRecordNumber, index, recordNumber):
+  return b"\x20" + gbextractor.FOLDER_ENTRY.pack(timeStamp, folderRecordNumber, index, recordNumber)
+
+# A folder ends with a null block and an 0x5x block, which the parser skips
+def createFolder(recordNumber, midiID, entries):
+  data = b"".join(entries) + b"\x00" * 64 + b"\x51" + b"\x00" * 15
+  return createRecord(b'qeSM', 1, recordNumber, midiID, data)
+
+# Returns a MIDI block of eventCount random events which mostly fit in a
+# section of sectionLength ticks.  About one note in twenty is written twice.
+def createMIDIBlock(recordNumber, midiID, rng, eventCount, sectionLength):
+  data = bytearray()
+  timeStamp = gbextractor.BASE_TIME
+  maxStep = max(2, 2 * sectionLength // max(1, eventCount))
+  for i in range(0, eventCount):
+    kind = rng.random() if i else 0.0
+    channel = rng.randrange(16)
+    timeStamp += rng.randrange(0, maxStep)
+    event = bytearray(16)
+    event[4:8] = struct.pack("<I", timeStamp)
+    if(kind < 0.55):
+      # Notes use two rows, the second holding the duration
+      event += bytes(16)
+      event[0] = 0x90 | channel
+      event[11] = rng.randrange(1, 128)
+      event[12] = rng.randrange(30, 90)
+      event[16] = 0x80
+      event[23] = 0x89
+      event[24:28] = struct.pack("<I", rng.choice([0, 0, 5]))
+      event[28:32] = struct.pack("<I", rng.randrange(1, 2000))
+      if(rng.random() < 0.05):
+        data += event
+    elif(kind < 0.65):
+      event[0] = 0xB0 | channel
+      event[11] = rng.randrange(128)
+      event[12] = rng.choice([1, 64, 7])
+    elif(kind < 0.72):
+      event[0] = 0xD0 | channel
+      event[11] = rng.randrange(128)
+    elif(kind < 0.82):
+      event[0] = 0xE0 | channel
+      event[11] = rng.randrange(128)
+      event[12] = rng.randrange(128)
+    elif(kind < 0.85):
+      event = bytearray(16)
+      event[0] = 0x05
+      event[7] = 0xA8
+    elif(kind < 0.88):
+      event[0] = 0x50
+    elif(kind < 0.91):
+      event = bytearray(32)
+      event[0] = 0x70
+    elif(kind < 0.94):
+      event = bytearray(16)
+      event[0] = 0x20 | channel
+    else:
+      event = bytearray(16)
+      event[0] = 0xA0 | channel
+    data += event
+  return createRecord(b'qeSM', 1, recordNumber, midiID, bytes(data))
+
+# Returns the decoded project data of a synthetic project
+def generateProjectData(tracks=4, sections=4, takes=3, events=200, seed=1, tempo=120, sectionBars=4):
+  rng = random.Random(seed)
+  header = bytearray(PROJECT_HEADER_SIZE)
+  header[gbextractor.TEMPO_OFFSET // 8:gbextractor.TEMPO_OFFSET // 8 + 3] = struct.pack("<I", int(tempo * 10000))[:3]
+  header[gbextractor.TIME_SIGNATURE_OFFSET // 8] = 4
+  header[gbextractor.TIME_SIGNATURE_OFFSET // 8 + 1] = 2
+
+  sectionLength = BAR_TICKS * sectionBars
+  recordNumber = FIRST_SECTION_RECORD_NUMBER
+  rootEntries = []
+  trackRecords = []
+  sectionRecords = []
+  for track in range(1, tracks + 1):
+    trackNameRecordNumber = TRACK_NAME_RECORD_BASE + track
+    trackId = TRACK_ID_BASE + track
+    trackRecords.append(createTrackName(trackNameRecordNumber, "Track {} Piano".format(track)))
+    trackRecords.append(createTrackReference(TRACK_REFERENCE_RECORD_BASE + track, trackNameRecordNumber, trackId))
+    timeStamp = gbextractor.BASE_TIME
+    for section in range(0, sections):
+      recordNumber += 1
+      sectionRecordNumber = recordNumber
+      rootEntries.append(createFolderEntry(timeStamp, trackId, track, sectionRecordNumber))
+      if(takes > 1 and section % 2 == 1):
+        sectionRecords.append(createSectionHeader(sectionRecordNumber, MULTI_TAKE_MIDI_ID, "Takes", sectionLength, 0))
+        takeEntries = []
+        for take in range(0, takes):
+          recordNumber += 1
+          takeEntries.append(createFolderEntry(timeStamp, trackId, take, recordNumber))
+          sectionRecords.append(createSectionHeader(recordNumber, TAKE_MIDI_ID, "Take {}".format(take), sectionLength, 0))
+          sectionRecords.append(createMIDIBlock(recordNumber, TAKE_MIDI_ID, rng, events, sectionLength))
+        sectionRecords.append(createFolder(sectionRecordNumber, MULTI_TAKE_MIDI_ID, takeEntries))
+      else:
+        sectionRecords.append(createSectionHeader(sectionRecordNumber, SECTION_MIDI_ID, "Sec {}".format(section), sectionLength, 0))
+        sectionRecords.append(createMIDIBlock(sectionRecordNumber, SECTION_MIDI_ID, rng, events, sectionLength))
+      timeStamp += sectionLength + BAR_TICKS
+
+  body = bytearray(createSectionHeader(ROOT_RECORD_NUMBER, ROOT_MIDI_ID, "Root Folder", 0, 0))
+  body += createFolder(ROOT_RECORD_NUMBER, ROOT_MIDI_ID, rootEntries)
+  for record in trackRecords + sectionRecords:
+    body += record
+  return bytes(header + body)
+
+# Write a project.band directory holding the projectData plist for decodedData
+def writeProject(gbPath, decodedData):
+  encodedData = base64.b64encode(decodedData).decode("ascii")
+  lines = "\n".join("\t" + encodedData[i:i + PLIST_LINE_LENGTH] for i in range(0, len(encodedData), PLIST_LINE_LENGTH))
+  os.makedirs(gbPath, exist_ok=True)
+  with open(os.path.join(gbPath, "projectData"), "w") as projectFile:
+    projectFile.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                      '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                      '<plist version="1.0">\n<dict>\n\t<key>$objects</key>\n\t<array>\n\t<dict>\n'
+                      '\t<key>NS.data</key>\n\t<data>\n' + lines + '\n\t</data>\n\t</dict>\n\t</array>\n</dict>\n</plist>\n')
+
+def generateProject(gbPath, tracks=4, sections=4, takes=3, events=200, seed=1, tempo=120, sectionBars=4):
+  writeProject(gbPath, generateProjectData(tracks, sections, takes, events, seed, tempo, sectionBars))
+
+def main():
+  parser = argparse.ArgumentParser(description="Write a synthetic GarageBand project")
+  parser.add_argument("project", help="the project.band directory to write")
+  parser.add_argument("--tracks", type=int, default=4, help="number of tracks")
+  parser.add_argument("--sections", type=int, default=4, help="number of sections in each track")
+  parser.add_argument("--takes", type=int, default=3, help="number of takes in each multi-take section")
+  parser.add_argument("--events", type=int, default=200, help="number of events in each section or take")
+  parser.add_argument("--seed", type=int, default=1, help="seed for the random events")
+  parser.add_argument("--tempo", type=float, default=120, help="tempo in beats per minute")
+  parser.add_argument("--section-bars", type=int, default=4, help="length of each section in bars")
+  options = parser.parse_args()
+  generateProject(options.project, options.tracks, options.sections, options.takes, options.events,
+                  options.seed, options.tempo, options.section_bars)
+
+if __name__ == "__main__":
+  main()
@@ -5,9 +5,10 @@
 # See LICENSE for license information (Apache 2)
 
 # Comes with the following dependencies:
-# bitstring (3.1.7) - Simple construction, analysis and modification of binary data. https://github.com/scott-griffiths/bitstring
-# MIDIUtil (1.2.1) - A pure python library for creating multi-track MIDI files. https://github.com/MarkCWirt/MIDIUtil
+# bitstring (3.1.7) - (optional) Simple construction, analysis and modification of binary data. https://github.com/scott-griffiths/bitstring
+# MIDIUtil (1.2.1) - (optional) A pure python library for creating multi-track MIDI files. https://github.com/MarkCWirt/MIDIUtil
 # https://midiutil.readthedocs.io/en/1.2.1/class.html#classref
+# NumPy - (optional) Used to decode large MIDI blocks in one go. https://numpy.org
 
 #SEONN Edit - Added the tkinter library to allow code to be run from Windows.
 #Open the Garageband project and select the "ProjectData" file.
@@ -15,20 +16,55 @@
 import xml.etree.ElementTree as ET
 import os
 import base64
+import binascii
+import mmap
 import sys
-from bitstring import ConstBitStream
+import struct
 import time
 import string
-from midiutil import MIDIFile
+import re
+import array
+import random
 import itertools
-import glob
 import shutil
+import concurrent.futures
+import multiprocessing
+import argparse
+import contextlib
+import io
+import hashlib
+import json
+import tempfile
+import zipfile
+import tarfile
+import atexit
+import bisect
+import queue
+import threading
+try:
+  from midiutil import MIDIFile
+except ImportError:
+  MIDIFile = None # Only needed by the "midiutil" MIDI writer
+try:
+  from bitstring import ConstBitStream
+except ImportError:
+  ConstBitStream = None # Only needed by the "bitstring" decoder backend
+try:
+  import numpy as np
+except ImportError:
+  np = None # MIDI blocks are decoded one event at a time without NumPy
+try:
+  import fcntl
+except ImportError:
+  fcntl = None # Only used to clone audio files, see audioCopyMode
+try:
+  import resource
+except ImportError:
+  resource = None # Peak memory is not reported without it
 if os.name == 'nt':# If the OS is Windows
   import tkinter as tk  # For opening Windows file explorer
   from tkinter import filedialog # For opening Windows file explorer
 
-ROOT_DIR = os.getcwd()
-
 # These offsets are in bits!
 TEMPO_OFFSET = 0x550 # 0xAA bytes
 TIME_SIGNATURE_OFFSET = 0x7D0 # 0xFA bytes
@@ -36,10 +72,6 @@ TIME_SIGNATURE_OFFSET_2 = 0x1DB6
 BASE_TIME = 0x9600
 PPQN = 960
 
-baseTime = BASE_TIME
-trackNameLookup = dict()
-trackLookup = dict()
-
 ####################################
 ### User-configurable parameters ###
 ####################################
@@ -53,6 +85,21 @@ bEnableCutUp = False
 # of permutations is the product of all the take counts so be very careful about setting
 # this to -1!
 maxPerms = 24
+# Choose which permutations are written, and in what order, when there are
+# more than maxPerms of them:
+#   "lexicographic" - in order, changing the takes of the last section first
+#   "graycode"      - in an order where each cut-up differs from the one before
+#                     in only one take
+#   "random"        - picked at random, see cutUpSeed
+#   "cover"         - just enough cut-ups for every take to be used at least once
+cutUpStrategy = "lexicographic"
+# The seed for the "random" strategy.  The same seed picks the same cut-ups.
+cutUpSeed = 0
+# Set to True to skip cut-ups whose takes contain exactly the same events as a
+# cut-up that has already been written, e.g. where takes have been duplicated.
+# This writes fewer files, and can change which cut-ups fill maxPerms, so it is
+# off by default to keep the same output as earlier versions.
+bCutUpSkipDuplicates = False
 
 ## Note filter ##
 # If your MIDI came from a source such as a MIDI drum kit or MIDI guitar
@@ -65,12 +112,63 @@ velocityMin = 20
 velocityMax = 127
 # Set the minimum duration in milliseconds that a note must sound to be kept
 durationMin = 40
+# Rules for particular notes or channels, which are checked in order before
+# the limits above.  The first rule that covers a note decides whether it is
+# kept.  Each rule may give "notes" as (lowest, highest), "channels" as a list
+# of channels from 0 to 15, and "velocityMin", "velocityMax" and "durationMin",
+# which default to the values above.  For example, to keep quieter hi-hats:
+#   noteFilterRules = [{"notes": (42, 46), "velocityMin": 5}]
+noteFilterRules = []
 
 ## Audio ##
 # Enable this option to extract audio files stored in the project
 bExtractAudio = False
 # Enable this option to create a zipped version of the audio that is extracted
 bCompressAudio = True
+# The number of audio files that are copied at the same time
+audioWorkers = 4
+# How audio files are copied when extracting to a directory:
+#   "copy"     - as new files
+#   "reflink"  - as copy-on-write clones, which take no extra space, where the
+#                file system supports them (e.g. Btrfs or XFS on Linux) and as
+#                new files otherwise
+#   "hardlink" - as hard links where the output is on the same file system as
+#                the project and as new files otherwise.  A hard link is the
+#                same file as the one in the project, so do not edit it!
+audioCopyMode = "reflink"
+# Set to True to skip audio files that have not changed since they were last
+# extracted to the same directory.  This applies to incremental extractions and
+# to directories which already hold an export, see bIncremental
+bSkipUnchangedAudio = True
+
+## Views ##
+# The MIDI views to write, from "tracks", "song", "trackStems", "cutUps",
+# "sectionStems", "sections" and "sectionsFiltered", e.g. ["tracks", "song"].
+# None writes the first, second, third, fifth and sixth views, plus "cutUps" if
+# bEnableCutUp is set and "sectionsFiltered" if bFilterNotes is set.
+outputViews = None
+# Only write the tracks that match one of these, or every track if this is
+# empty.  Each entry is a track number, a track name or a regular expression
+# which matches the whole name, ignoring case, e.g. [1, "Drums", "Bass.*"].
+# The MIDI of tracks that are not written is not decoded.
+includeTracks = []
+# Never write the tracks that match one of these
+excludeTracks = []
+
+## Output ##
+# How the extracted files are written:
+#   "directory" - to a new directory in the current directory
+#   "zip"       - to a single zip file in the current directory
+#   "tar"       - as a tar stream to standard output, with messages written to
+#                 standard error, e.g. python gbextractor.py Song.band > Song.tar
+# The batch command writes a directory, zip file or tar file for each project.
+outputFormat = "directory"
+# Set to True to write "directory" output to a directory named after the
+# project, without the date and time, and to update it on later runs.  Only
+# the files made from sections that have changed are written again and files
+# that would no longer be written are deleted.  The batch command does the same
+# when it is given --incremental.
+bIncremental = False
 
 ## Pitch ##
 
@@ -149,60 +247,323 @@ trackMap = {35:'Kick',
             81:'TriangleOpen'
             }
       
+## Performance ##
+# Number of processes used to scan the decoded project data for records.  Scanning
+# is a single pass over the data so this only helps with very large projects and
+# multiprocessing is not available in Pythonista, so leave this at 1 on iOS.
+scanWorkers = 1
+# How the decoded project data is read.  "struct" uses precompiled struct
+# formats over the decoded bytes and is much faster.  "bitstring" uses the
+# bitstring package, which is how earlier versions of this script worked.
+decoderBackend = "struct"
+# If NumPy is installed then decode large MIDI blocks as arrays rather than one
+# event at a time.  Runs that trace "midi" always use the event at a time
+# decoder so that every command is traced.
+bVectorizedMIDI = True
+# How MIDI files are written.  "native" uses the writer built in to this script,
+# which writes exactly the same bytes as MIDIUtil but much faster.  "midiutil"
+# uses the MIDIUtil package, which is how earlier versions of this script worked.
+midiWriter = "native"
+# Number of worker processes used to write the MIDI views of a project, or 0 to
+# use one per CPU.  Each view of each track is written by a separate job.
+# GBProject.dumpAll() called from another script writes them in the calling
+# process unless it is given a number of workers.
+renderWorkers = 0
+# Number of worker processes used by the batch command, or 0 to use one per CPU
+batchWorkers = 0
+# Number of threads that write the files of a directory output while the next
+# files are rendered, or 0 to write each file before rendering the next.  This
+# helps most on slow or network storage.
+writerThreads = 2
+# Most files that can wait to be written before rendering waits for the writers
+writerQueueSize = 32
+# Extract projects in streaming mode, which decodes the MIDI of a few tracks at
+# a time and writes their views before moving on, so that the memory used
+# depends on the largest track rather than the whole project.  The decoded
+# project data is kept in a temporary file instead of in memory and the model
+# cache is not used.
+bStreamTracks = False
+# Most bytes of MIDI data decoded at once in streaming mode.  Tracks are
+# written together while their MIDI fits and a larger track is written alone.
+streamMemoryLimit = 16 << 20
+
+## Model cache ##
+# Parsed projects are cached on disk, keyed by a hash of the projectData file, so
+# that exporting the same project again with different output options does not
+# need to parse it again.  Runs that trace the parser always parse the project.
+# Set to True, or use --cache, to keep the cache, which is written outside of
+# the output directory, see modelCacheDir
+bCacheModels = False
+# Where the cached models are kept.  None means a "gbextractor" directory in the
+# user's cache directory
+modelCacheDir = None
+# The least recently used models are deleted when the cache grows past this many bytes
+modelCacheSize = 256 << 20
+
 ## Debugging ##
 
-# Turn debugging on or off
+# Turn debugging on or off.  Debug runs write trace records of what the parser
+# and the writers are doing
 bDebug = False
+# The categories of trace records to write, from "main", "scan", "record",
+# "midi", "folder", "render", "audio" and "model".  An empty list means every category
+traceCategories = []
+# The least important trace records to write.  "debug" writes every record except
+# the hex dumps of the project data, which are only written with "dump", and
+# "warn" only writes warnings
+traceLevel = "debug"
+# Trace records are printed unless this is the path of a file, which they are
+# added to as JSON lines
+traceFile = None
 # Choose whether to redirect stdout to a log file.  You would normally want to do this
 # on iOS
 bWriteToFile = False
-# If this is set then the whole binary is dumped as hex text at the end of processing
+# If this is set then the whole decoded project data is dumped as hex text at the end
+# of processing, annotated with the records found in it.  See also "gbextractor.py inspect"
 bDumpFile = False
+# If this is set then the decoded project data is written to decoded.bin in the output
+# directory so that it can be examined with other tools
+bDumpDecodedData = False
+# Write GB_Metrics.json to the output with the time taken by each phase of the
+# extraction, counts of what was read and written and the peak memory used.
+# The batch command writes GB_Batch_Metrics.json with the metrics of every project.
+bWriteMetrics = False
 
 ########################################
 ### END User-configurable parameters ###
 ########################################
 
+# The names of the user-configurable parameters, whose values are passed on to
+# render worker processes, see getSettings().  A new parameter must be added
+# here too.
+SETTING_NAMES = ("bEnableCutUp", "maxPerms", "cutUpStrategy", "cutUpSeed",
+                 "bCutUpSkipDuplicates", "bFilterNotes", "velocityMin",
+                 "velocityMax", "durationMin", "noteFilterRules",
+                 "bExtractAudio", "bCompressAudio", "audioWorkers",
+                 "audioCopyMode", "bSkipUnchangedAudio", "outputViews",
+                 "includeTracks", "excludeTracks", "outputFormat",
+                 "bIncremental", "bOverridePitchBend", "pitchBendMultiplier",
+                 "pitchBendInstFilter", "trackLimit", "bRenameTracks",
+                 "trackMap", "scanWorkers", "decoderBackend", "bVectorizedMIDI",
+                 "midiWriter", "renderWorkers", "batchWorkers", "writerThreads",
+                 "writerQueueSize", "bStreamTracks", "streamMemoryLimit",
+                 "bCacheModels", "modelCacheDir", "modelCacheSize", "bDebug",
+                 "traceCategories", "traceLevel", "traceFile", "bWriteToFile",
+                 "bDumpFile", "bDumpDecodedData", "bWriteMetrics")
+
 
 MIDI_EVENT_NOTE = 0x90
 MIDI_EVENT_CC   = 0xB0
 MIDI_EVENT_CHANNEL_PRESSURE = 0xD0
 MIDI_EVENT_PITCH_WHEEL = 0xE0
 
+# The partitions of a section that MIDIFilter.partition() puts each event in
+FILTER_KEPT = 1
+FILTER_REJECTED = 2
+
+# The name and array type code of each column of an EventStore
+EVENT_STORE_COLUMNS = (("types", "B"), ("timeStamps", "I"), ("channels", "B"), ("data1", "B"), ("data2", "B"), ("values", "q"))
+EVENT_STORE_ROW_SIZE = sum(array.array(typeCode).itemsize for name, typeCode in EVENT_STORE_COLUMNS)
+
+# Tags which mark the start of the records that processOffsetList understands:
+# qSvE, qeSM, qSxT, karT, tSnI, tSxT and ivnE.  None of these can overlap
+# another so each byte offset matches at most one of them.
+RECORD_SIGNATURES = (b'qSvE', b'qeSM', b'qSxT', b'karT', b'tSnI', b'tSxT', b'ivnE')
+# Matches any of the signatures.  No signature can overlap another, so the
+# matches are the same as searching for each signature on its own.
+RECORD_SIGNATURE_PATTERN = re.compile(b"|".join(re.escape(signature) for signature in RECORD_SIGNATURES))
+# The decoded data is scanned in chunks of this many bytes
+SCAN_CHUNK_SIZE = 1 << 20
+# The base64 NS.data text is decoded this many characters at a time
+BASE64_CHUNK_SIZE = 4 << 20
+BASE64_WHITESPACE = b" \t\r\n"
+
+# Precompiled little-endian layouts of the records and events in the decoded data.
+# Padding that is skipped over is part of the layout.
+RECORD_HEADER = struct.Struct("<4sHIII10xI4x") # identity, type, sub type, record no, MIDI ID, data length
+BLOCK_TYPE = struct.Struct("<2sx")
+SECTION_HEADER = struct.Struct("<5xI4xH") # associated MIDI ID, section name length
+TRACK_REFERENCE = struct.Struct("<4xII") # track name block, track ID
+FOLDER_ENTRY = struct.Struct("<3xI8xIH10xI44x") # timestamp, folder record no, index, record no
+NOTE_ON_EVENT = struct.Struct("<3xI3xBB10xB") # start, velocity, note, next command
+NOTE_OFF_EVENT = struct.Struct("<II") # extended bytes, duration
+INTERNAL_EVENT = struct.Struct("<6xB8x") # sub command
+TWO_PART_EVENT = struct.Struct("<3xI3xBB3x") # time, value A, value B
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<I")
+UINT32_BE = struct.Struct(">L")
+
+# Most MIDI blocks are runs of 16 byte events, with notes taking 32 bytes
+# (the note on and the note off/duration).  These are the fields that the
+# batch decoder reads from each 16 byte row.  For the second row of a note
+# the overlapping fields "sub", "extended" and "duration" apply instead.
+MIDI_ROW_SIZE = 16
+MIDI_ROW_FIELDS = {'names': ['cmd', 'time', 'valueA', 'valueB', 'sub', 'extended', 'duration'],
+                   'formats': ['u1', '<u4', 'u1', 'u1', 'u1', '<u4', '<u4'],
+                   'offsets': [0, 4, 11, 12, 7, 8, 12],
+                   'itemsize': MIDI_ROW_SIZE}
+# Blocks smaller than this are quicker to decode one event at a time.  This is
+# also larger than the 48 byte blocks which processMIDI special cases.
+VECTORIZED_MIDI_MIN_LENGTH = 256
+MIDI_ROW_UNKNOWN = 0
+MIDI_ROW_SINGLE = 1
+MIDI_ROW_DOUBLE = 2
+MIDI_ROW_END = 3
+
+# Increase this whenever the parser changes the model that it builds so that
+# models cached by an earlier version are not used
+PARSER_VERSION = 2
+MODEL_CACHE_MAGIC = b'GBXM'
+MODEL_CACHE_HEADER = struct.Struct("<4sII") # magic, parser version, description length
+HASH_CHUNK_SIZE = 1 << 20
+
+# Where the audio in a project is copied to in the output
+AUDIO_FOLDERS = ((["Media"], ["audio", "media"]),
+                 (["Media", "Sampler", "Sampler Files"], ["audio", "sampled"]),
+                 (["Freeze Files.nosync"], ["audio", "frozen"]))
+# Audio in these formats is already compressed so it is stored in zip files
+# without compressing it again
+COMPRESSED_AUDIO_EXTENSIONS = frozenset([".m4a", ".caf", ".aac", ".mp3"])
+# Records the audio files that have been extracted to a directory, see
+# bSkipUnchangedAudio
+AUDIO_MANIFEST_NAME = "GB_Audio_Manifest.json"
+AUDIO_MANIFEST_VERSION = 1
+FICLONE = 0x40049409 # Linux ioctl that clones a file
+# Records what each file in an incremental extraction was made from, see
+# bIncremental
+OUTPUT_MANIFEST_NAME = "GB_Output_Manifest.json"
+OUTPUT_MANIFEST_VERSION = 1
+
+# Trace levels and categories, see traceLevel and traceCategories
+TRACE_DUMP = 5
+TRACE_DEBUG = 10
+TRACE_WARN = 30
+TRACE_LEVELS = {"dump": TRACE_DUMP, "debug": TRACE_DEBUG, "warn": TRACE_WARN}
+TRACE_LEVEL_NAMES = {level: name for name, level in TRACE_LEVELS.items()}
+TRACE_CATEGORIES = ("main", "scan", "record", "midi", "folder", "render", "audio", "model")
+TRACE_BUFFER_SIZE = 1000 # Records kept before they are added to traceFile
+
+# Metrics reports
+METRICS_NAME = "GB_Metrics.json"
+BATCH_METRICS_NAME = "GB_Batch_Metrics.json"
+METRICS_VERSION = 1
+EVENT_TYPE_NAMES = {MIDI_EVENT_NOTE: "note", MIDI_EVENT_CC: "controlChange",
+                    MIDI_EVENT_CHANNEL_PRESSURE: "channelPressure", MIDI_EVENT_PITCH_WHEEL: "pitchWheel"}
+
+# The order of events that happen at the same time in a MIDI track, as used by
+# MIDIUtil.  Note offs come before note ons so that a note can be played again
+# straight away
+SMF_ORDER_NAME = 0 # Track names and time signatures
+SMF_ORDER_CONTROL = 1 # Controllers, channel pressure and pitch wheel
+SMF_ORDER_NOTE_OFF = 2
+SMF_ORDER_NOTE_ON = 3 # Note ons and tempo
+SMF_HEADER = struct.Struct(">4sLHHH") # MThd, header length, format, tracks, ticks per quarter note
+SMF_TRACK_HEADER = struct.Struct(">4sL") # MTrk, track length
+SMF_END_OF_TRACK = b'\x00\xFF\x2F\x00'
+
+# Every MIDI view, in the order that they are written
+VIEW_NAMES = ("tracks", "song", "trackStems", "cutUps", "sectionStems", "sections", "sectionsFiltered")
+
+# Cut-up permutations are shuffled up to this many, and sampled beyond it
+RANDOM_SHUFFLE_LIMIT = 1 << 16
+# How the cut-ups of a track are split between render workers
+CUT_UP_JOBS_PER_WORKER = 4
+MIN_CUT_UPS_PER_JOB = 32
+
+canBePrinted = bytes(string.ascii_letters + string.digits + string.punctuation, 'ascii')
+# Maps each byte to itself if it can be printed and to "." if not
+HEX_DUMP_ASCII = bytes(byte if byte in canBePrinted else ord(".") for byte in range(0, 256))
+HEX_DUMP_CHUNK_SIZE = 1 << 16 # Bytes formatted and written at a time
+
+# Raised when the project data cannot be parsed or the output cannot be written.
+# The command line entry point turns this into quitWithError() but library
+# users can catch it and carry on with the next project.
+class GBExtractorError(Exception):
+  pass
+
 class MIDISection:
   def __init__(self, label, associatedMidiID, recordNumber, sectionLength, sectionStart):
     self.label = label
     self.associatedMidiID = associatedMidiID
-    self.midiEvents = []
+    self.midiEvents = EventStore()
     self.recordNumber = recordNumber
     self.sectionLength = sectionLength
     self.sectionStart = sectionStart
 
-class MIDIEvent:
-  def __init__(self, type, timeStamp, channel, event):
-    self.timeStamp = timeStamp
-    self.type = type
-    self.event = event
-    self.channel = channel
+# The MIDI events of a section, stored as one typed array per field instead
+# of as objects.  Iterating yields (type, timeStamp, channel, data1, data2,
+# value) tuples:
+#   notes            data1 velocity, data2 note, value duration
+#   CC               data1 control number, data2 control value
+#   channel pressure data1 pressure
+#   pitch wheel      value pitch wheel value
+# Fields that an event type does not use are zero.
+class EventStore:
+  __slots__ = tuple(name for name, typeCode in EVENT_STORE_COLUMNS)
     
-class MIDIEventNote:
-  def __init__(self, velocity, note):
-    self.note = note
-    self.velocity = velocity
-    self.duration = -1
+  def __init__(self):
+    for name, typeCode in EVENT_STORE_COLUMNS:
+      setattr(self, name, array.array(typeCode))
 
-class MIDIEventCC:
-  def __init__(self, ctrlNumber, ctrlValue):
-    self.ctrlNumber = ctrlNumber
-    self.ctrlValue = ctrlValue
+  def __len__(self):
+    return len(self.types)
     
-class MIDIEventPressure:
-  def __init__(self, pressure):
-    self.pressure = pressure
+  def __iter__(self):
+    return zip(self.types, self.timeStamps, self.channels, self.data1, self.data2, self.values)
     
-class MIDIEventPitchWheel:
-  def __init__(self, pitchWheelValue):
-    self.pitchWheelValue = pitchWheelValue
+  def __getitem__(self, index):
+    return (self.types[index], self.timeStamps[index], self.channels[index], self.data1[index], self.data2[index], self.values[index])
+
+  def append(self, eventType, timeStamp, channel, data1, data2, value):
+    self.types.append(eventType)
+    self.timeStamps.append(timeStamp)
+    self.channels.append(channel)
+    self.data1.append(data1)
+    self.data2.append(data2)
+    self.values.append(value)
+
+  # Returns the note number of each note event
+  def getNotes(self):
+    return [note for eventType, note in zip(self.types, self.data2) if eventType == MIDI_EVENT_NOTE]
+
+  # Returns the columns one after another as little endian bytes
+  def toBytes(self):
+    data = bytearray()
+    for name, typeCode in EVENT_STORE_COLUMNS:
+      column = getattr(self, name)
+      if(sys.byteorder == "big"):
+        column = array.array(typeCode, column)
+        column.byteswap()
+      data += column.tobytes()
+    return bytes(data)
+
+  # Rebuild eventCount events from the bytes returned by toBytes()
+  @classmethod
+  def fromBytes(cls, data, eventCount):
+    eventStore = cls()
+    offset = 0
+    for name, typeCode in EVENT_STORE_COLUMNS:
+      column = getattr(eventStore, name)
+      columnSize = eventCount * column.itemsize
+      column.frombytes(data[offset:offset + columnSize])
+      if(sys.byteorder == "big"):
+        column.byteswap()
+      offset += columnSize
+    return eventStore
+
+  # Returns a new store with the events for which selectors is true
+  def compress(self, selectors):
+    selectors = list(selectors)
+    return EventStore.fromColumns(*[itertools.compress(getattr(self, name), selectors) for name, typeCode in EVENT_STORE_COLUMNS])
+
+  # Build a store from one sequence of values per column, in
+  # EVENT_STORE_COLUMNS order
+  @classmethod
+  def fromColumns(cls, *columns):
+    eventStore = cls()
+    for (name, typeCode), values in zip(EVENT_STORE_COLUMNS, columns):
+      getattr(eventStore, name).extend(values)
+    return eventStore
     
 class LastNoteEvent:
   def __init__(self, note, timeStamp):
@@ -215,18 +576,94 @@ class TwoPartEvent:
     self.valueA = valueA
     self.valueB = valueB
         
-class MIDIFilter:
-  def __init__(self, velMin, velMax, durMin, bInvert):
+# The velocity and duration limits for notes in a range of note numbers and
+# channels.  If notes or channels is None then the rule covers all of them.
+class NoteRule:
+  def __init__(self, velMin, velMax, durMin, notes=None, channels=None):
     self.velMin = velMin
     self.velMax = velMax
     self.durMin = durMin
+    self.notes = notes # (lowest, highest)
+    self.channels = None if channels is None else frozenset(channels)
+
+  def covers(self, channel, note):
+    return ((self.notes is None or self.notes[0] <= note <= self.notes[1]) and
+            (self.channels is None or channel in self.channels))
+
+  def passes(self, velocity, duration):
+    return duration >= self.durMin and self.velMin <= velocity <= self.velMax
+
+# Decides which notes to keep using a list of NoteRules.  The first rule that
+# covers a note decides whether it is kept, and notes that no rule covers are
+# kept.  Events other than notes are always kept.
+class MIDIFilter:
+  def __init__(self, rules, bInvert=False):
+    self.rules = rules
     self.bInvert = bInvert # Invert the filter, i.e. include *only* those notes that match
 
+  def keepsNote(self, channel, note, velocity, duration):
+    bKeep = True
+    for rule in self.rules:
+      if(rule.covers(channel, note)):
+        bKeep = rule.passes(velocity, duration)
+        break
+    return bKeep != self.bInvert
+
+  # Returns FILTER_KEPT, FILTER_REJECTED or both for each event in an
+  # EventStore, in one pass.  Events other than notes belong to both.
+  def partition(self, midiEvents):
+    bTrace = isTracing("render")
+    flags = bytearray(b'\x03' * len(midiEvents))
+    index = 0
+    for eventType, channel, velocity, note, duration in zip(midiEvents.types, midiEvents.channels, midiEvents.data1, midiEvents.data2, midiEvents.values):
+      if(eventType == MIDI_EVENT_NOTE):
+        if(self.keepsNote(channel, note, velocity, duration)):
+          flags[index] = FILTER_KEPT
+        else:
+          if(bTrace): trace("render", "Filtering out note {} velocity {} duration {}", note, velocity, duration)
+          flags[index] = FILTER_REJECTED
+      index += 1
+    return flags
+
+# Selects tracks by number, by name or by a regular expression which matches
+# the whole name, ignoring case.  A track is selected if it matches one of
+# includeTracks, or includeTracks is empty, and none of excludeTracks.
+# Numbers may be given as ints or as strings of digits, as on the command line.
+class TrackFilter:
+  def __init__(self, includeTracks=None, excludeTracks=None):
+    self.includeTracks = [self.compileSelector(selector) for selector in includeTracks or []]
+    self.excludeTracks = [self.compileSelector(selector) for selector in excludeTracks or []]
+
+  # Returns (number, name, pattern) for a selector, with None for the parts
+  # that it cannot be
+  def compileSelector(self, selector):
+    if(isinstance(selector, int)):
+      return (selector, None, None)
+    number = int(selector) if selector.isdigit() else None
+    try:
+      pattern = re.compile(selector, re.IGNORECASE)
+    except re.error:
+      pattern = None
+    return (number, selector.casefold(), pattern)
+
+  def matchesSelector(self, selector, track, trackName):
+    number, name, pattern = selector
+    if(number == track):
+      return True
+    if(trackName is None or name is None):
+      return False
+    return trackName.casefold() == name or (pattern is not None and pattern.fullmatch(trackName) is not None)
+
+  def matches(self, track, trackName):
+    if(self.includeTracks and not any(self.matchesSelector(selector, track, trackName) for selector in self.includeTracks)):
+      return False
+    return not any(self.matchesSelector(selector, track, trackName) for selector in self.excludeTracks)
+
 class Record:
   def __init__(self, recordNumber, timeStamp):
     self.recordNumber = recordNumber
     self.timeStamp = timeStamp # Where does the section start on the main timeline?
-    self.midiEvents = []
+    self.midiEvents = EventStore()
     self.label = None
     self.sectionLength = -1
 
@@ -245,8 +682,6 @@ class Folder:
       trackSet.add(folder.index)
     return trackSet
 
-rootFolder = Folder(0)
-
 class NoteToTrackLookup:
   def __init__(self):
     self.dict = dict()
@@ -256,11 +691,10 @@ class NoteToTrackLookup:
   def getTrackCount(self):
     return max(self.uniqueCounter, 1)
     
-  # Add all of the note events from a list of events
+  # Add all of the note events from an EventStore
   def addNotes(self, midiEvents):
-    for midiEvent in midiEvents:
-      if(midiEvent.type == MIDI_EVENT_NOTE): 
-        self.getTrackNumberForNote(midiEvent.event.note)
+    for note in midiEvents.getNotes():
+      self.getTrackNumberForNote(note)
     
   # Get the track that a note has been assigned to, creating
   # a new assigment if necessary
@@ -273,252 +707,1282 @@ class NoteToTrackLookup:
       self.uniqueCounter = min(trackLimit, self.uniqueCounter + 1)
       
       if(self.counter >= trackLimit):
-        debugPrint("Resetting track counter")
+        trace("render", "Resetting track counter")
         self.counter = 0
         
-      debugPrint("Track number {} for note {}".format(trackNumber, note))
+      trace("render", "Track number {} for note {}", trackNumber, note)
     return trackNumber
         
-def millisecondsToTicks(bpm, msDuration):
-  return ((bpm * PPQN) / 60000) * msDuration
+# Writes Standard MIDI Files with the same interface as MIDIUtil's MIDIFile, for
+# the methods used by this script.  Each event is stored as a (tick, order,
+# insertion order, message bytes) tuple and the track is encoded straight into
+# a bytearray when it is written.  The output is byte for byte the same as
+# MIDIUtil with event times in ticks: duplicate events are removed and
+# overlapping notes are de-interleaved in the same way, and running status is
+# not used.  Sections are added in time order so sorting the tuples is mostly
+# a merge of the runs that are already in order.
+class SMFWriter:
+  def __init__(self, numTracks=1, file_format=1, ticks_per_quarternote=PPQN):
+    self.fileFormat = file_format
+    self.ticksPerQuarterNote = ticks_per_quarternote
+    # Format 1 files have an extra track for the tempo and time signature
+    self.trackOffset = 1 if file_format == 1 else 0
+    self.tracks = [[] for i in range(0, numTracks + self.trackOffset)]
+    self.eventCounter = 0
     
-def createDir(path):
-  try:
-    os.mkdir(path)
-  except OSError:
-    quitWithError("ERROR: Could not create directory {}".format(path))
+  def addEvent(self, track, tick, order, message):
+    self.tracks[track].append((tick, order, self.eventCounter, message))
+    self.eventCounter += 1
 
-def createPath(path):
-  try:
-    if(not os.path.exists(path)):
-      os.makedirs(path)
-  except OSError:
-    quitWithError("ERROR: Could not create path {}".format(path))
+  def addNote(self, track, channel, pitch, time, duration, volume):
+    events = self.tracks[track + self.trackOffset]
+    events.append((time, SMF_ORDER_NOTE_ON, self.eventCounter, bytes((0x90 | channel, pitch, volume))))
+    events.append((time + duration, SMF_ORDER_NOTE_OFF, self.eventCounter, bytes((0x80 | channel, pitch, volume))))
+    self.eventCounter += 1
 
-def createAndChDir(path):
-  createDir(path)
-  os.chdir(path)
+  def addControllerEvent(self, track, channel, time, controller_number, parameter):
+    self.addEvent(track + self.trackOffset, time, SMF_ORDER_CONTROL, bytes((0xB0 | channel, controller_number, parameter)))
   
-def copyFiles(src, dest, wildcard):
-  if(os.path.exists(src)):
-    paths = glob.glob(os.path.join(src, wildcard))
+  def addPitchWheelEvent(self, track, channel, time, pitchWheelValue):
+    self.addEvent(track + self.trackOffset, time, SMF_ORDER_CONTROL, bytes((0xE0 | channel, (pitchWheelValue + 8192) & 0x7F, (pitchWheelValue + 8192) >> 7)))
       
-    for path in paths:
-      if(os.path.isfile(path)):
-        # Only create dest if there are files to copy.  If this
-        # function is going to process lots of files then this
-        # should be refactored
-        if(not os.path.exists(dest)):
-          createPath(dest)
-        debugPrint("Copying {} to {}".format(path, dest))
-        shutil.copy(path, dest)
-
-def compressFolder(folderToCompress, archiveName):
-  shutil.make_archive(archiveName, 'zip', folderToCompress)
+  def addChannelPressure(self, tracknum, channel, time, pressure_value):
+    self.addEvent(tracknum + self.trackOffset, time, SMF_ORDER_CONTROL, bytes((0xD0 | channel, pressure_value)))
+
+  def addTrackName(self, track, time, trackName):
+    name = trackName.encode("ISO-8859-1")
+    self.addEvent(track + self.trackOffset, time, SMF_ORDER_NAME, b'\xFF\x03' + encodeVarLength(len(name)) + name)
   
-def extractAudio(gbRoot):
-  # Includes direct recording and audio imported by the user and
-  # from Apple Loops
-  copyFiles(os.path.join(gbRoot, "Media"), 
-            os.path.join(WORKING_DIR, *["audio", "media"]),
-            "*")
-  copyFiles(os.path.join(gbRoot, *["Media", "Sampler", "Sampler Files"]), 
-            os.path.join(WORKING_DIR, *["audio", "sampled"]),
-            "*")
-  copyFiles(os.path.join(gbRoot, "Freeze Files.nosync"), 
-            os.path.join(WORKING_DIR, *["audio", "frozen"]),
-            "*")
-
-  audioPath = os.path.join(WORKING_DIR, "audio")
-  if(bCompressAudio and os.path.exists(audioPath)):
-    compressFolder(audioPath, "audio")
-
-# Return a sorted list of sections for a particular
-# track.
-def getSectionsForTrack(trackNumber):
-  sectionList = []
-  for topLevelFolder in rootFolder.folderContents:
-    if(topLevelFolder.index == trackNumber):
-      sectionList.append(topLevelFolder)
-  # Fortunately references to grouped takes do store
-  # the timestamp of the start of the section
-  sectionList.sort(key=lambda x: x.record.timeStamp)     
-  return sectionList
+  def addTimeSignature(self, track, time, numerator, denominator, clocks_per_tick, notes_per_quarter=8):
+    self.addEvent(0 if self.fileFormat == 1 else track, time, SMF_ORDER_NAME, bytes((0xFF, 0x58, 0x04, numerator, denominator, clocks_per_tick, notes_per_quarter)))
+
+  # Add events taken from a track of another SMFWriter, keeping their order.
+  # eventCount is the eventCounter of the other SMFWriter.
+  def addEvents(self, track, events, eventCount):
+    insertionBase = self.eventCounter
+    self.tracks[track + self.trackOffset].extend((tick, order, insertionBase + insertionOrder, message) for tick, order, insertionOrder, message in events)
+    self.eventCounter += eventCount
+
+  def addTempo(self, track, time, tempo):
+    self.addEvent(0 if self.fileFormat == 1 else track, time, SMF_ORDER_NOTE_ON, b'\xFF\x51\x03' + UINT32_BE.pack(int(60000000 / tempo))[1:])
   
-# Returns a list of sections, sorted by time stamp, which
-# are multi-take sections from the provided track
-def getMulitTakeSectionsForTrack(trackNumber):
-  sectionList = []
-  for topLevelFolder in rootFolder.folderContents:
-    if(topLevelFolder.folderContents and topLevelFolder.index == trackNumber):
-      sectionList.append(topLevelFolder)
-  # Fortunately references to grouped takes do store
-  # the timestamp of the start of the section
-  sectionList.sort(key=lambda x: x.record.timeStamp)     
-  return sectionList
+  # Encode a track which is complete, so its events are not kept until the
+  # file is written
+  def finishTrack(self, track):
+    events = self.tracks[track + self.trackOffset]
+    if(isinstance(events, list)):
+      self.tracks[track + self.trackOffset] = self.encodeTrack(events)
   
-def getTrackName(trackNumber):
-  for topLevelFolder in rootFolder.folderContents:
-    if(topLevelFolder.index == trackNumber):
-      return topLevelFolder.trackName
+  def writeFile(self, fileHandle):
+    fileHandle.write(SMF_HEADER.pack(b'MThd', 6, self.fileFormat, len(self.tracks), self.ticksPerQuarterNote))
+    for events in self.tracks:
+      trackData = self.encodeTrack(events) if isinstance(events, list) else events
+      fileHandle.write(SMF_TRACK_HEADER.pack(b'MTrk', len(trackData)))
+      fileHandle.write(trackData)
      
-  return "" 
-
-# Returns a map of record numbers which are multi-take
-# sections and indicate which take should be used in
-# each permutation of takes.  This function initialises
-# the map to zero.
-def getMultiTakeMappings(trackNumber):
-  multiTakes = getMulitTakeSectionsForTrack(trackNumber)
-  return initMultiTakeChoices(multiTakes)   
+  def encodeTrack(self, events):
+    events, noteStacks = self.sortTrack(self.removeDuplicates(events))
+    trackData = encodeSMFEvents(events, 0)
+    trackData += SMF_END_OF_TRACK
+    return trackData
+
+  # Keep the first of any events that MIDIUtil treats as equal: notes with the
+  # same time, channel and pitch, identical channel pressure, track name and
+  # tempo events, and time signatures at the same time.  Controller and pitch
+  # wheel events are never duplicates.
+  def removeDuplicates(self, events):
+    seen = set()
+    uniqueEvents = []
+    for event in events:
+      tick, order, insertionOrder, message = event
+      status = message[0]
+      if(status == 0xFF):
+        key = (tick, 0x58) if message[1] == 0x58 else (tick, message)
+      elif(order == SMF_ORDER_NOTE_ON or order == SMF_ORDER_NOTE_OFF):
+        key = (tick, status, message[1])
+      elif(status & 0xF0 == 0xD0):
+        key = (tick, message)
+      else:
+        uniqueEvents.append(event)
+        continue
+      if(key not in seen):
+        seen.add(key)
+        uniqueEvents.append(event)
+    return uniqueEvents
   
-def dumpSections():
-  dumpSectionOrSectionStems(False)
+  # Sort the events and then de-interleave overlapping notes of the same pitch
+  # as MIDIUtil does: when a note is still sounding from more than one note on,
+  # the note off is moved to the time of the latest note on.  The times of the
+  # note ons that are sounding are kept in lists per note key (see
+  # SMF_NOTE_KEYS), which may be passed in to carry on from earlier events.
+  # Returns the events and the lists of note ons still sounding.
+  def sortTrack(self, events, stacks=None):
+    events.sort()
+    if(stacks is None):
+      stacks = dict()
+    bMoved = False
+    for i, event in enumerate(events):
+      order = event[1]
+      if(order == SMF_ORDER_NOTE_ON):
+        message = event[3]
+        stacks.setdefault(SMF_NOTE_KEYS[message[0] & 0x0F][message[1]], []).append(event[0])
+      elif(order == SMF_ORDER_NOTE_OFF):
+        message = event[3]
+        stack = stacks.get(SMF_NOTE_KEYS[message[0] & 0x0F][message[1]])
+        if(stack):
+          if(len(stack) > 1):
+            events[i] = (stack.pop(),) + event[1:]
+            bMoved = True
+          else:
+            stack.pop()
+    if(bMoved):
+      events.sort()
+    return events, stacks
   
-def dumpSectionStems():
-  dumpSectionOrSectionStems(True)
+# Splices cut-ups of a track together from chunks of MIDI data that are encoded
+# once per section and take, rather than rendering every event of the track for
+# every permutation of takes.  Joining the encoded chunks gives exactly the same
+# bytes as SMFWriter would for the whole track as long as no event of one chunk
+# is sorted or de-duplicated with an event of another, which is the case when
+# the chunks occupy increasing, separate ranges of ticks.  Notes that a chunk
+# leaves sounding (see SMFWriter.sortTrack) are carried in to the next chunk,
+# which is encoded again for each different set of sounding notes it is given.
+# Permutations which cannot be spliced are written from the chunks' events with
+# SMFWriter.
+class CutUpEngine:
+  def __init__(self, project, track, multiTakes):
+    self.project = project
+    self.track = track
+    self.multiTakes = multiTakes
+    # One entry per section that dumpTrack() would write: the record number of
+    # multi-take sections (or None) and the events and time stamp of each take.
+    # The chunk of a take is only rendered when a cut-up first uses it.
+    self.slots = []
+    self.chunks = []
+    mostRecentSectionEnd = 0
+    for section in project.getSectionsForTrack(track):
+      if(mostRecentSectionEnd > 0 and mostRecentSectionEnd > section.record.timeStamp):
+        trace("render", "Section overlaps last one so skipping.")
+        continue
+      if(not section.folderContents):
+        self.slots.append((None, [(section.record.midiEvents, section.record.timeStamp)]))
+      else:
+        self.slots.append((section.record.recordNumber, [(take.record.midiEvents, section.record.timeStamp) for take in section.folderContents]))
+      self.chunks.append([None] * len(self.slots[-1][1]))
+      mostRecentSectionEnd = section.record.timeStamp + section.record.sectionLength
 
-def writeSection(recordNo, recordLabel, section, bDoStems, path, file, stemPath, stemFile):
-  midiEvents = section.record.midiEvents
+    # A digest of the events of every take of each multi-take section, so that
+    # cut-ups with the same content can be found without rendering them
+    self.takeDigests = dict()
+    for recordNumber, takes in self.slots:
+      if(recordNumber is not None):
+        self.takeDigests[recordNumber] = [getEventsDigest(midiEvents) for midiEvents, timeStamp in takes]
+    self.layoutDigest = None
   
-  if(bDoStems):
-    noteToTrackLookup = NoteToTrackLookup()
-    noteToTrackLookup.addNotes(midiEvents)
-    trackCount = noteToTrackLookup.getTrackCount()
-  else:
-    noteToTrackLookup = None
-    trackCount = 1   
+    # The file header and tempo track are the same for every cut-up
+    if(midiWriter == "native"):
+      self.template = project.allocateMIDIFile(1)
+      tempoTrack = self.template.encodeTrack(list(self.template.tracks[0]))
+      self.fileHeader = (SMF_HEADER.pack(b'MThd', 6, self.template.fileFormat, len(self.template.tracks), self.template.ticksPerQuarterNote) +
+                         SMF_TRACK_HEADER.pack(b'MTrk', len(tempoTrack)) + bytes(tempoTrack))
+      self.trackNamePrefix = b'\x00' + self.template.tracks[1][0][3]
   
-  perSectionMIDIFileData = allocateMIDIFile(trackCount)        
-  dumpSection(perSectionMIDIFileData, midiEvents, 0, 0, 0, noteToTrackLookup, None)
-  if(bDoStems):
-    writeMIDI(stemPath, stemFile, perSectionMIDIFileData)
-  else:
-    perSectionMIDIFileData.addTrackName(0, 0, "{}".format(recordLabel))
-    writeMIDI(path, file, perSectionMIDIFileData)
+  # Render the events of one section or take, as dumpTrack() would, into a chunk
+  def createChunk(self, midiEvents, timeStamp):
+    chunkWriter = SMFWriter(1)
+    self.project.dumpSection(chunkWriter, midiEvents, timeStamp, 0, 0, None, None)
+    return CutUpChunk(chunkWriter)
    
-def dumpSectionOrSectionStems(bDoStems):
-  debugPrint("Dumping sections") 
-  for track in rootFolder.getTrackSet():        
-    for section in getSectionsForTrack(track):
-      debugPrint(" Section {} ({}) timestamp {} track {}".format(section.record.recordNumber, section.record.label, section.record.timeStamp, section.trackName))
+  def getChunk(self, slotIndex, takeIndex):
+    chunk = self.chunks[slotIndex][takeIndex]
+    if(chunk is None):
+      chunk = self.createChunk(*self.slots[slotIndex][1][takeIndex])
+      self.chunks[slotIndex][takeIndex] = chunk
+    return chunk
+
+  # Yields the permutations of takes to write, as the index of the take to use
+  # from each multi-take section, following cutUpStrategy.  Permutations with
+  # the same content as one already yielded are skipped if
+  # bCutUpSkipDuplicates is set and at most maxPerms are yielded.
+  def iterCutUps(self):
+    takeSizes = [len(multiTake.folderContents) for multiTake in self.multiTakes]
+    if(cutUpStrategy == "lexicographic"):
+      permutations = itertools.product(*[range(0, i) for i in takeSizes])
+    elif(cutUpStrategy == "graycode"):
+      permutations = grayCodePermutations(takeSizes)
+    elif(cutUpStrategy == "random"):
+      permutations = randomPermutations(takeSizes, cutUpSeed)
+    elif(cutUpStrategy == "cover"):
+      permutations = coveringPermutations(takeSizes)
+    else:
+      raise GBExtractorError("ERROR: Unknown cut-up strategy {}".format(cutUpStrategy))
+
+    contentKeys = set()
+    permCount = 0
+    for permutation in permutations:
+      if(maxPerms != -1 and permCount >= maxPerms):
+        trace("render", "maxPerms hit for this track, breaking from perm loop")
+        return
+      if(bCutUpSkipDuplicates):
+        contentKey = self.getContentKey(permutation)
+        if(contentKey in contentKeys):
+          trace("render", "Skipping cut-up {}, it has the same content as an earlier one", permutation)
+          continue
+        contentKeys.add(contentKey)
+      yield permutation
+      permCount += 1
+
+  # Returns a digest of the takes that a permutation uses.  Sections which are
+  # skipped for overlapping the one before do not change the content.
+  def getContentKey(self, permutation):
+    multiTakeChoices = self.getMultiTakeChoices(permutation)
+    contentKey = hashlib.blake2b(digest_size=16)
+    for recordNumber, takes in self.slots:
+      if(recordNumber is not None):
+        contentKey.update(self.takeDigests[recordNumber][multiTakeChoices[recordNumber]])
+    return contentKey.digest()
+
+  # Returns a digest of everything that the cut-up for a permutation is made
+  # from: the sections that every cut-up uses, where each section starts and
+  # the takes that the permutation uses
+  def getCutUpDigest(self, permutation):
+    if(self.layoutDigest is None):
+      layoutDigest = hashlib.blake2b(digest_size=16)
+      for recordNumber, takes in self.slots:
+        layoutDigest.update(json.dumps([recordNumber, takes[0][1]]).encode("utf-8"))
+        if(recordNumber is None):
+          layoutDigest.update(getEventsDigest(takes[0][0]))
+      self.layoutDigest = layoutDigest.digest()
+    return self.layoutDigest + self.getContentKey(permutation)
+
+  # Returns the name of the cut-up for a permutation, which is the record
+  # number and take index of each multi-take section that it uses
+  def getCutUpText(self, permutation):
+    multiTakeChoices = self.getMultiTakeChoices(permutation)
+    return "-".join("{}_{}".format(recordNumber, multiTakeChoices[recordNumber]) for recordNumber, takes in self.slots if recordNumber is not None)
+
+  def getMultiTakeChoices(self, permutation):
+    multiTakeChoices = dict()
+    for multiTake, takeIndex in zip(self.multiTakes, permutation):
+      multiTakeChoices[multiTake.record.recordNumber] = takeIndex
+    return multiTakeChoices
+
+  # Returns the name of the cut-up and its MIDI file for one permutation, given
+  # as the index of the take to use from each multi-take section
+  def createCutUp(self, permutation):
+    multiTakeChoices = self.getMultiTakeChoices(permutation)
+
+    # MIDIUtil files are rendered from the events of each take
+    if(midiWriter != "native"):
+      midiFileData = self.project.allocateMIDIFile(1)
+      cutUpText = self.project.dumpTrack(self.track, 0, multiTakeChoices, midiFileData)
+      midiFileData.addTrackName(0, 0, "{}".format(cutUpText))
+      return cutUpText, midiFileData
+
+    cutUpText = self.getCutUpText(permutation)
+    chunks = []
+    for slotIndex, (recordNumber, takes) in enumerate(self.slots):
+      if(recordNumber is None):
+        chunks.append(self.getChunk(slotIndex, 0))
+      else:
+        chunks.append(self.getChunk(slotIndex, multiTakeChoices.get(recordNumber)))
+
+    cutUpName = "{}".format(cutUpText)
+    chunks = [chunk for chunk in chunks if chunk.eventCount]
+    encodedChunks = []
+    noteStacks = dict()
+    bCanSplice = True
+    for chunk in chunks:
+      soundingNotes = {key: stack for key, stack in noteStacks.items() if key in chunk.noteKeys}
+      firstTick, lastTick, data, chunkStacks = chunk.encode(soundingNotes)
+      if(encodedChunks):
+        bCanSplice = chunk.uniqueFirstTick > previousUniqueTick and firstTick > encodedChunks[-1][1]
+      else:
+        bCanSplice = firstTick >= 0 # Track names are at tick 0
+      if(not bCanSplice):
+        break
+      for key in soundingNotes:
+        del noteStacks[key]
+      noteStacks.update(chunkStacks)
+      encodedChunks.append((firstTick, lastTick, data))
+      previousUniqueTick = chunk.uniqueLastTick
+
+    if(not bCanSplice):
+      trace("render", "Writing cut-up {} event by event", cutUpName)
+      midiFileData = self.project.allocateMIDIFile(1)
+      for chunk in chunks:
+        chunk.addTo(midiFileData)
+      midiFileData.addTrackName(0, 0, cutUpName)
+      return cutUpText, midiFileData
+
+    name = cutUpName.encode("ISO-8859-1")
+    trackData = bytearray(self.trackNamePrefix)
+    trackData += b'\x00\xFF\x03' + encodeVarLength(len(name)) + name
+    previousTick = 0
+    for firstTick, lastTick, data in encodedChunks:
+      trackData += encodeVarLength(firstTick - previousTick)
+      trackData += data
+      previousTick = lastTick
+    trackData += SMF_END_OF_TRACK
+    return cutUpText, EncodedMIDIFile(self.fileHeader + SMF_TRACK_HEADER.pack(b'MTrk', len(trackData)) + trackData)
+
+# The events of one section or take of a cut-up.  The events as added to the
+# SMFWriter are kept for permutations that cannot be spliced, along with the
+# events with duplicates removed, their range of ticks and the keys of all of
+# their notes.  The encoded events are cached for each set of notes sounding at
+# the start of the chunk.
+class CutUpChunk:
+  def __init__(self, chunkWriter):
+    self.writer = chunkWriter
+    self.events = chunkWriter.tracks[chunkWriter.trackOffset]
+    self.eventCount = chunkWriter.eventCounter
+    self.uniqueEvents = chunkWriter.removeDuplicates(list(self.events))
+    self.uniqueFirstTick = min(event[0] for event in self.uniqueEvents) if self.eventCount else 0
+    self.uniqueLastTick = max(event[0] for event in self.uniqueEvents) if self.eventCount else 0
+    self.noteKeys = {SMF_NOTE_KEYS[message[0] & 0x0F][message[1]] for tick, order, insertionOrder, message in self.events
+                     if order == SMF_ORDER_NOTE_ON or order == SMF_ORDER_NOTE_OFF}
+    self.encodings = dict()
+
+  # Returns the first and last tick of the sorted and de-interleaved events,
+  # the encoded events without the time of the first one and the notes left
+  # sounding, given the notes sounding before the chunk as tuples of note on
+  # ticks keyed by note key
+  def encode(self, soundingNotes):
+    encodingKey = tuple(sorted(soundingNotes.items()))
+    encoding = self.encodings.get(encodingKey)
+    if(encoding is None):
+      stacks = {key: list(stack) for key, stack in soundingNotes.items()}
+      events, stacks = self.writer.sortTrack(list(self.uniqueEvents), stacks)
+      chunkStacks = {key: tuple(stack) for key, stack in stacks.items() if stack}
+      encoding = (events[0][0], events[-1][0], bytes(encodeSMFEvents(events, events[0][0])[1:]), chunkStacks)
+      self.encodings[encodingKey] = encoding
+    return encoding
+
+  # Add the events to track 0 of an SMFWriter as if they had been rendered there
+  def addTo(self, midiFileData):
+    midiFileData.addEvents(0, self.events, self.eventCount)
+
+# A MIDI file that has already been encoded
+class EncodedMIDIFile:
+  def __init__(self, fileData):
+    self.fileData = fileData
+
+  def writeFile(self, fileHandle):
+    fileHandle.write(self.fileData)
+
+# Builds the song view a few tracks at a time for GBProject.streamTracks(),
+# writing the same file as GBProject.dumpSong().  With the native MIDI writer
+# each track of the file is encoded once it has been added, so the events of
+# the tracks that have been released are not kept.
+class SongStream:
+  def __init__(self, project, tracks):
+    self.project = project
+    self.tracks = list(tracks)
+    self.trackDigests = dict()
+    self.midiFileData = project.allocateMIDIFile(len(self.tracks))
+
+  def addTracks(self, tracks):
+    trace("render", "Adding tracks {} to the song", tracks)
+    for track in tracks:
+      trackCounter = self.tracks.index(track)
+      self.trackDigests[track] = self.project.getTrackDigest(track)
+      self.midiFileData.addTrackName(trackCounter, 0, self.project.getFormattedTrackName(track))
+      self.project.dumpTrack(track, trackCounter, self.project.getMultiTakeMappings(track), self.midiFileData)
+      if(isinstance(self.midiFileData, SMFWriter)):
+        self.midiFileData.finishTrack(trackCounter)
+
+  def write(self, outputDir):
+    filename = "{}.mid".format(self.project.projectName)
+    if(self.project.isOutputCurrent(outputDir, ["full"], filename, *[self.trackDigests[track] for track in self.tracks])):
+      return
+    writeMIDI(outputDir, ["full"], filename, self.midiFileData, self.project.metrics)
+
+# Reads little-endian values from the decoded project data.  Positions are in
+# bytes.  Records are decoded with the precompiled struct layouts above straight
+# from a memoryview so there is no format string parsing per field.
+class ByteReader:
+  def __init__(self, data):
+    self.data = data
+    self.view = memoryview(data)
+    self.pos = 0
+
+  def unpack(self, layout):
+    values = layout.unpack_from(self.view, self.pos)
+    self.pos += layout.size
+    return values
+
+  def readU8(self):
+    value = self.view[self.pos]
+    self.pos += 1
+    return value
+
+  def readU16(self):
+    value = UINT16.unpack_from(self.view, self.pos)[0]
+    self.pos += 2
+    return value
+
+  def readU24(self):
+    value = int.from_bytes(self.view[self.pos:self.pos + 3], "little")
+    self.pos += 3
+    return value
+
+  def readU32(self):
+    value = UINT32.unpack_from(self.view, self.pos)[0]
+    self.pos += 4
+    return value
+
+  def readBytes(self, length):
+    value = self.view[self.pos:self.pos + length].tobytes()
+    self.pos += length
+    return value
+
+  def skip(self, length):
+    self.pos += length
+
+  # Returns the offset from the current position of the first byte within
+  # length bytes that has this value, or -1.  The position is not changed.
+  def findByte(self, value, length):
+    if(length <= 0):
+      return -1
+    offset = self.data.find(bytes((value,)), self.pos, self.pos + length)
+    return offset if offset == -1 else offset - self.pos
+
+# The same interface as ByteReader implemented with bitstring
+class BitstringReader:
+  def __init__(self, data):
+    self.stream = ConstBitStream(bytes=data)
+
+  @property
+  def pos(self):
+    return self.stream.pos // 8
+
+  @pos.setter
+  def pos(self, value):
+    self.stream.pos = value * 8
+
+  def unpack(self, layout):
+    return layout.unpack(self.readBytes(layout.size))
+
+  def readU8(self):
+    return self.stream.read("uintle:8")
+
+  def readU16(self):
+    return self.stream.read("uintle:16")
+
+  def readU24(self):
+    return self.stream.read("uintle:24")
+
+  def readU32(self):
+    return self.stream.read("uintle:32")
+
+  def readBytes(self, length):
+    return self.stream.read("bytes:{}".format(length))
+
+  def skip(self, length):
+    self.stream.pos += length * 8
+
+  def findByte(self, value, length):
+    originalPosition = self.stream.pos
+    offset = -1
+    for i in range(0, length):
+      if(self.stream.read("uintle:8") == value):
+        offset = i
+        break
+    self.stream.pos = originalPosition
+    return offset
+
+# Create a reader for the decoded project data using the configured backend
+def createReader(data):
+  if(decoderBackend == "bitstring"):
+    if(ConstBitStream is None):
+      raise GBExtractorError("ERROR: The bitstring decoder backend needs the bitstring package")
+    return BitstringReader(data)
+  return ByteReader(data)
+
+# A parsed GarageBand project.  All of the state that used to live in module
+# globals (the folder tree, the record hash, track lookups, tempo and time
+# signature) is held per instance so several projects can be opened and
+# extracted in the same process.  The user-configurable parameters and the
+# trace buffer are still module globals, so only one thread of a process
+# should extract at a time.  Every dump method takes the directory that the
+# output should be written under.
+class GBProject:
+  def __init__(self, projectName):
+    self.projectName = projectName
+    self.gbPath = None
+    self.rootFolder = Folder(0)
+    self.recordHash = dict()
+    self.trackLookup = dict()
+    self.trackNameLookup = dict()
+    self.baseTime = BASE_TIME
+    self.songTempo = None
+    self.numerator = None
+    self.denominator = None
+    self.durationAsTicks = None
+    self.decodedData = None
+    self.midiFilter = None
+    self.settingsDigest = None
+    self.recordDigests = dict()
+    # Lookups into the folder tree, see buildIndexes()
+    self.topLevelFolderIndex = dict()
+    self.trackSet = set()
+    self.sectionIndex = dict()
+    self.multiTakeIndex = dict()
+    self.trackNameIndex = dict()
+    self.recordIndex = dict()
+    # The reader and MIDI blocks of the decoded project data in streaming
+    # mode, see openStream()
+    self.streamReader = None
+    self.streamBlocks = None
+    # The timings and counters of the extraction, see Metrics
+    self.metrics = Metrics()
+
+  # Render worker processes only write events that have already been decoded,
+  # so they are not given the decoded project data, which is memory mapped in
+  # streaming mode and cannot be passed to a spawned process
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["decodedData"] = None
+    state["streamReader"] = None
+    state["streamBlocks"] = None
+    return state
+
+  # Open and parse the project.band directory at gbPath.  The decoded project
+  # data is only needed while parsing so it is released afterwards unless
+  # bKeepDecodedData is set, e.g. for dumpDecodedData().  If a ModelCache is
+  # provided then a model cached from the same projectData is used instead of
+  # parsing, and a newly parsed model is added to the cache.  If a TrackFilter
+  # is given then a newly parsed model only has the events of the tracks that it
+  # selects and it is not cached.  If bStream is set then the MIDI is not
+  # decoded, see openStream(), and the cache is not used.  The metrics of the
+  # project are added to metrics, if given, or to a new Metrics.
+  @classmethod
+  def open(cls, gbPath, bKeepDecodedData=False, modelCache=None, trackFilter=None, bStream=False, metrics=None):
+    projectName = os.path.splitext(os.path.basename(os.path.normpath(gbPath)))[0]
+    dataPath = os.path.join(gbPath, "projectData")
+    metrics = metrics or Metrics()
+
+    if(bStream):
+      project = cls(projectName)
+      project.gbPath = gbPath
+      project.metrics = metrics
+      project.openStream(dataPath)
+      return project
+
+    cacheKey = None
+    bTracingParser = any(isTracing(category) for category in ("scan", "record", "midi", "folder"))
+    if(modelCache is not None and not bKeepDecodedData and not bTracingParser and os.path.isfile(dataPath)):
+      with metrics.phase("modelCacheLoad"):
+        cacheKey = modelCache.getKey(dataPath)
+        project = modelCache.load(cacheKey, projectName)
+      if(project is not None):
+        metrics.count("modelCacheHits")
+        project.gbPath = gbPath
+        project.metrics = metrics
+        return project
+
+    project = cls(projectName)
+    project.gbPath = gbPath
+    project.metrics = metrics
+    with metrics.phase("decode"):
+      decodedData = readProjectData(dataPath)
+    metrics.count("projectDataBytes", os.path.getsize(dataPath))
+    project.parse(decodedData, bKeepDecodedData, trackFilter)
+    if(cacheKey is not None and trackFilter is None):
+      with metrics.phase("modelCacheStore"):
+        modelCache.store(cacheKey, project)
+    return project
+
+  # Build a project from a model written by writeModel()
+  @classmethod
+  def readModel(cls, projectName, modelData):
+    magic, parserVersion, descriptionLength = MODEL_CACHE_HEADER.unpack_from(modelData, 0)
+    if(magic != MODEL_CACHE_MAGIC or parserVersion != PARSER_VERSION):
+      raise GBExtractorError("ERROR: Not a model written by this version of the parser")
+    eventsStart = MODEL_CACHE_HEADER.size + descriptionLength
+    description = json.loads(bytes(modelData[MODEL_CACHE_HEADER.size:eventsStart]).decode("utf-8"))
+    eventData = memoryview(modelData)[eventsStart:]
+
+    project = cls(projectName)
+    project.songTempo = description["songTempo"]
+    project.numerator = description["numerator"]
+    project.denominator = description["denominator"]
+    project.baseTime = description["baseTime"]
+    project.trackLookup = dict(description["trackLookup"])
+    project.trackNameLookup = dict(description["trackNameLookup"])
+    project.rootFolder = project.readFolderDescription(description["rootFolder"], eventData)
+    project.durationAsTicks = millisecondsToTicks(project.songTempo, durationMin)
+    project.buildIndexes()
+    return project
+
+  def readFolderDescription(self, folderDescription, eventData):
+    index, folderRecordNumber, trackName, recordDescription, contents = folderDescription
+    folder = Folder(index)
+    folder.folderRecordNumber = folderRecordNumber
+    folder.trackName = trackName
+    if(recordDescription is not None):
+      recordNumber, timeStamp, label, sectionLength, eventStart, eventCount = recordDescription
+      folder.record = Record(recordNumber, timeStamp)
+      folder.record.label = label
+      folder.record.sectionLength = sectionLength
+      folder.record.midiEvents = EventStore.fromBytes(eventData[eventStart * EVENT_STORE_ROW_SIZE:(eventStart + eventCount) * EVENT_STORE_ROW_SIZE], eventCount)
+    for subFolderDescription in contents:
+      folder.folderContents.append(self.readFolderDescription(subFolderDescription, eventData))
+    return folder
+
+  # Serialise the parsed model to a binary file object.  The folder tree, track
+  # lookups, tempo and time signature are described in JSON and the event
+  # stores of every record follow, as written by EventStore.toBytes()
+  def writeModel(self, modelFile):
+    eventData = bytearray()
+    description = {"songTempo": self.songTempo,
+                   "numerator": self.numerator,
+                   "denominator": self.denominator,
+                   "baseTime": self.baseTime,
+                   "trackLookup": list(self.trackLookup.items()),
+                   "trackNameLookup": list(self.trackNameLookup.items()),
+                   "rootFolder": self.describeFolder(self.rootFolder, eventData)}
+    descriptionData = json.dumps(description, separators=(",", ":")).encode("utf-8")
+    modelFile.write(MODEL_CACHE_HEADER.pack(MODEL_CACHE_MAGIC, PARSER_VERSION, len(descriptionData)))
+    modelFile.write(descriptionData)
+    modelFile.write(eventData)
+
+  def describeFolder(self, folder, eventData):
+    recordDescription = None
+    if(folder.record is not None):
+      record = folder.record
+      eventStart = len(eventData) // EVENT_STORE_ROW_SIZE
+      eventData += record.midiEvents.toBytes()
+      recordDescription = [record.recordNumber, record.timeStamp, record.label, record.sectionLength,
+                           eventStart, len(record.midiEvents)]
+    return [folder.index, folder.folderRecordNumber, folder.trackName, recordDescription,
+            [self.describeFolder(subFolder, eventData) for subFolder in folder.folderContents]]
+
+  # Parse the decoded NS.data payload of a projectData file.  The parser works
+  # directly on this buffer.  If a TrackFilter is given then only the MIDI
+  # blocks of the tracks that it selects are decoded.
+  def parse(self, decodedData, bKeepDecodedData=True, trackFilter=None):
+    self.decodedData = decodedData
+    try:
+      self.parseDecodedData(decodedData, trackFilter)
+    finally:
+      if(not bKeepDecodedData):
+        self.decodedData = None
+
+  def parseDecodedData(self, decodedData, trackFilter=None):
+    s, midiBlocks = self.readRecords(decodedData)
+
+    # The folders and track names have all been read so the records of each
+    # track are known before any MIDI is decoded
+    selectedRecords = None
+    if(trackFilter is not None):
+      self.indexTracks()
+      selectedRecords = self.getRecordsForTracks(self.selectTracks(trackFilter))
+    self.decodeMIDIBlocks(s, midiBlocks, selectedRecords)
+
+  # Read the header and the records of the decoded project data, in offset
+  # order.  Returns the reader and the MIDI blocks, which are decoded by
+  # decodeMIDIBlocks()
+  def readRecords(self, decodedData):
+    s = createReader(decodedData)
+    self.readHeader(s)
+    with self.metrics.phase("scan"):
+      offsetList = self.scanRecords(decodedData)
+    self.metrics.count("bytesScanned", len(decodedData))
+    for thisOffset, signature in offsetList:
+      self.metrics.countBy("records", signature.decode("ascii", "replace"))
+    with self.metrics.phase("records"):
+      if(isinstance(decodedData, mmap.mmap)):
+        offsetList = iterReleasingPages(offsetList, decodedData)
+      midiBlocks = self.processOffsetList(s, offsetList)
+    return s, midiBlocks
+
+  # Build the indexes from the folders and track names before any MIDI has
+  # been decoded, so that the records of each track are known
+  def indexTracks(self):
+    for topLevelFolder in self.rootFolder.folderContents:
+      self.resolveTrackName(topLevelFolder)
+    self.buildIndexes()
+
+  # Decode the MIDI blocks of selectedRecords, or every record, and give the
+  # events to their folders
+  def decodeMIDIBlocks(self, s, midiBlocks, selectedRecords=None):
+    with self.metrics.phase("midi"):
+      self.processMIDIBlocks(s, midiBlocks, selectedRecords)
+    with self.metrics.phase("associate"):
+      self.associateMIDIEvents()
+      self.buildIndexes()
+
+  # Read the records of the projectData file at dataPath for streamTracks()
+  # without decoding any MIDI.  The root folder and the track references can
+  # be anywhere in the data, so the records of a track are only known once
+  # every record has been read, but until the MIDI is decoded that only needs
+  # the small folder and section records.  The decoded data is written to a
+  # temporary file and memory mapped, so it is held by the OS page cache,
+  # which can drop it, rather than by this process.
+  def openStream(self, dataPath):
+    with self.metrics.phase("decode"):
+      self.decodedData = readProjectDataToMap(dataPath)
+    self.metrics.count("projectDataBytes", os.path.getsize(dataPath))
+    self.streamReader, self.streamBlocks = self.readRecords(self.decodedData)
+    self.indexTracks()
+    releaseMappedPages(self.decodedData)
+
+  # Release the decoded project data of streaming mode.  The map is closed
+  # once nothing is reading it
+  def closeStream(self):
+    decodedData = self.decodedData
+    self.decodedData = self.streamReader = self.streamBlocks = None
+    if(isinstance(decodedData, mmap.mmap)):
+      try:
+        decodedData.close()
+      except BufferError:
+        pass
+
+  # Read the tempo and time signature from the start of the project data
+  def readHeader(self, s):
+    traceHex("record", 0x800, s)
+
+    # Pull out the tempo, offset is number of BITS
+    s.pos = TEMPO_OFFSET // 8
+    preciseBPM = s.readU24()
+    self.songTempo = preciseBPM/10000
+    trace("record", "Tempo BPM is {} ({:#x})", self.songTempo, preciseBPM)
+
+    # Pull out the time signature
+    s.pos = TIME_SIGNATURE_OFFSET // 8
+    self.numerator = s.readU8()
+    self.denominator = s.readU8()
+    trace("record", "Time signature is {}/{}", self.numerator, 2**self.denominator)
+
+    self.durationAsTicks = millisecondsToTicks(self.songTempo, durationMin)
+
+  # Generate an ordered list of offsets pointing to the records in the
+  # binary data that we are interested in
+  def scanRecords(self, decodedData):
+    # Batch workers are daemon processes which cannot start a process pool
+    if(scanWorkers > 1 and len(decodedData) > SCAN_CHUNK_SIZE and not multiprocessing.current_process().daemon):
+      chunkSize = max(SCAN_CHUNK_SIZE, len(decodedData) // (scanWorkers * 4) + 1)
+      with concurrent.futures.ProcessPoolExecutor(scanWorkers) as executor:
+        offsetList = scanRecordOffsets(decodedData, executor, chunkSize)
+    else:
+      offsetList = scanRecordOffsets(decodedData)
+    trace("scan", "Found {} records in {} bytes", len(offsetList), len(decodedData))
+    return offsetList
+
+  # Build the lookups used while writing from the parsed folder tree: the set
+  # of tracks, the sections and multi-take sections of each track sorted by
+  # time stamp, the name of each track and the record of each record number
+  def buildIndexes(self):
+    self.trackSet = self.rootFolder.getTrackSet()
+    self.sectionIndex = {track: [] for track in self.trackSet}
+    self.trackNameIndex = dict()
+    self.recordIndex = dict()
+    for topLevelFolder in self.rootFolder.folderContents:
+      self.sectionIndex[topLevelFolder.index].append(topLevelFolder)
+      self.trackNameIndex.setdefault(topLevelFolder.index, topLevelFolder.trackName)
+      self.recordIndex.setdefault(topLevelFolder.record.recordNumber, topLevelFolder.record)
+    for topLevelFolder in self.rootFolder.folderContents:
+      for subFolder in topLevelFolder.folderContents:
+        self.recordIndex.setdefault(subFolder.record.recordNumber, subFolder.record)
+
+    # Fortunately references to grouped takes do store
+    # the timestamp of the start of the section
+    for sectionList in self.sectionIndex.values():
+      sectionList.sort(key=lambda x: x.record.timeStamp)
+    self.multiTakeIndex = {track: [section for section in sectionList if section.folderContents] for track, sectionList in self.sectionIndex.items()}
+
+  # Returns the set of track numbers used by the sections in the root folder
+  def getTrackSet(self):
+    return self.trackSet
+
+  # Returns the tracks that a TrackFilter selects, in the order of
+  # getTrackSet(), or every track if trackFilter is None
+  def selectTracks(self, trackFilter):
+    return [track for track in self.getTrackSet() if trackFilter is None or trackFilter.matches(track, self.getTrackName(track))]
+
+  # Returns the record numbers of the sections and takes of some tracks
+  def getRecordsForTracks(self, tracks):
+    recordNumbers = set()
+    for track in tracks:
+      for section in self.getSectionsForTrack(track):
+        recordNumbers.add(section.record.recordNumber)
+        recordNumbers.update(take.record.recordNumber for take in section.folderContents)
+    return recordNumbers
+
+  # Count the tracks, sections, takes and events of each type in the model
+  def countModel(self, metrics):
+    metrics.count("tracks", len(self.getTrackSet()))
+    for sectionList in self.sectionIndex.values():
+      for section in sectionList:
+        metrics.count("sections")
+        metrics.count("takes", len(section.folderContents))
+    self.countEvents(metrics, self.recordIndex.values())
+
+  # Count the events of each type in some records
+  def countEvents(self, metrics, records):
+    for record in records:
+      for eventType, name in EVENT_TYPE_NAMES.items():
+        eventCount = record.midiEvents.types.count(eventType)
+        if(eventCount):
+          metrics.countBy("events", name, eventCount)
+
+  # Write the decoded project data to decoded.bin in outputDir
+  def dumpDecodedData(self, outputDir):
+    if(self.decodedData is None):
+      raise GBExtractorError("ERROR: The decoded project data was not kept")
+    getOutputSink(outputDir).addFile([], "decoded.bin", bytes(self.decodedData))
+
+  # Dump the parsed folder tree and lookups when debugging
+  def debugPrintModel(self):
+    if(not isTracing("folder")): return
+
+    trace("folder", "trackLookup items:")
+    for key, lookup in self.trackLookup.items():
+      trace("folder", "key {} lookup {}", key, lookup)
+
+    trace("folder", "trackNameLookup items:")
+    for key, lookup in self.trackNameLookup.items():
+      trace("folder", "key {} lookup {}", key, lookup)
+
+    trace("folder", "Root folder:")
+    for thisFolder in self.rootFolder.folderContents:
+      trace("folder", "  Top level folder: idx {} record number {} folder id {} trackName {}", thisFolder.index, thisFolder.record.recordNumber, thisFolder.folderRecordNumber, thisFolder.trackName)
+      for subFolder in thisFolder.folderContents:
+        trace("folder", "   Sub Folder: idx {} record number {} folder id {} trackName {}", subFolder.index, subFolder.record.recordNumber, subFolder.folderRecordNumber, subFolder.trackName)
+
+  # Write the MIDI views named by views, or those enabled by the
+  # user-configurable parameters, of the tracks that trackFilter selects, or
+  # every track, to outputDir, which is a directory path or an output sink.
+  # Each view of each track is a separate render job and with more than one
+  # worker, or 0 for one per CPU, the jobs are shared between a process pool.
+  # The model is only read while rendering and every job writes to its own
+  # paths, so the files written do not depend on the number of workers.  The
+  # output of each job is printed in job order, as if they had run serially.
+  def dumpAll(self, outputDir, workers=1, views=None, trackFilter=None):
+    workers = getRenderWorkers(workers)
+    tracks = self.selectTracks(trackFilter)
+    if(not tracks):
+      print("No tracks match the track filter")
+      return
+    self.runRenderJobs(getOutputSink(outputDir), self.getRenderJobs(workers, views, tracks), workers)
+
+  # Run render jobs from getRenderJobs(), writing to sink, on up to workers
+  # processes
+  def runRenderJobs(self, sink, jobs, workers):
+    if(workers <= 1 or len(jobs) <= 1):
+      for job in jobs:
+        self.renderView(sink, *job)
+      return
+
+    # Workers write to a directory themselves but return the files for an
+    # archive, which are added in job order.  An incremental sink gets back the
+    # keys of the files that each job made.  Files still waiting for the writer
+    # threads are written first, as the workers only get a copy of the sink.
+    jobSink = sink if isinstance(sink, DirectorySink) else None
+    if(jobSink):
+      jobSink.flush()
+    with concurrent.futures.ProcessPoolExecutor(min(workers, len(jobs)), initializer=initRenderWorker, initargs=(self, jobSink, getSettings())) as executor:
+      futures = [executor.submit(renderJob, *job) for job in jobs]
+      try:
+        for future in futures:
+          jobLog, jobFiles, jobOutputs, jobMetrics = future.result()
+          sys.stdout.write(jobLog)
+          self.metrics.merge(jobMetrics)
+          for path, filename, data in jobFiles:
+            sink.addFile(path, filename, data)
+          if(jobOutputs):
+            sink.outputs.update(jobOutputs)
+      except BaseException:
+        for future in futures:
+          future.cancel()
+        raise
+
+  # Write the same views as dumpAll() in streaming mode, see openStream().
+  # The tracks are split into groups by getStreamGroups() and the MIDI of each
+  # group is decoded, written and released before the next.  The song view is
+  # built up a group at a time and written at the end.
+  def streamTracks(self, outputDir, workers=1, views=None, trackFilter=None):
+    workers = getRenderWorkers(workers)
+    tracks = self.selectTracks(trackFilter)
+    if(not tracks):
+      print("No tracks match the track filter")
+      return
+    sink = getOutputSink(outputDir)
+    viewNames = getViewNames(views)
+    trackViews = [viewName for viewName in viewNames if viewName != "song"]
+    song = SongStream(self, tracks) if "song" in viewNames else None
+    for group in self.getStreamGroups(tracks):
+      trace("main", "Streaming tracks {}", group)
+      self.metrics.count("streamGroups")
+      records = self.getRecordsForTracks(group)
+      self.decodeMIDIBlocks(self.streamReader, self.streamBlocks, records)
+      self.countEvents(self.metrics, [self.getRecord(recordNumber) for recordNumber in records])
+      if(trackViews):
+        self.runRenderJobs(sink, self.getRenderJobs(workers, trackViews, group), workers)
+      if(song is not None):
+        with self.metrics.phase("view.song"):
+          song.addTracks(group)
+      self.releaseTracks(group)
+    if(song is not None):
+      with self.metrics.phase("view.song"):
+        song.write(sink)
+
+  # Split tracks, in order, into groups whose MIDI blocks add up to no more
+  # than streamMemoryLimit bytes
+  def getStreamGroups(self, tracks):
+    blockSizes = dict()
+    for midiSection, recordNumber, recordMidiID, dataStart, dataLength in self.streamBlocks:
+      blockSizes[midiSection.recordNumber] = blockSizes.get(midiSection.recordNumber, 0) + dataLength
+    groups = []
+    groupSize = 0
+    for track in tracks:
+      trackSize = sum(blockSizes.get(recordNumber, 0) for recordNumber in self.getRecordsForTracks([track]))
+      if(trackSize > streamMemoryLimit):
+        trace("main", "Track {} has {} bytes of MIDI, more than streamMemoryLimit", track, trackSize, level=TRACE_WARN)
+      if(groups and groupSize + trackSize <= streamMemoryLimit):
+        groups[-1].append(track)
+        groupSize += trackSize
+      else:
+        groups.append([track])
+        groupSize = trackSize
+    return groups
+
+  # Drop the events of some tracks once their views have been written
+  def releaseTracks(self, tracks):
+    records = self.getRecordsForTracks(tracks)
+    for midiSection, recordNumber, recordMidiID, dataStart, dataLength in self.streamBlocks:
+      if(midiSection.recordNumber in records):
+        midiSection.midiEvents = None
+    for track in tracks:
+      for section in self.getSectionsForTrack(track):
+        section.record.midiEvents = EventStore()
+        for take in section.folderContents:
+          take.record.midiEvents = EventStore()
+    releaseMappedPages(self.decodedData)
+
+  # Returns the (view name, track, cut-up range) render jobs for views, see
+  # getViewNames(), and tracks, or every track, in the order that they are
+  # written.  The track of the song view is the list of tracks in the song.
+  # With more than one worker the cut-ups of a track are split into ranges so
+  # that they can be shared between workers, otherwise the cut-up range is None.
+  def getRenderJobs(self, workers=1, views=None, tracks=None):
+    if(tracks is None):
+      tracks = list(self.getTrackSet())
+    jobs = []
+    for viewName in getViewNames(views):
+      if(viewName == "song"):
+        jobs.append((viewName, tuple(tracks), None))
+      elif(viewName == "cutUps" and workers > 1):
+        for track in tracks:
+          jobs.extend((viewName, track, cutUpRange) for cutUpRange in self.getCutUpRanges(track, workers))
+      else:
+        jobs.extend((viewName, track, None) for track in tracks)
+    return jobs
+
+  # Split the cut-ups of a track into up to CUT_UP_JOBS_PER_WORKER ranges per
+  # worker of at least MIN_CUT_UPS_PER_JOB cut-ups each.  Every job goes
+  # through the permutations up to the end of its range, which only costs a
+  # digest lookup for each cut-up that it does not write.
+  def getCutUpRanges(self, track, workers):
+    cutUpEngine = self.getCutUpEngine(track)
+    if(cutUpEngine is None):
+      return [None]
+    cutUpCount = sum(1 for permutation in cutUpEngine.iterCutUps())
+    rangeCount = max(1, min(workers * CUT_UP_JOBS_PER_WORKER, cutUpCount // MIN_CUT_UPS_PER_JOB))
+    if(rangeCount == 1):
+      return [None]
+    return [(i * cutUpCount // rangeCount, (i + 1) * cutUpCount // rangeCount) for i in range(rangeCount)]
+
+  # Write one view of one track, or for the song view of the list of tracks in
+  # the song, or every track if track is None
+  def renderView(self, outputDir, viewName, track, cutUpRange=None):
+    with self.metrics.phase("view." + viewName):
+      self.renderViewForTrack(outputDir, viewName, track, cutUpRange)
+
+  def renderViewForTrack(self, outputDir, viewName, track, cutUpRange):
+    if(viewName == "tracks"):
+      self.dumpTracksForTrack(outputDir, track)
+    elif(viewName == "song"):
+      self.dumpSong(outputDir, track)
+    elif(viewName == "trackStems"):
+      self.dumpTrackStemsForTrack(outputDir, track)
+    elif(viewName == "cutUps"):
+      self.dumpCutUpsForTrack(outputDir, track, cutUpRange)
+    elif(viewName == "sectionStems"):
+      self.dumpSectionsForTrack(outputDir, track, True)
+    elif(viewName == "sections"):
+      self.dumpSectionsForTrack(outputDir, track, False)
+    elif(viewName == "sectionsFiltered"):
+      self.dumpSectionsFilteredForTrack(outputDir, track)
+    else:
+      raise GBExtractorError("ERROR: Unknown view {}".format(viewName))
+
+  # Copy the audio files in the project to outputDir, which is a directory path
+  # or an output sink.  The zipped copy of the audio is only made for
+  # directories as archives are already a single file.
+  def extractAudio(self, outputDir):
+    sink = getOutputSink(outputDir)
+    audioFiles = self.getAudioFiles()
+    if(isinstance(sink, DirectorySink)):
+      exportAudio(sink.rootDir, audioFiles, isinstance(sink, IncrementalSink), self.metrics)
+    else:
+      for path, filename, sourcePath in audioFiles:
+        trace("audio", "Copying {} to {}", sourcePath, "/".join(path))
+        sink.addPath(path, filename, sourcePath)
+        self.metrics.count("audioFilesCopied")
+        self.metrics.count("audioBytesCopied", os.path.getsize(sourcePath))
+      self.metrics.count("audioFiles", len(audioFiles))
+
+  # Returns a sorted list of (path, filename, sourcePath) for the audio files
+  # in the project, which includes direct recording, audio imported by the
+  # user and from Apple Loops, sampler audio and frozen tracks
+  def getAudioFiles(self):
+    audioFiles = []
+    for folder, path in AUDIO_FOLDERS:
+      try:
+        entries = list(os.scandir(os.path.join(self.gbPath, *folder)))
+      except OSError:
+        continue
+      for entry in entries:
+        if(not entry.name.startswith(".") and entry.is_file()):
+          audioFiles.append((path, entry.name, entry.path))
+    audioFiles.sort()
+    return audioFiles
+
+  # Return a sorted list of sections for a particular
+  # track.  The list is shared so it must not be modified.
+  def getSectionsForTrack(self, trackNumber):
+    return self.sectionIndex.get(trackNumber, [])
+
+  # Returns a list of sections, sorted by time stamp, which
+  # are multi-take sections from the provided track
+  def getMulitTakeSectionsForTrack(self, trackNumber):
+    return self.multiTakeIndex.get(trackNumber, [])
+
+  def getTrackName(self, trackNumber):
+    return self.trackNameIndex.get(trackNumber, "")
+
+  # Returns a map of record numbers which are multi-take
+  # sections and indicate which take should be used in
+  # each permutation of takes.  This function initialises
+  # the map to zero.
+  def getMultiTakeMappings(self, trackNumber):
+    multiTakes = self.getMulitTakeSectionsForTrack(trackNumber)
+    return initMultiTakeChoices(multiTakes)
+
+  def dumpSections(self, outputDir):
+    self.dumpSectionOrSectionStems(outputDir, False)
+
+  def dumpSectionStems(self, outputDir):
+    self.dumpSectionOrSectionStems(outputDir, True)
+
+  def writeSection(self, outputDir, recordNo, recordLabel, section, bDoStems, path, file, stemPath, stemFile):
+    if(bDoStems):
+      bCurrent = self.isOutputCurrent(outputDir, stemPath, stemFile, self.getRecordDigest(section.record))
+    else:
+      bCurrent = self.isOutputCurrent(outputDir, path, file, self.getRecordDigest(section.record))
+    if(bCurrent):
+      return
+
+    midiEvents = section.record.midiEvents
+
+    if(bDoStems):
+      noteToTrackLookup = NoteToTrackLookup()
+      noteToTrackLookup.addNotes(midiEvents)
+      trackCount = noteToTrackLookup.getTrackCount()
+    else:
+      noteToTrackLookup = None
+      trackCount = 1
+
+    perSectionMIDIFileData = self.allocateMIDIFile(trackCount)
+    self.dumpSection(perSectionMIDIFileData, midiEvents, 0, 0, 0, noteToTrackLookup, None)
+    if(bDoStems):
+      writeMIDI(outputDir, stemPath, stemFile, perSectionMIDIFileData, self.metrics)
+    else:
+      perSectionMIDIFileData.addTrackName(0, 0, "{}".format(recordLabel))
+      writeMIDI(outputDir, path, file, perSectionMIDIFileData, self.metrics)
+
+  def dumpSectionOrSectionStems(self, outputDir, bDoStems):
+    trace("render", "Dumping sections")
+    for track in self.getTrackSet():
+      self.dumpSectionsForTrack(outputDir, track, bDoStems)
+
+  def dumpSectionsForTrack(self, outputDir, track, bDoStems):
+    for section in self.getSectionsForTrack(track):
+      trace("render", " Section {} ({}) timestamp {} track {}", section.record.recordNumber, section.record.label, section.record.timeStamp, section.trackName)
             
       if(not section.folderContents):
         # This section does not contain multiple takes
         recordLabel = cleanStringForFile(section.record.label)
         recordNo = str(section.record.recordNumber)
-        writeSection(recordNo, recordLabel, section, bDoStems,
-                     getSectionsPath(track), "{}-{}{}-{}.mid".format(track, "S", recordNo, recordLabel),
-                     getSectionsPath(track) + ["stems"], "{}-{}{}-{}.mid".format(track, "SStem", recordNo, recordLabel)) 
+        self.writeSection(outputDir, recordNo, recordLabel, section, bDoStems,
+                          self.getSectionsPath(track), "{}-{}{}-{}.mid".format(track, "S", recordNo, recordLabel),
+                          self.getSectionsPath(track) + ["stems"], "{}-{}{}-{}.mid".format(track, "SStem", recordNo, recordLabel))
       else:
         for sectionToUse in section.folderContents:
           recordNo = str(section.record.recordNumber)
           recordLabel = cleanStringForFile(sectionToUse.record.label)
           sectionIndex = sectionToUse.index
           
-          writeSection(recordNo, recordLabel, sectionToUse, bDoStems,
-                       getSectionsPath(track) + ["takes", "S{}_{}".format(recordNo, recordLabel)], "{}-{}{}-{}-T{}.mid".format(track, "S", recordNo, recordLabel, sectionIndex),
-                       getSectionsPath(track) + ["stems", "takes", "S{}_{}".format(recordNo, recordLabel)], "{}-{}{}-{}-T{}.mid".format(track, "SStem", recordNo, recordLabel, sectionIndex))
-
-def dumpSectionsFiltered():
-  debugPrint("Dumping sections with filter applied")  
-  for track in rootFolder.getTrackSet():
-    sectionList = getSectionsForTrack(track) 
+          self.writeSection(outputDir, recordNo, recordLabel, sectionToUse, bDoStems,
+                            self.getSectionsPath(track) + ["takes", "S{}_{}".format(recordNo, recordLabel)], "{}-{}{}-{}-T{}.mid".format(track, "S", recordNo, recordLabel, sectionIndex),
+                            self.getSectionsPath(track) + ["stems", "takes", "S{}_{}".format(recordNo, recordLabel)], "{}-{}{}-{}-T{}.mid".format(track, "SStem", recordNo, recordLabel, sectionIndex))
+
+  def dumpSectionsFiltered(self, outputDir):
+    trace("render", "Dumping sections with filter applied")
+    for track in self.getTrackSet():
+      self.dumpSectionsFilteredForTrack(outputDir, track)
         
-    for section in sectionList:
-      debugPrint(" Section {} ({}) timestamp {}".format(section.record.recordNumber, section.record.label, section.record.timeStamp))
+  def dumpSectionsFilteredForTrack(self, outputDir, track):
+    for section in self.getSectionsForTrack(track):
+      trace("render", " Section {} ({}) timestamp {}", section.record.recordNumber, section.record.label, section.record.timeStamp)
      
       if(not section.folderContents):
         # This section does not contain multiple takes
-        writeSectionFiltered(section, track, getSectionsPath(track) + ["filtered"], str(section.record.recordNumber))             
+        self.writeSectionFiltered(outputDir, section, track, self.getSectionsPath(track) + ["filtered"], str(section.record.recordNumber))
       else:
         for sectionToUse in section.folderContents:
-          writeSectionFiltered(sectionToUse, track, getSectionsPath(track) + ["filtered", "takes", "S{}_{}".format(str(section.record.recordNumber), cleanStringForFile(sectionToUse.record.label))], str(section.record.recordNumber))                      
+          self.writeSectionFiltered(outputDir, sectionToUse, track, self.getSectionsPath(track) + ["filtered", "takes", "S{}_{}".format(str(section.record.recordNumber), cleanStringForFile(sectionToUse.record.label))], str(section.record.recordNumber))
        
-def writeSectionFiltered(section, track, folder, recordNumber):
-  # Three tracks - original, filtered, delta
-  perSectionMIDIFileData = allocateMIDIFile(3)
-  sectionLabel = cleanStringForFile(section.record.label)
-  for i in range(0, 3):  
-    if(i == 0):
-      midiFilter = None
-      trackName = "Orig_{}".format(sectionLabel)
-    elif(i == 1):
-      midiFilter = MIDIFilter(velocityMin, velocityMax, durationAsTicks, False)
-      trackName = "Filtered_{}".format(sectionLabel)
+  # Write the filtered section to its own file, then the original, filtered
+  # and delta (rejected) tracks to a deltas file.  The filter is evaluated once
+  # and the section is rendered once by the native writer, with its rendered
+  # events shared between the files.
+  def writeSectionFiltered(self, outputDir, section, track, folder, recordNumber):
+    sectionLabel = cleanStringForFile(section.record.label)
+    filteredFile = "{}-S{}-{}-T{}.mid".format(track, recordNumber, sectionLabel, section.index)
+    deltasFile = "{}-deltas-S{}-{}-T{}.mid".format(track, recordNumber, sectionLabel, section.index)
+    recordDigest = self.getRecordDigest(section.record)
+    if(all([self.isOutputCurrent(outputDir, folder, filteredFile, recordDigest),
+            self.isOutputCurrent(outputDir, folder, deltasFile, recordDigest)])):
+      return
+
+    midiEvents = section.record.midiEvents
+    flags = self.getMIDIFilter().partition(midiEvents)
+    trackNames = ["Orig_{}".format(sectionLabel), "Filtered_{}".format(sectionLabel), "Delta_{}".format(sectionLabel)]
+
+    if(midiWriter == "native"):
+      # Each event is rendered with its index in midiEvents as its insertion order
+      sectionWriter = SMFWriter(1)
+      self.dumpSection(sectionWriter, midiEvents, 0, 0, 0, None, None)
+      renderedEvents = sectionWriter.tracks[sectionWriter.trackOffset]
+      partitions = [renderedEvents,
+                    [event for event in renderedEvents if flags[event[2]] & FILTER_KEPT],
+                    [event for event in renderedEvents if flags[event[2]] & FILTER_REJECTED]]
       
       # Write the filtered track to a separate file
-      perSectionFilteredMIDIFileData = allocateMIDIFile(1)
-      dumpSection(perSectionFilteredMIDIFileData, section.record.midiEvents, 0, 0, 0, None, midiFilter)
+      perSectionFilteredMIDIFileData = self.allocateMIDIFile(1)
+      perSectionFilteredMIDIFileData.addEvents(0, partitions[1], sectionWriter.eventCounter)
       perSectionFilteredMIDIFileData.addTrackName(0, 0, "{}".format(sectionLabel))
-      writeMIDI(folder, "{}-S{}-{}-T{}.mid".format(track, recordNumber, sectionLabel, section.index), perSectionFilteredMIDIFileData)
-    elif(i == 2):
-      midiFilter = MIDIFilter(velocityMin, velocityMax, durationAsTicks, True)
-      trackName = "Delta_{}".format(sectionLabel)
+      writeMIDI(outputDir, folder, filteredFile, perSectionFilteredMIDIFileData, self.metrics)
         
-    dumpSection(perSectionMIDIFileData, section.record.midiEvents, 0, i, 0, None, midiFilter)
-    perSectionMIDIFileData.addTrackName(i, 0, trackName)
+      # Three tracks - original, filtered, delta
+      perSectionMIDIFileData = self.allocateMIDIFile(3)
+      for i in range(0, 3):
+        perSectionMIDIFileData.addEvents(i, partitions[i], sectionWriter.eventCounter)
+        perSectionMIDIFileData.addTrackName(i, 0, trackNames[i])
+    else:
+      partitions = [midiEvents,
+                    midiEvents.compress(flag & FILTER_KEPT for flag in flags),
+                    midiEvents.compress(flag & FILTER_REJECTED for flag in flags)]
   
-  writeMIDI(folder, "{}-deltas-S{}-{}-T{}.mid".format(track, recordNumber, sectionLabel, section.index), perSectionMIDIFileData)
+      perSectionFilteredMIDIFileData = self.allocateMIDIFile(1)
+      self.dumpSection(perSectionFilteredMIDIFileData, partitions[1], 0, 0, 0, None, None)
+      perSectionFilteredMIDIFileData.addTrackName(0, 0, "{}".format(sectionLabel))
+      writeMIDI(outputDir, folder, filteredFile, perSectionFilteredMIDIFileData, self.metrics)
   
-def dumpSection(midiFileData, midiEvents, timeStamp, trackToWriteTo, offset, noteToTrackLookup, midiFilter):
-  for midiEvent in midiEvents:
-    if(noteToTrackLookup and midiEvent.type == MIDI_EVENT_NOTE):
-      trackToWriteTo = noteToTrackLookup.getTrackNumberForNote(midiEvent.event.note)
-      debugPrint("noteToTrackLookup overrides track number to {}".format(trackToWriteTo))
-      midiFileData.addTrackName(trackToWriteTo, 0, str(midiEvent.event.note) + "_" + getNoteName(midiEvent.event.note))
+      perSectionMIDIFileData = self.allocateMIDIFile(3)
+      for i in range(0, 3):
+        self.dumpSection(perSectionMIDIFileData, partitions[i], 0, i, 0, None, None)
+        perSectionMIDIFileData.addTrackName(i, 0, trackNames[i])
             
-    renderMIDIEvent(timeStamp, midiEvent, midiFileData, trackToWriteTo, midiFilter)
-
-# Writes one file per track
-def dumpTracks():
-  debugPrint("Dumping tracks") 
-  for track in rootFolder.getTrackSet():
-    multiTakeChoices = getMultiTakeMappings(track)    
-    perTrackMIDIFileData = allocateMIDIFile(1)
-    perTrackMIDIFileData.addTrackName(0, 0, getFormattedTrackName(track))      
-    dumpTrack(track, 0, multiTakeChoices, perTrackMIDIFileData)  
-    writeMIDI(getTracksPath(track), "{}-{}.mid".format(track, getCleanTrackName(track)), perTrackMIDIFileData)   
-
-def dumpTrack(track, trackToWriteTo, multiTakeChoices, midiFileData):
-  cutUpText = None
-  mostRecentSectionEnd = 0
-  for section in getSectionsForTrack(track):
-    sectionEnd = section.record.timeStamp + section.record.sectionLength
+    writeMIDI(outputDir, folder, deltasFile, perSectionMIDIFileData, self.metrics)
+
+  # Returns the MIDIFilter built from the note filter parameters
+  def getMIDIFilter(self):
+    if(self.midiFilter is None):
+      rules = []
+      for rule in noteFilterRules:
+        rules.append(NoteRule(rule.get("velocityMin", velocityMin), rule.get("velocityMax", velocityMax),
+                              millisecondsToTicks(self.songTempo, rule.get("durationMin", durationMin)),
+                              rule.get("notes"), rule.get("channels")))
+      rules.append(NoteRule(velocityMin, velocityMax, self.durationAsTicks))
+      self.midiFilter = MIDIFilter(rules)
+    return self.midiFilter
+
+  def dumpSection(self, midiFileData, midiEvents, timeStamp, trackToWriteTo, offset, noteToTrackLookup, midiFilter):
+    bTrace = isTracing("render")
+    for midiEvent in midiEvents:
+      if(noteToTrackLookup and midiEvent[0] == MIDI_EVENT_NOTE):
+        note = midiEvent[4]
+        trackToWriteTo = noteToTrackLookup.getTrackNumberForNote(note)
+        if(bTrace): trace("render", "noteToTrackLookup overrides track number to {}", trackToWriteTo)
+        midiFileData.addTrackName(trackToWriteTo, 0, str(note) + "_" + getNoteName(note))
     
-    debugPrint(" Section {} ({}) timestamp {}, ends {} trackName is {}".format(section.record.recordNumber, section.record.label, section.record.timeStamp, sectionEnd, section.trackName))
+      self.renderMIDIEvent(timeStamp, midiEvent, midiFileData, trackToWriteTo, midiFilter)
     
-    # For some reason a track can have invisible sections that overlap.  MIDIUtil can
-    # fail if this is the case as it gets confused with note on/off sequences so ignore
-    # any sections which do not follow the last section
-    if(mostRecentSectionEnd > 0 and mostRecentSectionEnd > section.record.timeStamp):
-      debugPrint("Section overlaps last one so skipping.")
-      continue
+  # Writes one file per track
+  def dumpTracks(self, outputDir):
+    trace("render", "Dumping tracks")
+    for track in self.getTrackSet():
+      self.dumpTracksForTrack(outputDir, track)
           
-    if(not section.folderContents):
-      dumpSection(midiFileData, section.record.midiEvents, section.record.timeStamp, trackToWriteTo, 0, None, None)
-    else:
-      multiTakeIdx = multiTakeChoices.get(section.record.recordNumber)
-      debugPrint("Found multi take at {} {}".format(section.record.recordNumber, multiTakeIdx))
-      formattedCombo = "{}_{}".format(section.record.recordNumber, multiTakeIdx)
-      if(not cutUpText):
-        cutUpText = formattedCombo
+  def dumpTracksForTrack(self, outputDir, track):
+    filename = "{}-{}.mid".format(track, self.getCleanTrackName(track))
+    if(self.isOutputCurrent(outputDir, self.getTracksPath(track), filename, self.getTrackDigest(track))):
+      return
+    multiTakeChoices = self.getMultiTakeMappings(track)
+    perTrackMIDIFileData = self.allocateMIDIFile(1)
+    perTrackMIDIFileData.addTrackName(0, 0, self.getFormattedTrackName(track))
+    self.dumpTrack(track, 0, multiTakeChoices, perTrackMIDIFileData)
+    writeMIDI(outputDir, self.getTracksPath(track), filename, perTrackMIDIFileData, self.metrics)
+
+  def dumpTrack(self, track, trackToWriteTo, multiTakeChoices, midiFileData):
+    cutUpText = None
+    mostRecentSectionEnd = 0
+    for section in self.getSectionsForTrack(track):
+      sectionEnd = section.record.timeStamp + section.record.sectionLength
+
+      trace("render", " Section {} ({}) timestamp {}, ends {} trackName is {}", section.record.recordNumber, section.record.label, section.record.timeStamp, sectionEnd, section.trackName)
+
+      # For some reason a track can have invisible sections that overlap.  MIDIUtil can
+      # fail if this is the case as it gets confused with note on/off sequences so ignore
+      # any sections which do not follow the last section
+      if(mostRecentSectionEnd > 0 and mostRecentSectionEnd > section.record.timeStamp):
+        trace("render", "Section overlaps last one so skipping.")
+        continue
+
+      if(not section.folderContents):
+        self.dumpSection(midiFileData, section.record.midiEvents, section.record.timeStamp, trackToWriteTo, 0, None, None)
       else:
-        cutUpText = "{}-{}".format(cutUpText, formattedCombo)
+        multiTakeIdx = multiTakeChoices.get(section.record.recordNumber)
+        trace("render", "Found multi take at {} {}", section.record.recordNumber, multiTakeIdx)
+        formattedCombo = "{}_{}".format(section.record.recordNumber, multiTakeIdx)
+        if(not cutUpText):
+          cutUpText = formattedCombo
+        else:
+          cutUpText = "{}-{}".format(cutUpText, formattedCombo)
       
-      sectionToUse = section.folderContents[multiTakeIdx]
-      dumpSection(midiFileData, sectionToUse.record.midiEvents, section.record.timeStamp, trackToWriteTo, 0, None, None)
-    debugPrint("Most recent section ended {} + {} = {}".format(str(section.record.timeStamp), str(section.record.sectionLength), str(sectionEnd)))    
-    mostRecentSectionEnd = sectionEnd
+        sectionToUse = section.folderContents[multiTakeIdx]
+        self.dumpSection(midiFileData, sectionToUse.record.midiEvents, section.record.timeStamp, trackToWriteTo, 0, None, None)
+      trace("render", "Most recent section ended {} + {} = {}", section.record.timeStamp, section.record.sectionLength, sectionEnd)
+      mostRecentSectionEnd = sectionEnd
   
-  return cutUpText
+    return cutUpText
 
-def dumpTrackStems():
-  debugPrint("Dumping track stems")
-  for track in rootFolder.getTrackSet():
-    debugPrint("Dumping track {}:".format(track))        
+  def dumpTrackStems(self, outputDir):
+    trace("render", "Dumping track stems")
+    for track in self.getTrackSet():
+      self.dumpTrackStemsForTrack(outputDir, track)
+
+  def dumpTrackStemsForTrack(self, outputDir, track):
+    trace("render", "Dumping track {}:", track)
+    filename = "{}-{}-{}.mid".format(track, "TStem", self.getCleanTrackName(track))
+    if(self.isOutputCurrent(outputDir, self.getTracksPath(track) + ["stems"], filename, self.getTrackDigest(track))):
+      return
     noteToTrackLookup = NoteToTrackLookup()    
-    sectionList = getSectionsForTrack(track)
+    sectionList = self.getSectionsForTrack(track)
         
     for section in sectionList:        
       if(not section.folderContents):
@@ -529,9 +1993,9 @@ def dumpTrackStems():
         noteToTrackLookup.addNotes(sectionToUse.record.midiEvents)
            
     trackCount = noteToTrackLookup.getTrackCount()
-    debugPrint("Derived track count is {}".format(trackCount))
+    trace("render", "Derived track count is {}", trackCount)
     
-    perTrackMIDIFileData = allocateMIDIFile(trackCount)
+    perTrackMIDIFileData = self.allocateMIDIFile(trackCount)
     mostRecentSectionEnd = 0
     for section in sectionList:
       sectionTimestamp = section.record.timeStamp
@@ -539,176 +2003,1722 @@ def dumpTrackStems():
       sectionEnd = sectionTimestamp + section.record.sectionLength
       
       if(mostRecentSectionEnd > 0 and mostRecentSectionEnd > sectionTimestamp):
-        debugPrint("WARN: Section overlaps last one so skipping.")
+        trace("render", "Section overlaps last one so skipping.", level=TRACE_WARN)
         continue
         
-      debugPrint(" Section {} ({}) timestamp {}".format(sectionRecordNo, section.record.label, sectionTimestamp))
+      trace("render", " Section {} ({}) timestamp {}", sectionRecordNo, section.record.label, sectionTimestamp)
       
       if(not section.folderContents):
-        dumpSection(perTrackMIDIFileData, section.record.midiEvents, sectionTimestamp, 0, 0, noteToTrackLookup, None)
+        self.dumpSection(perTrackMIDIFileData, section.record.midiEvents, sectionTimestamp, 0, 0, noteToTrackLookup, None)
       else:
         # Use the most recent take  
         sectionToUse = section.folderContents[0]
-        dumpSection(perTrackMIDIFileData, sectionToUse.record.midiEvents, sectionTimestamp, 0, 0, noteToTrackLookup, None)
+        self.dumpSection(perTrackMIDIFileData, sectionToUse.record.midiEvents, sectionTimestamp, 0, 0, noteToTrackLookup, None)
      
-      debugPrint("Most recent section ended {} + {} = {}".format(str(sectionTimestamp), str(section.record.sectionLength), str(sectionEnd))) 
+      trace("render", "Most recent section ended {} + {} = {}", sectionTimestamp, section.record.sectionLength, sectionEnd)
       mostRecentSectionEnd = sectionEnd
     
-    writeMIDI(getTracksPath(track) + ["stems"], "{}-{}-{}.mid".format(track, "TStem", getCleanTrackName(track)), perTrackMIDIFileData)    
+    writeMIDI(outputDir, self.getTracksPath(track) + ["stems"], filename, perTrackMIDIFileData, self.metrics)
    
-bCutItUp = False
+  def getCleanTrackName(self, track):
+    return cleanStringForFile(self.getTrackName(track))
 
-def initMultiTakeChoices(multiTakes):
-  multiTakeChoices = dict()
-  for multiTake in multiTakes:
-    multiTakeChoices[multiTake.record.recordNumber] = 0
-  return multiTakeChoices
+  def getFormattedTrackName(self, track):
+    return "{}".format(self.getCleanTrackName(track))
 
-def getCleanTrackName(track):
-  return cleanStringForFile(getTrackName(track))
+  def getTracksPath(self, track):
+    return ["tracks", "{}_{}".format(str(track), self.getCleanTrackName(track))]
 
-def getFormattedTrackName(track):
-  return "{}".format(getCleanTrackName(track))
+  def getSectionsPath(self, track):
+    return ["sections", "{}_{}".format(str(track), self.getCleanTrackName(track))]
 
-def getTracksPath(track):
-  return ["tracks", "{}_{}".format(str(track), getCleanTrackName(track))]
-  
-def getSectionsPath(track):
-  return ["sections", "{}_{}".format(str(track), getCleanTrackName(track))]
+  def getCutUpsPath(self, track):
+    return ["cutups", "{}_{}".format(str(track), self.getCleanTrackName(track))]
 
-def getCutUpsPath(track):
-  return ["cutups", "{}_{}".format(str(track), getCleanTrackName(track))]
-  
-def writeMIDI(path, filename, midiFileData):
-  # 'with open' means Python will automatically close the file
-  createPath(os.path.join(WORKING_DIR, *path))
-  with open(os.path.join(WORKING_DIR, *path, filename), "wb") as output_file:
-    print("Writing MIDI to {}".format(filename))
-    midiFileData.writeFile(output_file)
-
-# Writes one file per combination of takes in the track
-def dumpCutUps():
-  debugPrint("Dumping cut-ups of each track")
-  for track in rootFolder.getTrackSet():
-    multiTakes = getMulitTakeSectionsForTrack(track)
-    takeSizes = []
-    cutUpText = None
-    permutations = 1
-    
-    debugPrint("{} multi-takes in use for track {}".format(len(multiTakes), str(track)))
-    
+  # Writes one file per combination of takes in each track
+  def dumpCutUps(self, outputDir):
+    trace("render", "Dumping cut-ups of each track")
+    for track in self.getTrackSet():
+      self.dumpCutUpsForTrack(outputDir, track)
+
+  # Writes one file per combination of takes in one track.  If cutUpRange is
+  # given then only the cut-ups from first up to but not including stop, in the
+  # order that iterCutUps() yields them, are written.
+  def dumpCutUpsForTrack(self, outputDir, track, cutUpRange=None):
+    cutUpEngine = self.getCutUpEngine(track)
+    if(cutUpEngine is None):
+      return
+
+    cutUps = cutUpEngine.iterCutUps()
+    if(cutUpRange is not None):
+      cutUps = itertools.islice(cutUps, *cutUpRange)
+    for permutation in cutUps:
+      filename = "{}-CutUp-{}.mid".format(str(track), cutUpEngine.getCutUpText(permutation))
+      if(self.isOutputCurrent(outputDir, self.getCutUpsPath(track), filename, cutUpEngine.getCutUpDigest(permutation))):
+        continue
+      cutUpText, perTrackMIDIFileData = cutUpEngine.createCutUp(permutation)
+      writeMIDI(outputDir, self.getCutUpsPath(track), filename, perTrackMIDIFileData, self.metrics)
+
+  # Returns the CutUpEngine for a track, or None if it has fewer than two
+  # multi-take sections
+  def getCutUpEngine(self, track):
+    multiTakes = self.getMulitTakeSectionsForTrack(track)
+    trace("render", "{} multi-takes in use for track {}", len(multiTakes), track)
     if(len(multiTakes) <= 1):
-      continue
-    
-    # Create a list describing how big each set of takes is
+      return None
+
+    permutations = 1
     for take in multiTakes:
       permutations *= len(take.folderContents)
-      takeSizes.append(len(take.folderContents))
-    
-    debugPrint("{} permutations of takes".format(permutations))
-    values = itertools.product(*[range(0, i) for i in takeSizes])
+    trace("render", "{} permutations of takes", permutations)
+    return CutUpEngine(self, track, multiTakes)
 
-    multiTakeChoices = dict()
-    permCount = 0
-    for value in values:
-      if(maxPerms != -1 and permCount >= maxPerms):
-        debugPrint("maxPerms hit for this track, breaking from perm loop")
-        break
-      
-      takeCount = 0
-      perTrackMIDIFileData = allocateMIDIFile(1)
-      
-      for element in value:
-        multiTakeChoices[multiTakes[takeCount].record.recordNumber] = element
-        takeCount += 1
-      cutUpText = dumpTrack(track, 0, multiTakeChoices, perTrackMIDIFileData)
-      perTrackMIDIFileData.addTrackName(0, 0, "{}".format(cutUpText))
-      writeMIDI(getCutUpsPath(track),"{}-CutUp-{}.mid".format(str(track), cutUpText), perTrackMIDIFileData)
-      permCount += 1
-      
-def dumpSong():
-  debugPrint("Dumping whole song")
-  trackSet = rootFolder.getTrackSet()
-  perSongMIDIFileData = allocateMIDIFile(len(trackSet))
-  trackCounter = 0
-  for track in trackSet:
-    multiTakeChoices = getMultiTakeMappings(track)   
-    perSongMIDIFileData.addTrackName(trackCounter, 0, getFormattedTrackName(track))
-    dumpTrack(track, trackCounter, multiTakeChoices, perSongMIDIFileData)
-    trackCounter += 1
-  writeMIDI(["full"], "{}.mid".format(projectName), perSongMIDIFileData)
-
-def allocateMIDIFile(numTracks):
-  debugPrint("Allocating MIDI file with {} tracks".format(numTracks))
-  midiFileData = MIDIFile(numTracks=numTracks, ticks_per_quarternote=960, eventtime_is_ticks=True, file_format=1)
-  midiFileData.addTimeSignature(0, 0, numerator, denominator, clocks_per_tick = 24, notes_per_quarter=8)
-  midiFileData.addTempo(0, 0, songTempo)
-  midiFileData.addTrackName(0, 0, "Track_0")
-  return midiFileData
-
-def renderMIDIEvent(startOffset, midiEvent, midiFileData, trackNumber, midiFilter):
-  if(startOffset > 0):  
-    timeStamp = midiEvent.timeStamp - baseTime + (startOffset - 0x8700)
-  else:
-    timeStamp = midiEvent.timeStamp - baseTime
+  # Writes one file with a track for each of tracks, or for every track
+  def dumpSong(self, outputDir, tracks=None):
+    trace("render", "Dumping whole song")
+    trackSet = self.getTrackSet() if tracks is None else tracks
+    if(self.isOutputCurrent(outputDir, ["full"], "{}.mid".format(self.projectName), *[self.getTrackDigest(track) for track in trackSet])):
+      return
+    perSongMIDIFileData = self.allocateMIDIFile(len(trackSet))
+    trackCounter = 0
+    for track in trackSet:
+      multiTakeChoices = self.getMultiTakeMappings(track)
+      perSongMIDIFileData.addTrackName(trackCounter, 0, self.getFormattedTrackName(track))
+      self.dumpTrack(track, trackCounter, multiTakeChoices, perSongMIDIFileData)
+      trackCounter += 1
+    writeMIDI(outputDir, ["full"], "{}.mid".format(self.projectName), perSongMIDIFileData, self.metrics)
+
+  def allocateMIDIFile(self, numTracks):
+    trace("render", "Allocating MIDI file with {} tracks", numTracks)
+    if(midiWriter == "midiutil"):
+      if(MIDIFile is None):
+        raise GBExtractorError("ERROR: The midiutil MIDI writer needs the MIDIUtil package")
+      midiFileData = MIDIFile(numTracks=numTracks, ticks_per_quarternote=960, eventtime_is_ticks=True, file_format=1)
+    else:
+      midiFileData = SMFWriter(numTracks=numTracks, ticks_per_quarternote=960, file_format=1)
+    midiFileData.addTimeSignature(0, 0, self.numerator, self.denominator, clocks_per_tick = 24, notes_per_quarter=8)
+    midiFileData.addTempo(0, 0, self.songTempo)
+    midiFileData.addTrackName(0, 0, "Track_0")
+    return midiFileData
+
+  # Add one (type, timeStamp, channel, data1, data2, value) event from an
+  # EventStore to a MIDI file
+  def renderMIDIEvent(self, startOffset, midiEvent, midiFileData, trackNumber, midiFilter):
+    eventType, eventTime, channel, data1, data2, value = midiEvent
+    if(startOffset > 0):
+      timeStamp = eventTime - self.baseTime + (startOffset - 0x8700)
+    else:
+      timeStamp = eventTime - self.baseTime
+
+    if(eventType == MIDI_EVENT_NOTE):
+      velocity, note, duration = data1, data2, value
+
+      if(midiFilter is None or midiFilter.keepsNote(channel, note, velocity, duration)):
+        midiFileData.addNote(trackNumber, channel, note, timeStamp, duration, velocity)
+    elif(eventType == MIDI_EVENT_CC):
+      midiFileData.addControllerEvent(trackNumber, channel, timeStamp, data2, data1)
+    elif(eventType == MIDI_EVENT_PITCH_WHEEL):
+      midiFileData.addPitchWheelEvent(trackNumber, channel, timeStamp, value)
+    elif(eventType == MIDI_EVENT_CHANNEL_PRESSURE):
+      # This method does not appear to be documented but is in the MIDIUtil unit tests and the
+      # changelog says it was added in 1.2.1
+      midiFileData.addChannelPressure(trackNumber, channel, timeStamp, data1)
 
-  if(midiEvent.type == MIDI_EVENT_NOTE):
-    midiEventNote = midiEvent.event
-    
-    bAddIt = True
-    if(midiFilter):
-      if(midiEventNote.duration < midiFilter.durMin):
-        debugPrint("Note {} at {} duration {} < {}".format(midiEventNote.note, timeStamp, midiEventNote.duration, midiFilter.durMin))
-        bAddIt = False
-      if(midiEventNote.velocity < velocityMin or midiEventNote.velocity > velocityMax):
-        debugPrint("Note {} at {} velocity {} not in range {} -> {}".format(midiEventNote.note, timeStamp, midiEventNote.velocity, midiFilter.velMin, midiFilter.velMax))
-        bAddIt = False
-        
-      if(midiFilter.bInvert):
-        bAddIt = not bAddIt
-      
-    if(bAddIt):
-      midiFileData.addNote(trackNumber, midiEvent.channel, midiEventNote.note, timeStamp, midiEventNote.duration, midiEventNote.velocity)
-  elif(midiEvent.type == MIDI_EVENT_CC):
-    midiEventCC = midiEvent.event        
-    midiFileData.addControllerEvent(trackNumber, midiEvent.channel, timeStamp, midiEventCC.ctrlValue, midiEventCC.ctrlNumber)
-  elif(midiEvent.type == MIDI_EVENT_PITCH_WHEEL):
-    midiEventPitchWheel = midiEvent.event
-    midiFileData.addPitchWheelEvent(trackNumber, midiEvent.channel, timeStamp, midiEventPitchWheel.pitchWheelValue)
-  elif(midiEvent.type == MIDI_EVENT_CHANNEL_PRESSURE):
-    midiEventPressure = midiEvent.event
-    # This method does not appear to be documented but is in the MIDIUtil unit tests and the
-    # changelog says it was added in 1.2.1
-    midiFileData.addChannelPressure(trackNumber, midiEvent.channel, timeStamp, midiEventPressure.pressure)
-
-def associateFolder(folder, midiSection):
   # If we have not resolved the track name for this folder then do
   # this now
-  if(folder.trackName == None):
-    ref = trackLookup.get(folder.folderRecordNumber)
-    trackName = trackNameLookup.get(ref)
-    folder.trackName = trackName
-  
-  if(folder.record.recordNumber == midiSection.recordNumber):
-    debugPrint("Matched folder record {} with section record {} folderRecordNumber {}".format(folder.record.recordNumber, midiSection.recordNumber, folder.folderRecordNumber))    
-    folder.record.midiEvents = midiSection.midiEvents
-    folder.record.sectionLength = midiSection.sectionLength    
-    debugPrint("found {} events and label {}".format(len(midiSection.midiEvents), midiSection.label))
-    folder.record.label = midiSection.label
-    return 1
-  return 0
-
-def associateMIDIEvents(recordHash):
-  for key, midiSection in recordHash.items():
-    if(not midiSection.midiEvents): continue
-    matchCount = 0
-    for topLevelFolder in rootFolder.folderContents:
-      matchCount += associateFolder(topLevelFolder, midiSection)
-      for subFolder in topLevelFolder.folderContents:
-        matchCount += associateFolder(subFolder, midiSection)
-        
-    if(matchCount != 1):
-      debugPrint("WARN: Found unexpected number of matching records ({}) for {}".format(matchCount, midiSection.recordNumber))
+  def resolveTrackName(self, folder):
+    if(folder.trackName == None):
+      ref = self.trackLookup.get(folder.folderRecordNumber)
+      trackName = self.trackNameLookup.get(ref)
+      folder.trackName = trackName
+
+  def associateFolder(self, folder, midiSection):
+    if(folder.record.recordNumber == midiSection.recordNumber):
+      trace("folder", "Matched folder record {} with section record {} folderRecordNumber {}", folder.record.recordNumber, midiSection.recordNumber, folder.folderRecordNumber)
+      folder.record.midiEvents = midiSection.midiEvents
+      folder.record.sectionLength = midiSection.sectionLength
+      trace("folder", "found {} events and label {}", len(midiSection.midiEvents), midiSection.label)
+      folder.record.label = midiSection.label
+      return 1
+    return 0
+
+  # Give each folder in the root folder, and each take in those folders, the
+  # events of the section with the same record number.  The folders are
+  # indexed by record number first so that each section is only matched
+  # against its own folders.
+  def associateMIDIEvents(self):
+    folders = []
+    for topLevelFolder in self.rootFolder.folderContents:
+      folders.append(topLevelFolder)
+      folders.extend(topLevelFolder.folderContents)
+    folderIndex = dict()
+    for folder in folders:
+      folderIndex.setdefault(folder.record.recordNumber, []).append(folder)
+
+    bTrackNamesResolved = False
+    for key, midiSection in self.recordHash.items():
+      if(not midiSection.midiEvents): continue
+      if(not bTrackNamesResolved):
+        for folder in folders:
+          self.resolveTrackName(folder)
+        bTrackNamesResolved = True
+      matchCount = 0
+      for folder in folderIndex.get(midiSection.recordNumber, []):
+        matchCount += self.associateFolder(folder, midiSection)
+
+      if(matchCount != 1):
+        trace("record", "Found unexpected number of matching records ({}) for {}", matchCount, midiSection.recordNumber, level=TRACE_WARN)
+
+  # Read the records at each offset in offsetList.  Returns the MIDI blocks
+  # that were found, which are decoded by processMIDIBlocks()
+  def processOffsetList(self, s, offsetList):
+    bTrace = isTracing("record")
+    bDump = isTracing("record", TRACE_DUMP)
+    midiSection = None
+    midiBlocks = []
+    for thisOffset, signature in offsetList:
+      s.pos = thisOffset
+
+      if(bTrace): trace("record", "Byte offset {}", thisOffset)
+      if(bDump): traceHex("record", 64, s)
+
+      identity, recordType, recordSubType, recordNumber, recordMidiID, dataLength = s.unpack(RECORD_HEADER)
+
+      # We are now at the start of the data so save this position for later...
+      dataStart = s.pos
+
+      if(bTrace): trace("record", "Data length is: {} Type is: {}/{} Record no: {} MIDI ID: {} ", dataLength, identity, recordType, recordNumber, recordMidiID)
+      if(bDump and (recordType == 1 or recordType == 2 or recordType == 4 or recordType == 5)): traceHex("record", dataLength, s)
+
+      # Test for a MIDI block header
+      blockType, = s.unpack(BLOCK_TYPE)
+
+      if(bTrace): trace("record", "BlockType is {}", blockType.hex())
+
+      if(identity == b'qSxT'):
+        s.pos = dataStart
+        sectionLength = s.readU32()
+        if(bTrace): trace("record", "Section length {}", sectionLength)
+        if(sectionLength < 98):
+          raise GBExtractorError("ERROR: section length invalid {}".format(sectionLength))
+        s.skip(94)
+        # The name is terminated by a zero byte.  If there is no terminator
+        # then the last byte of the record is not part of the name
+        i = s.findByte(0, sectionLength - 98)
+        if(i == -1):
+          i = max(sectionLength - 99, 0)
+        if(bTrace): trace("record", "Found track section name length {}", i)
+        if(i > 0):
+          trackName = s.readBytes(i).decode("utf-8")
+          if(bTrace): trace("record", "trackName is {}", trackName)
+          self.trackNameLookup[recordNumber] = trackName
+        else:
+          if(bTrace): trace("record", "No track name")
+        continue
+
+      # Is this a section header?
+      if(recordType == 2):
+        associatedMidiID, sectionNameLength = s.unpack(SECTION_HEADER)
+        if(sectionNameLength == 0):
+          continue
+
+        # Create a key from the record + associated midi ID
+        hashKey = createKey(str(recordNumber), str(associatedMidiID))
+        origSectionName = s.readBytes(sectionNameLength).decode("utf-8")
+
+        # Strip out filename unfriendly characters
+        sectionName = "".join(thisChar for thisChar in origSectionName if (thisChar.isalnum() or thisChar in "._- "))
+
+        if(bTrace): trace("record", "Section name is {} (orig {}), hash key is {}", sectionName, origSectionName, hashKey)
+        # Nothing to guide us here
+        sectionLength = None
+        sectionStart = 0
+        i = s.findByte(0x20, 100)
+        if(i != -1):
+          s.skip(i + 1)
+          if(bDump): traceHex("record", 45, s)
+          s.skip(39)
+          sectionLength = s.readU24()
+          s.skip(161)
+          sectionStart = s.readU24()
+
+        if(sectionLength == None):
+          raise GBExtractorError("ERROR: Did not find section length")
+
+        if(bTrace): trace("record", "Section length is {0} {0:#x} start is {1} ({1:#x})", sectionLength, sectionStart)
+
+        existingRecord = self.recordHash.get(hashKey)
+        # Validation - The key should be unique
+        if(existingRecord != None):
+          raise GBExtractorError("ERROR: Found second record for key {}".format(hashKey))
+
+        midiSection = MIDISection(sectionName, associatedMidiID, recordNumber, sectionLength, sectionStart)
+        self.recordHash[hashKey] = midiSection
+      elif(recordType == 1): # MIDI data block
+        hashKey = createKey(str(recordNumber), str(recordMidiID))
+        if(bTrace): trace("record", "Hash key is {}", hashKey)
+        # Have we seen a section header with this MIDI ID?
+        midiSection = self.recordHash.get(hashKey)
+        if(midiSection != None):
+          if(bTrace): trace("record", "Found MIDI data for section {} blockType {}", midiSection.label, blockType.hex())
+          midiEvents = None
+
+          if(blockType == b'\x20\x00' or blockType == b'\x24\x00'):
+            if(bTrace): trace("record", "Found Folder")
+            if(midiSection.label != "Automation"):
+              self.processFolder(s, midiSection, dataStart, dataLength)
+            else:
+              if(bTrace): trace("record", "TODO: Automation folders.  Ignoring for now.")
+          else:
+            midiBlocks.append((midiSection, recordNumber, recordMidiID, dataStart, dataLength))
+
+          midiSection.midiEvents = midiEvents
+      elif(midiSection != None and midiSection.label == "Root Folder" and recordType == 4 and identity == b'karT'):
+        s.pos = dataStart
+        trackNameBlock, trackId = s.unpack(TRACK_REFERENCE)
+        if(not trackId in self.trackLookup.keys() and trackNameBlock != 0):
+          self.trackLookup[trackId] = trackNameBlock
+          if(bTrace): trace("record", "set key {} to {}", trackId, trackNameBlock)
+        if(bTrace): trace("record", "trackNameBlock: {0} ({0:#x}) trackId: {1} ({1:#x})", trackNameBlock, trackId)
+    return midiBlocks
+
+  # Decode the MIDI blocks found by processOffsetList(), skipping the blocks of
+  # records that are not in selectedRecords if it is given
+  def processMIDIBlocks(self, s, midiBlocks, selectedRecords=None):
+    self.metrics.count("midiBlocks", len(midiBlocks))
+    for midiSection, recordNumber, recordMidiID, dataStart, dataLength in midiBlocks:
+      if(selectedRecords is None or midiSection.recordNumber in selectedRecords):
+        midiSection.midiEvents = self.processMIDI(s, midiSection, self.baseTime, recordNumber, recordMidiID, dataStart, dataLength)
+        self.metrics.count("midiBlocksDecoded")
+        self.metrics.count("midiBytesDecoded", dataLength)
+
+  def processFolder(self, s, midiSection, dataStart, dataLength):
+    bTrace = isTracing("folder")
+    s.pos = dataStart
+    folder = None
+    if(midiSection.label == "Root Folder"):
+      folder = self.rootFolder
+      folder.record = Record(midiSection.recordNumber, 0)
+    else:
+      # Find this section, it must be in the root folder
+      folder = self.topLevelFolderIndex.get(midiSection.recordNumber)
+
+    # This must be a reference to an existing section
+    if(folder == None):
+      if(bTrace): trace("folder", "Found folder by reference")
+      folder = self.rootFolder
+
+    while True:
+      # Read in the next command byte
+      midiCmd = s.readU8()
+      if(bTrace): trace("folder", "Command is {0} ({0:#x})", midiCmd)
+
+      if (midiCmd == 0xF1):
+        if(bTrace): trace("folder", "Found end of buffer")
+        break
+
+      if(midiCmd == 0x20):
+        # 0x00000050 | 20 00 00 00 40 44 03 00 00 00 00 00 00 05 00 80 | ....@D.......... |
+        # 0x00000060 | 64 00 00 00 01 00 00 89 00 00 00 00 FF FF FF 3F | d..............? |
+        # 0x00000070 | 1C 00 00 00 00 00 00 88 00 00 00 00 00 00 00 00 | ................ |
+
+        # The index might be 24 bits but that would be a lot of takes!
+        timeStamp, folderRecordNumber, index, recordNumber = s.unpack(FOLDER_ENTRY)
+        if(bTrace): trace("folder", "Index is {}", index)
+        if(bTrace): trace("folder", "Record number is {}", recordNumber)
+
+        newFolder = Folder(index)
+        newRecord = Record(recordNumber, timeStamp)
+        newFolder.record = newRecord
+        newFolder.folderRecordNumber = folderRecordNumber
+        folder.folderContents.append(newFolder)
+        if(folder is self.rootFolder):
+          self.topLevelFolderIndex[recordNumber] = newFolder
+      elif (midiCmd & 0xF0 == 0x50): # Possibly some onscreen dial setup?
+        if(bTrace): trace("folder", "Found 0x5x, skipping")
+        s.skip(15)
+      elif (midiCmd == 0x00):
+        if(bTrace): trace("folder", "Null block")
+        s.skip(63)
+      elif (midiCmd == 0x24): # Audio section, skip for now
+        if(bTrace): trace("folder", "Found 0x24 audio section, skipping")
+        s.skip(79)
+      else: # Unknown section, skip for now
+        if(bTrace): trace("folder", "Unknown command {0} ({0:#x})", midiCmd)
+        s.skip(79)
+
+      # Check we have not exceeded the length of the data in this block
+      bufferUsed = s.pos - dataStart
+      totalBufferSize = dataLength
+      if(bTrace): trace("folder", "Buffer used so far: {} out of: {}", bufferUsed, totalBufferSize)
+
+      if(bufferUsed > totalBufferSize):
+        raise GBExtractorError("ERROR: Went past end of buffer.")
+
+      if(bufferUsed == totalBufferSize):
+        if(bTrace): trace("folder", "Used full buffer")
+        break
+
+  def getRecord(self, recordNumber):
+    return self.recordIndex.get(recordNumber)
+
+  # Returns True if outputDir is an IncrementalSink which already holds the
+  # file at path/filename, made from sources with the same digests by the last
+  # extraction, so that it does not need to be written again
+  def isOutputCurrent(self, outputDir, path, filename, *digests):
+    sink = getOutputSink(outputDir)
+    if(not isinstance(sink, IncrementalSink)):
+      return False
+    key = hashlib.blake2b(self.getSettingsDigest(), digest_size=16)
+    for digest in digests:
+      key.update(digest)
+    return sink.isCurrent(path, filename, key.hexdigest())
+
+  # Returns a digest of the tempo, time signature and parameters that change
+  # how every MIDI file is written
+  def getSettingsDigest(self):
+    if(self.settingsDigest is None):
+      settings = [OUTPUT_MANIFEST_VERSION, self.projectName, self.songTempo, self.numerator, self.denominator,
+                  self.baseTime, midiWriter, velocityMin, velocityMax, durationMin, noteFilterRules,
+                  trackLimit, bRenameTracks, sorted(trackMap.items())]
+      self.settingsDigest = hashlib.blake2b(json.dumps(settings).encode("utf-8"), digest_size=16).digest()
+    return self.settingsDigest
+
+  # Returns a digest of the label, length, time stamp and events of a record
+  def getRecordDigest(self, record):
+    digest = self.recordDigests.get(record)
+    if(digest is None):
+      digest = hashlib.blake2b(json.dumps([record.label, record.sectionLength, record.timeStamp]).encode("utf-8"), digest_size=16)
+      digest.update(record.midiEvents.toBytes())
+      digest = digest.digest()
+      self.recordDigests[record] = digest
+    return digest
+
+  # Returns a digest of the name of a track and the records of its sections
+  # and their takes, which is everything that the track views are made from
+  def getTrackDigest(self, track):
+    digest = hashlib.blake2b(json.dumps(self.getTrackName(track)).encode("utf-8"), digest_size=16)
+    for section in self.getSectionsForTrack(track):
+      digest.update(self.getRecordDigest(section.record))
+      digest.update(struct.pack("<I", len(section.folderContents)))
+      for take in section.folderContents:
+        digest.update(self.getRecordDigest(take.record))
+    return digest.digest()
+
+  def processMIDI(self, s, midiSection, baseTime, recordNumber, recordMidiID, dataStart, dataLength):
+    # The vectorised decoder does not trace each event
+    bTrace = isTracing("midi")
+    if(bVectorizedMIDI and np is not None and not bTrace and dataLength >= VECTORIZED_MIDI_MIN_LENGTH):
+      eventList = decodeMIDIBlock(self.decodedData, dataStart, dataLength, baseTime + midiSection.sectionLength)
+      if(eventList is not None):
+        return eventList
+
+    eventList = EventStore()
+    lastNoteEvent = None
+    s.pos = dataStart
+
+    sectionEnd = baseTime + midiSection.sectionLength
+
+    while True:
+      # Read in the next command byte
+      midiCmd = s.readU8()
+      if(bTrace): trace("midi", "Command is {0} ({0:#x})", midiCmd)
+
+      midiChl = midiCmd & 0x0F
+
+      if(midiCmd >= 0x90 and midiCmd <= 0x9F): # Note on/off event
+        # 0x00000000 | 90 00 00 00 00 96 00 00 00 00 00 7D 24 00 00 00 | ...........}$...
+        # 0x00000010 | 80 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | ................
+        noteStart, velocity, note, midiCmd = s.unpack(NOTE_ON_EVENT)
+
+        if(midiCmd >= 0x80 and midiCmd <= 0x8F): # Note Off event then set note duration event
+          # 0x00000580 | 40 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | @...............
+          # 0x00000590 | 00 00 00 00 00 00 00 A7 00 00 00 00 00 00 00 00 | ................
+          # 0x000005A0 | 90 00 00 00 53 BD 00 00 00 00 00 73 24 00 00 00 | ....S......s$...
+
+          # Duration spans at least 3, probably 4 bytes.  We'll go for 4 for now!
+          extendedBytes, duration = s.unpack(NOTE_OFF_EVENT)
+
+          if(baseTime is None):
+            baseTime = noteStart
+
+          bAddNote = True
+
+          sectionEnd = baseTime + midiSection.sectionLength
+          noteEnd = noteStart + duration
+
+          if(bTrace): trace("midi", ":Event time is {} logical section start is {} ({}) section length is {} basetime {} datastart {} dataLength {}", noteStart, midiSection.sectionStart, midiSection.sectionStart + baseTime, midiSection.sectionLength, baseTime, dataStart, dataLength)
+          if(bTrace): trace("midi", ":event is {} in to the section.  It goes from {} to {} and the end of the section is {}", noteStart-baseTime, noteStart, noteEnd, sectionEnd)
+
+          # Try and work around duplicate note bug https://github.com/MarkCWirt/MIDIUtil/issues/24
+          if(lastNoteEvent is not None):
+            if(lastNoteEvent.note == note and
+               lastNoteEvent.timeStamp == noteStart):
+               bAddNote = False
+
+          if(noteStart >= sectionEnd):
+            if(bTrace): trace("midi", "Note starts at or past logical end of the section so ignoring it")
+            bAddNote = False
+          elif(noteEnd > sectionEnd):
+            duration = sectionEnd - noteStart
+            if(bTrace): trace("midi", "Duration corrected to {}", duration)
+
+          if(bAddNote):
+            eventList.append(MIDI_EVENT_NOTE, noteStart, midiChl, velocity, note, duration)
+            lastNoteEvent = LastNoteEvent(note, noteStart)
+
+          if(extendedBytes > 0):
+            if(bTrace): trace("midi", "Found extended bytes {:#x}", extendedBytes)
+
+        else: # Did not find expected 0x8x before note duration data
+          raise GBExtractorError('ERROR: Unknown command {} ({})'.format(midiCmd, hex(midiCmd)))
+      elif ((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF): # internal commands/screen elements?
+        # 00 00 00 00 00 00 01 B5 00 00 00 00 00 00 00 00. button on? 01 on 02 off
+        midiCmd, = s.unpack(INTERNAL_EVENT)
+        if (midiCmd != 0xA8 and midiCmd != 0xA7 and midiCmd != 0xB5):
+          if(bTrace): trace("midi", "Unknown command {0} ({0:#x})", midiCmd, level=TRACE_WARN)
+      elif (midiCmd >= 0x20 and midiCmd <= 0x2F): # cc bank change
+        # 20 3D 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+        s.skip(15)
+      elif (midiCmd == 0x40): # cc sustain ?
+        # 40 2F 01 00 00 00 00 A8 00 00 00 00 A2 83 00 00
+        s.skip(15)
+      elif (midiCmd == 0x50): # cc general purpose controller, synth knobs 0x00-0x0b pads CA-CD
+        # 50 40 00 00 00 96 00 00 10 58 39 0E 00 01 00 01 # knob top left synth 00
+        # 50 40 00 00 00 96 00 00 45 B6 D3 0C 01 01 00 01 # knob bottom left 01
+        # 50 40 00 00 00 96 00 00 00 00 00 7F 02 01 00 01 # knob top right 02
+        # 50 40 00 00 00 96 00 00 00 00 00 00 07 01 00 01 # knob bottom right 07
+
+        thisEvent = readTwoPartEvent(s, bTrace)
+
+        # It feels like program change, e.g. patch change in synth is implemented like this but GB does not respond
+        # so disabling this for now.
+        if(False and thisEvent.valueB & 0xC0 == 0xC0):
+          ctrlChl = thisEvent.valueB & 0x0F
+          if(bTrace): trace("midi", "Adding program change")
+      elif (midiCmd >= 0x60 and midiCmd <= 0x6F): # Do not know what this is. Seen with Grand Piano, possibly where smart piano is being touched?
+        # 60 9B 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+        # Special case the start of a 48 byte block
+        if(dataLength == 48):
+          s.skip(31)
+        else:
+          s.skip(15)
+      elif (midiCmd >= 0x70 and midiCmd <= 0x7F): # can be triggered by manually adding and moving percussion with smart drums while recording
+        # 70 00 00 00 00 96 00 00 00 00 00 01 36 00 00 00
+        # 09 00 02 06 00 00 00 A8 00 00 00 00 21 00 09 00
+        s.skip(31)
+      elif (midiCmd >= 0x80 and midiCmd <= 0x8F): # Do not know what this is. Seen with synth, not a note-off though as it uses the same bytes each time.
+        # 80 AE 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+        s.skip(15)
+      elif (midiCmd >= 0xA0 and midiCmd <= 0xAF): # polyphonic key pressure unsupported in MIDIUtil API :(
+        # A0 11 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+        if(bTrace): trace("midi", "Polyphonic key pressure (unsupported) {0}({0:#x})", midiCmd)
+        s.skip(15)
+      elif (midiCmd >= 0xB0 and midiCmd <= 0xBF): # MIDI CC
+        # B0 40 00 00 5D 9D 00 00 00 00 00 00 40 00 00 01 cc sustain off 00 40 ch 0 40 is cc val
+        # B0 40 00 00 5D 9D 00 00 00 00 00 7F 40 00 00 01 cc sus on 7F 40 ch 0
+        # 0 (to 63) is off. 127 (to 64) is on.
+        # B0 40 00 00 40 9A 00 00 00 00 00 00 01 00 00 01 cc mod wheel zero
+
+        thisEvent = readTwoPartEvent(s, bTrace)
+        if(thisEvent.time > sectionEnd):
+          if(bTrace): trace("midi", "CC event starts ({}) past logical end of the section ({})", thisEvent.time, sectionEnd)
+        else:
+          eventList.append(MIDI_EVENT_CC, thisEvent.time, midiChl, thisEvent.valueA, thisEvent.valueB, 0)
+      elif (midiCmd >= 0xC0 and midiCmd <= 0xCF): # Should be program change but don't think it is
+        # C0 03 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
+        s.skip(15)
+      elif (midiCmd >= 0xD0 and midiCmd <= 0xDF): # channel pressure
+        # D3 40 00 00 81 A1 00 00 00 00 00 00 00 00 00 01 channel pressure 0
+        # D5 40 00 00 C4 BA 00 00 00 00 00 1F 1F 00 00 01 channel pressure 1F
+
+        thisEvent = readTwoPartEvent(s, bTrace)
+
+        if(thisEvent.time > sectionEnd):
+          if(bTrace): trace("midi", "Pressure event starts ({}) past logical end of the section ({})", thisEvent.time, sectionEnd)
+        else:
+          eventList.append(MIDI_EVENT_CHANNEL_PRESSURE, thisEvent.time, midiChl, thisEvent.valueA, 0, 0)
+      elif (midiCmd >= 0xE0 and midiCmd <= 0xEF): # pitch bend
+        # E8 40 00 00 19 A0 00 00 00 00 00 40 17 00 00 01 pitch bend ch 8 val 40 17
+        # E4 40 00 00 41 9A 00 00 00 00 00 40 00 00 00 01 pitch bend 0
+
+        thisEvent = readTwoPartEvent(s, bTrace)
+
+        pb = 0
+        pb = (pb << 7) + (thisEvent.valueA & 0x7F)
+        pb = (pb << 7) + (thisEvent.valueB & 0x7F)
+        pitchWheelValue = -8192 + pb
+
+        if(bOverridePitchBend):
+          pitchWheelValue *= pitchBendMultiplier
+          # Correct any overshoot
+          if(pitchWheelValue < -8192): pitchWheelValue = -8192
+          if(pitchWheelValue > 8191): pitchWheelValue = 8191
+          if(bTrace): trace("midi", "Adjusted pitchWheelValue is: {0}({0:#x})", pitchWheelValue)
+
+        if(thisEvent.time > sectionEnd):
+          if(bTrace): trace("midi", "PitchWheel event starts past logical end of the section")
+        else:
+          eventList.append(MIDI_EVENT_PITCH_WHEEL, thisEvent.time, midiChl, 0, 0, pitchWheelValue)
+      elif (midiCmd == 0xF1):
+        if(bTrace): trace("midi", "Found end of buffer")
+        break
+      elif ((midiCmd >= 0x30 and midiCmd <= 0x3F) or
+             midiCmd == 0x11 or
+             midiCmd == 0x12):
+        # These tend to be at the start of blocks we are not interested in
+        if(bTrace): trace("midi", "Unknown bytes: {:#x}", midiCmd)
+        break
+      else:
+        # Not seen this command byte before so dump some context for debugging
+        # purposes then exit
+        s.pos = max(s.pos - 96, 0)
+        dumphex(100, s)
+        raise GBExtractorError("Unrecognised command: {}".format(midiCmd))
+
+      # Check we have not exceeded the length of the data in this block
+      bufferUsed = s.pos - dataStart
+      totalBufferSize = dataLength
+      if(bTrace): trace("midi", "Buffer used so far: {} out of: {}", bufferUsed, totalBufferSize)
+
+      if(bufferUsed > totalBufferSize):
+        raise GBExtractorError("ERROR: Went past end of buffer.")
+
+      if(bufferUsed == totalBufferSize):
+        if(bTrace): trace("midi", "Used full buffer")
+        break
+    return eventList
+
+# An on-disk cache of parsed project models.  Models are stored one per file,
+# named after a hash of the projectData file, the parser version and the options
+# that change what the parser produces.  Reading a model updates its modification
+# time and the oldest models are deleted when the cache is larger than maxSize
+# bytes, so the cache behaves as a least recently used cache.
+class ModelCache:
+  def __init__(self, cacheDir, maxSize):
+    self.cacheDir = cacheDir
+    self.maxSize = maxSize
+
+  def getKey(self, dataPath):
+    digest = hashlib.sha256("{}:{}:{}:".format(PARSER_VERSION, bOverridePitchBend, pitchBendMultiplier).encode("utf-8"))
+    return hashFile(dataPath, digest).hexdigest()
+
+  def getPath(self, key):
+    return os.path.join(self.cacheDir, "{}.gbmodel".format(key))
+
+  # Returns the cached project for this key or None
+  def load(self, key, projectName):
+    modelPath = self.getPath(key)
+    try:
+      with open(modelPath, "rb") as modelFile:
+        modelData = modelFile.read()
+    except OSError:
+      return None
+
+    try:
+      project = GBProject.readModel(projectName, modelData)
+    except (GBExtractorError, ValueError, KeyError, TypeError, struct.error) as ex:
+      trace("model", "Ignoring unreadable cached model {}: {}", modelPath, ex, level=TRACE_WARN)
+      self.remove(modelPath)
+      return None
+
+    trace("model", "Using cached model {}", modelPath)
+    try:
+      os.utime(modelPath)
+    except OSError:
+      pass
+    return project
+
+  # Add a project to the cache.  The cache is only an optimisation so failing
+  # to write to it is not an error
+  def store(self, key, project):
+    tempPath = None
+    try:
+      createPath(self.cacheDir)
+      fd, tempPath = tempfile.mkstemp(suffix=".tmp", dir=self.cacheDir)
+      with os.fdopen(fd, "wb") as modelFile:
+        project.writeModel(modelFile)
+      os.replace(tempPath, self.getPath(key))
+      tempPath = None
+      self.evict()
+    except (GBExtractorError, OSError) as ex:
+      trace("model", "Could not cache the model: {}", ex, level=TRACE_WARN)
+    finally:
+      if(tempPath is not None):
+        self.remove(tempPath)
+
+  # Delete the least recently used models until the cache fits in maxSize bytes
+  def evict(self):
+    models = []
+    totalSize = 0
+    for entry in os.scandir(self.cacheDir):
+      if(not entry.name.endswith(".gbmodel")):
+        continue
+      try:
+        stat = entry.stat()
+      except OSError:
+        continue # Removed by another process
+      models.append((stat.st_mtime, stat.st_size, entry.path))
+      totalSize += stat.st_size
+
+    models.sort()
+    for mtime, size, modelPath in models:
+      if(totalSize <= self.maxSize):
+        break
+      trace("model", "Evicting cached model {}", modelPath)
+      self.remove(modelPath)
+      totalSize -= size
+
+  def remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+# Returns the model cache configured by modelCacheDir and modelCacheSize
+def createModelCache():
+  cacheDir = modelCacheDir
+  if(cacheDir is None):
+    if(os.name == 'nt' and os.environ.get("LOCALAPPDATA")):
+      cacheRoot = os.environ["LOCALAPPDATA"]
+    else:
+      cacheRoot = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    cacheDir = os.path.join(cacheRoot, "gbextractor")
+  return ModelCache(cacheDir, modelCacheSize)
+
+# Returns the names of views, or of the views chosen by outputViews if views is
+# None, in the order that they are written
+def getViewNames(views=None):
+  if(views is None):
+    views = outputViews
+  if(views is None):
+    views = [viewName for viewName in VIEW_NAMES
+             if (viewName != "cutUps" or bEnableCutUp) and (viewName != "sectionsFiltered" or bFilterNotes)]
+  for viewName in views:
+    if(viewName not in VIEW_NAMES):
+      raise GBExtractorError("ERROR: Unknown view {}".format(viewName))
+  return [viewName for viewName in VIEW_NAMES if viewName in views]
+
+# Returns a TrackFilter for lists of tracks to include and exclude, see
+# includeTracks, or None if every track is selected
+def createTrackFilter(includeTrackList, excludeTrackList):
+  if(not includeTrackList and not excludeTrackList):
+    return None
+  return TrackFilter(includeTrackList, excludeTrackList)
+
+# Times each phase of an extraction and counts what it reads and writes.
+# Phases are timed with a monotonic clock and a phase that runs more than once
+# adds up its time and number of calls.  Counters are numbers, or dicts of
+# numbers for counters that are broken down, such as records by type.
+class Metrics:
+  def __init__(self):
+    self.startTime = time.time()
+    self.startCounter = time.perf_counter()
+    self.phases = dict()
+    self.counters = dict()
+
+  # Time the code in a with block as the phase called name
+  @contextlib.contextmanager
+  def phase(self, name):
+    phaseStart = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.addPhase(name, time.perf_counter() - phaseStart)
+
+  def addPhase(self, name, seconds, calls=1):
+    phase = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+    phase["seconds"] += seconds
+    phase["calls"] += calls
+
+  def count(self, name, amount=1):
+    self.counters[name] = self.counters.get(name, 0) + amount
+
+  # Add to the key entry of the counter called name
+  def countBy(self, name, key, amount=1):
+    counter = self.counters.setdefault(name, dict())
+    counter[key] = counter.get(key, 0) + amount
+
+  # Add the phases and counters of another Metrics, e.g. from a render worker
+  def merge(self, other):
+    for name, phase in other.phases.items():
+      self.addPhase(name, phase["seconds"], phase["calls"])
+    for name, value in other.counters.items():
+      if(isinstance(value, dict)):
+        for key, amount in value.items():
+          self.countBy(name, key, amount)
+      else:
+        self.count(name, value)
+
+  # Returns the metrics as a dict that can be written as JSON
+  def getReport(self, projectName=None):
+    return {"version": METRICS_VERSION,
+            "project": projectName,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.startTime)),
+            "seconds": time.perf_counter() - self.startCounter,
+            "phases": self.phases,
+            "counters": self.counters,
+            "peakRSSBytes": getPeakRSS(),
+            "peakWorkerRSSBytes": getPeakRSS(True)}
+
+# Returns the most memory that this process, or the largest of its finished
+# worker processes if bChildren is set, has used so far in bytes, or None if it
+# is not known
+def getPeakRSS(bChildren=False):
+  if(resource is None):
+    return None
+  peakRSS = resource.getrusage(resource.RUSAGE_CHILDREN if bChildren else resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes and macOS bytes
+  return peakRSS if sys.platform == "darwin" else peakRSS * 1024
+
+# Add the report of the metrics of an extraction to the output as METRICS_NAME
+def writeMetrics(sink, projectName, metrics):
+  sink.addFile([], METRICS_NAME, json.dumps(metrics.getReport(projectName), indent=2).encode("utf-8"))
+
+# Output sinks receive every file that is extracted from a project.  Each file
+# is given as a list of directories relative to the top of the output and a
+# file name.
+#
+# Writes the output files to a directory, as separate files.  Each directory
+# is only created once.  With writerThreads the files are handed to a
+# FileWriter, so they are written while the next ones are rendered, and close()
+# or flush() wait for them to be written.
+class DirectorySink:
+  def __init__(self, rootDir, writerThreads=0):
+    self.rootDir = rootDir
+    self.writerThreads = writerThreads
+    self.writer = None
+    self.writerPid = None
+    self.createdPaths = set()
+
+  # Worker processes start their own writer, see getWriter()
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["writer"] = None
+    state["writerPid"] = None
+    return state
+
+  def addFile(self, path, filename, data):
+    self.createPath(path)
+    writer = self.getWriter()
+    if(writer is None):
+      writeOutputFile(os.path.join(self.rootDir, *path, filename), data)
+      self.fileWritten(path, filename)
+    else:
+      writer.write(os.path.join(self.rootDir, *path, filename), data, lambda: self.fileWritten(path, filename))
+
+  # Copy the file at sourcePath into the output
+  def addPath(self, path, filename, sourcePath):
+    self.createPath(path)
+    shutil.copy(sourcePath, os.path.join(self.rootDir, *path, filename))
+    self.fileWritten(path, filename)
+
+  # Called once the file at path/filename has been written, on a writer thread
+  # if there is one
+  def fileWritten(self, path, filename):
+    pass
+
+  def createPath(self, path):
+    path = tuple(path)
+    if(path not in self.createdPaths):
+      createPath(os.path.join(self.rootDir, *path))
+      self.createdPaths.add(path)
+
+  # Returns the writer of this process, starting it if needed, or None if files
+  # are written straight away.  A worker process has a copy of its parent's
+  # writer, without the threads, so it needs one of its own.
+  def getWriter(self):
+    if(self.writerThreads <= 0):
+      return None
+    if(self.writer is None or self.writerPid != os.getpid()):
+      self.writer = FileWriter(self.writerThreads, writerQueueSize)
+      self.writerPid = os.getpid()
+    return self.writer
+
+  # Wait for the files that have been added to be written
+  def flush(self):
+    if(self.writer is not None and self.writerPid == os.getpid()):
+      self.writer.flush()
+
+  def close(self):
+    if(self.writer is not None and self.writerPid == os.getpid()):
+      writer = self.writer
+      self.writer = None
+      writer.close()
+
+  # Stop after a failed extraction.  The files already written are kept.
+  def abort(self):
+    try:
+      self.close()
+    except GBExtractorError:
+      pass
+
+# Writes files on a pool of threads while the caller gets on with something
+# else.  write() queues a file and waits while queueSize files are already
+# waiting, so rendering cannot get far ahead of slow storage.  onWritten is
+# called once the file has been written.  The first error is raised by the next
+# call to write(), flush() or close().
+class FileWriter:
+  def __init__(self, threads, queueSize):
+    self.queue = queue.Queue(max(1, queueSize))
+    self.error = None
+    self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(threads)]
+    for thread in self.threads:
+      thread.start()
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if(item is None):
+          return
+        filePath, data, onWritten = item
+        if(self.error is None):
+          writeOutputFile(filePath, data)
+          if(onWritten is not None):
+            onWritten()
+      except OSError as ex:
+        self.error = self.error or GBExtractorError("ERROR: Could not write {}: {}".format(item[0], ex.strerror or ex))
+      finally:
+        self.queue.task_done()
+
+  def checkError(self):
+    if(self.error is not None):
+      raise self.error
+
+  def write(self, filePath, data, onWritten=None):
+    self.checkError()
+    self.queue.put((filePath, data, onWritten))
+
+  def flush(self):
+    self.queue.join()
+    self.checkError()
+
+  def close(self):
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.checkError()
+
+# Updates a directory written by an earlier extraction.  Files are only
+# written again if the sources that they are made from have changed, as given
+# by the key of each file, and the files of the earlier extraction that are not
+# made this time are deleted by removeStaleOutputs().  The keys are kept in a
+# manifest in the directory.  Files that are added without a key, such as the
+# log, are always written and are not in the manifest.  The key of a file that
+# has to be written again is only recorded once it has been written, so that a
+# file which could not be written is not taken to be current next time.
+class IncrementalSink(DirectorySink):
+  def __init__(self, rootDir, writerThreads=0):
+    DirectorySink.__init__(self, rootDir, writerThreads)
+    self.manifestPath = os.path.join(rootDir, OUTPUT_MANIFEST_NAME)
+    self.oldOutputs = dict()
+    try:
+      with open(self.manifestPath) as manifestFile:
+        manifest = json.load(manifestFile)
+      if(manifest.get("version") == OUTPUT_MANIFEST_VERSION):
+        self.oldOutputs = manifest["outputs"]
+    except (OSError, ValueError, AttributeError, KeyError):
+      pass
+    self.outputs = dict()
+    self.pendingOutputs = dict()
+
+  # Return True if the file at path/filename is already there with the same
+  # key.  Otherwise the key is recorded when the file is written.
+  def isCurrent(self, path, filename, key):
+    outputPath = "/".join(list(path) + [filename])
+    if(self.oldOutputs.get(outputPath) == key and os.path.isfile(os.path.join(self.rootDir, *path, filename))):
+      self.outputs[outputPath] = key
+      return True
+    self.pendingOutputs[outputPath] = key
+    return False
+
+  def fileWritten(self, path, filename):
+    outputPath = "/".join(list(path) + [filename])
+    key = self.pendingOutputs.pop(outputPath, None)
+    if(key is not None):
+      self.outputs[outputPath] = key
+
+  # Returns the keys recorded since the last call, for render workers
+  def takeOutputs(self):
+    outputs = self.outputs
+    self.outputs = dict()
+    return outputs
+
+  # Delete the files of the earlier extraction that have not been made again
+  # and the directories that this leaves empty
+  def removeStaleOutputs(self):
+    unchanged = sum(1 for outputPath, key in self.outputs.items() if self.oldOutputs.get(outputPath) == key)
+    staleOutputs = sorted(set(self.oldOutputs) - set(self.outputs))
+    for outputPath in staleOutputs:
+      removeOutputFile(self.rootDir, outputPath)
+    self.oldOutputs = dict()
+    print("{} files unchanged, {} removed".format(unchanged, len(staleOutputs)))
+
+  # Write the manifest once the files have been written.  If the extraction did
+  # not finish then the keys of the files that it did not get to are kept,
+  # apart from those of files that it could not write.  The manifest is written
+  # even if the writer threads failed, so that it leaves out those files.
+  def close(self):
+    try:
+      DirectorySink.close(self)
+    finally:
+      self.writeManifest()
+
+  def writeManifest(self):
+    outputs = dict(self.oldOutputs)
+    outputs.update(self.outputs)
+    for outputPath in self.pendingOutputs:
+      outputs.pop(outputPath, None)
+    try:
+      with open(self.manifestPath + ".tmp", "w") as manifestFile:
+        json.dump({"version": OUTPUT_MANIFEST_VERSION, "outputs": outputs}, manifestFile)
+      os.replace(self.manifestPath + ".tmp", self.manifestPath)
+    except OSError:
+      raise GBExtractorError("ERROR: Could not write {}".format(self.manifestPath))
+
+# Writes the output files one after another into an archive, under a
+# directory called rootName.  The file object is closed with the sink if
+# bCloseFile is set.  archivePath is the path of the file, if known, which is
+# deleted if the sink is aborted.
+class ArchiveSink:
+  def __init__(self, fileObject, rootName, bCloseFile, archivePath=None):
+    self.fileObject = fileObject
+    self.rootName = rootName
+    self.bCloseFile = bCloseFile
+    self.archivePath = archivePath
+
+  def getArchivePath(self, path, filename):
+    return "/".join([self.rootName] + list(path) + [filename])
+
+  def close(self):
+    self.closeArchive()
+    if(self.bCloseFile):
+      self.fileObject.close()
+
+  # Close the archive after a failed extraction and delete the file at
+  # archivePath, as it would be incomplete
+  def abort(self):
+    try:
+      self.close()
+    except (OSError, zipfile.BadZipFile, tarfile.TarError):
+      if(self.bCloseFile):
+        self.fileObject.close()
+    if(self.archivePath is not None):
+      try:
+        os.remove(self.archivePath)
+      except OSError:
+        pass
+
+class ZipSink(ArchiveSink):
+  def __init__(self, fileObject, rootName, bCloseFile=True, archivePath=None):
+    ArchiveSink.__init__(self, fileObject, rootName, bCloseFile, archivePath)
+    self.archive = zipfile.ZipFile(fileObject, "w", zipfile.ZIP_DEFLATED)
+
+  def addFile(self, path, filename, data):
+    self.archive.writestr(self.getArchivePath(path, filename), data)
+
+  def addPath(self, path, filename, sourcePath):
+    self.archive.write(sourcePath, self.getArchivePath(path, filename), getZipCompression(filename))
+
+  def closeArchive(self):
+    self.archive.close()
+
+# The tar stream is written without seeking, so fileObject may be a pipe
+class TarSink(ArchiveSink):
+  def __init__(self, fileObject, rootName, bCloseFile=True, archivePath=None):
+    ArchiveSink.__init__(self, fileObject, rootName, bCloseFile, archivePath)
+    self.archive = tarfile.open(fileobj=fileObject, mode="w|")
+
+  def addFile(self, path, filename, data):
+    tarInfo = tarfile.TarInfo(self.getArchivePath(path, filename))
+    tarInfo.size = len(data)
+    tarInfo.mtime = int(time.time())
+    tarInfo.mode = 0o644
+    self.archive.addfile(tarInfo, io.BytesIO(data))
+
+  def addPath(self, path, filename, sourcePath):
+    self.archive.add(sourcePath, self.getArchivePath(path, filename), recursive=False)
+
+  def closeArchive(self):
+    self.archive.close()
+
+# Keeps the output files in memory, for render workers which cannot write to
+# the archive themselves
+class MemorySink:
+  def __init__(self):
+    self.files = []
+
+  def addFile(self, path, filename, data):
+    self.files.append((path, filename, data))
+
+# Returns outputDir if it is already a sink, or a DirectorySink for it if it
+# is the path of a directory
+def getOutputSink(outputDir):
+  if(isinstance(outputDir, (str, os.PathLike))):
+    return DirectorySink(outputDir)
+  return outputDir
+
+# Create the sink for a project's output, called name, in parentDir.  If
+# bTarToStdout is set then a "tar" sink writes to standard output.  If
+# bIncremental is set then a "directory" sink updates the output of an earlier
+# extraction.
+def createOutputSink(parentDir, name, format=None, bTarToStdout=False, bIncremental=False):
+  format = format or outputFormat
+  if(format == "directory"):
+    workingDir = os.path.join(parentDir, name)
+    createPath(workingDir)
+    return IncrementalSink(workingDir, writerThreads) if bIncremental else DirectorySink(workingDir, writerThreads)
+  if(format == "tar" and bTarToStdout):
+    return TarSink(sys.stdout.buffer, name, False)
+  if(format == "zip" or format == "tar"):
+    createPath(parentDir)
+    archivePath = os.path.join(parentDir, "{}.{}".format(name, format))
+    try:
+      archiveFile = open(archivePath, "wb")
+    except OSError:
+      raise GBExtractorError("ERROR: Could not create {}".format(archivePath))
+    return ZipSink(archiveFile, name, True, archivePath) if format == "zip" else TarSink(archiveFile, name, True, archivePath)
+  raise GBExtractorError("ERROR: Unknown output format {}".format(format))
+
+# Returns the number of render worker processes to use for workers, which is 0
+# for one per CPU
+def getRenderWorkers(workers):
+  workers = workers or os.cpu_count() or 1
+  # Pythonista cannot start processes and batch workers are daemon
+  # processes which cannot start a pool of their own
+  if(bIsPythonista or multiprocessing.current_process().daemon):
+    workers = 1
+  return workers
+
+# The project rendered by this worker process and the sink that it writes to,
+# see GBProject.dumpAll()
+renderProject = None
+renderSink = None
+
+def initRenderWorker(project, sink, settings):
+  global renderProject, renderSink
+  applySettings(settings)
+  renderProject = project
+  renderSink = sink
+
+# Returns the values of the user-configurable parameters.  Worker processes
+# that are spawned rather than forked import this module again, so they only
+# see parameters that were changed at run time, e.g. by a script that sets
+# gbextractor.velocityMin, if they are given these values.
+def getSettings():
+  return {name: globals()[name] for name in SETTING_NAMES}
+
+def applySettings(settings):
+  globals().update(settings)
+
+# Run one render job in a worker process and return everything that it printed,
+# the files that it wrote if there is no sink, the keys of the files that it
+# made if the sink is incremental and its metrics
+def renderJob(viewName, track, cutUpRange):
+  jobMetrics = renderProject.metrics = Metrics()
+  jobLog = io.StringIO()
+  memorySink = MemorySink() if renderSink is None else None
+  with contextlib.redirect_stdout(jobLog):
+    try:
+      renderProject.renderView(renderSink or memorySink, viewName, track, cutUpRange)
+      if(renderSink):
+        renderSink.flush()
+    finally:
+      flushTrace()
+  jobOutputs = renderSink.takeOutputs() if isinstance(renderSink, IncrementalSink) else None
+  return jobLog.getvalue(), memorySink.files if memorySink else [], jobOutputs, jobMetrics
+
+# Returns how many 16 byte rows a MIDI block event with this command byte uses,
+# following the same rules as processMIDI
+def getMIDIRowKind(midiCmd):
+  if((midiCmd >= 0x90 and midiCmd <= 0x9F) or (midiCmd >= 0x70 and midiCmd <= 0x7F)):
+    return MIDI_ROW_DOUBLE
+  if((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF or
+     (midiCmd >= 0x20 and midiCmd <= 0x2F) or midiCmd == 0x40 or midiCmd == 0x50 or
+     (midiCmd >= 0x60 and midiCmd <= 0x6F) or (midiCmd >= 0x80 and midiCmd <= 0x8F) or
+     (midiCmd >= 0xA0 and midiCmd <= 0xEF)):
+    return MIDI_ROW_SINGLE
+  if(midiCmd == 0xF1 or (midiCmd >= 0x30 and midiCmd <= 0x3F) or midiCmd == 0x11 or midiCmd == 0x12):
+    return MIDI_ROW_END
+  return MIDI_ROW_UNKNOWN
+
+MIDI_ROW_KINDS = bytes(getMIDIRowKind(midiCmd) for midiCmd in range(0, 256))
+
+# Decode a whole MIDI data block with NumPy.  The block is viewed as an array of
+# 16 byte rows and the timestamps, velocities, pitches, durations, CC, pressure
+# and pitch bend values are pulled out with a few array operations.  Section end
+# clipping and duplicate note suppression are applied as masks, with the same
+# results as processMIDI.  Returns None if the block contains anything that
+# processMIDI would reject so that it can be decoded (and reported) one event
+# at a time instead.
+def decodeMIDIBlock(data, dataStart, dataLength, sectionEnd):
+  rowCount = dataLength // MIDI_ROW_SIZE
+  if(rowCount == 0 or dataLength % MIDI_ROW_SIZE != 0 or dataStart + dataLength > len(data)):
+    return None
+
+  rows = np.frombuffer(data, dtype=np.dtype(MIDI_ROW_FIELDS), count=rowCount, offset=dataStart)
+  commands = rows['cmd']
+  kinds = np.frombuffer(MIDI_ROW_KINDS, dtype=np.uint8)[commands]
+
+  # Row i starts an event if it is preceded by an even number of consecutive
+  # double row commands, otherwise it is the second half of a note
+  rowIndex = np.arange(rowCount)
+  lastSingle = np.maximum.accumulate(np.where(kinds == MIDI_ROW_DOUBLE, -1, rowIndex))
+  precedingDoubles = np.zeros(rowCount, dtype=np.int64)
+  precedingDoubles[1:] = rowIndex[:-1] - lastSingle[:-1]
+  starts = rowIndex[(precedingDoubles & 1) == 0]
+
+  # Stop at the end of buffer marker or give up on unknown commands
+  startKinds = kinds[starts]
+  stops = np.flatnonzero((startKinds != MIDI_ROW_SINGLE) & (startKinds != MIDI_ROW_DOUBLE))
+  if(stops.size):
+    if(startKinds[stops[0]] == MIDI_ROW_UNKNOWN):
+      return None
+    starts = starts[:stops[0]]
+  elif(startKinds[-1] == MIDI_ROW_DOUBLE and starts[-1] == rowCount - 1):
+    # The last note runs past the end of the block
+    return None
+
+  eventCommands = commands[starts]
+  eventTypes = eventCommands & 0xF0
+  times = rows['time'][starts].astype(np.int64)
+  valuesA = rows['valueA'][starts].astype(np.int64)
+  valuesB = rows['valueB'][starts].astype(np.int64)
+
+  # Notes must be followed by a 0x8x note off with the duration
+  noteMask = eventTypes == MIDI_EVENT_NOTE
+  noteRows = starts[noteMask] + 1
+  if(np.any((rows['sub'][noteRows] & 0xF0) != 0x80)):
+    return None
+  noteStarts = times[noteMask]
+  notePitches = valuesB[noteMask]
+  inSection = np.flatnonzero(noteStarts < sectionEnd)
+  # Try and work around duplicate note bug https://github.com/MarkCWirt/MIDIUtil/issues/24
+  duplicate = np.zeros(inSection.size, dtype=bool)
+  duplicate[1:] = ((noteStarts[inSection[1:]] == noteStarts[inSection[:-1]]) &
+                   (notePitches[inSection[1:]] == notePitches[inSection[:-1]]))
+  keepNote = np.zeros(noteStarts.size, dtype=bool)
+  keepNote[inSection[~duplicate]] = True
+  durations = np.zeros(starts.size, dtype=np.int64)
+  durations[noteMask] = np.minimum(rows['duration'][noteRows], sectionEnd - noteStarts)
+
+  keep = np.zeros(starts.size, dtype=bool)
+  keep[noteMask] = keepNote
+  keep |= (((eventTypes == MIDI_EVENT_CC) | (eventTypes == MIDI_EVENT_CHANNEL_PRESSURE) |
+            (eventTypes == MIDI_EVENT_PITCH_WHEEL)) & (times <= sectionEnd))
+
+  pitchWheelValues = (((valuesA & 0x7F) << 7) + (valuesB & 0x7F)) - 8192
+  if(bOverridePitchBend):
+    pitchWheelValues = np.clip(pitchWheelValues * pitchBendMultiplier, -8192, 8191)
+
+  # Fields that an event type does not use are zero
+  selected = np.flatnonzero(keep)
+  selectedTypes = eventTypes[selected]
+  isNote = selectedTypes == MIDI_EVENT_NOTE
+  isPitchWheel = selectedTypes == MIDI_EVENT_PITCH_WHEEL
+  columns = (selectedTypes,
+             times[selected],
+             eventCommands[selected] & 0x0F,
+             np.where(isPitchWheel, 0, valuesA[selected]),
+             np.where(isNote | (selectedTypes == MIDI_EVENT_CC), valuesB[selected], 0),
+             np.where(isNote, durations[selected], np.where(isPitchWheel, pitchWheelValues[selected], 0)))
+  eventList = EventStore()
+  for (name, typeCode), column in zip(EVENT_STORE_COLUMNS, columns):
+    getattr(eventList, name).frombytes(column.astype(np.dtype(typeCode)).tobytes())
+  return eventList
+
+# Find every record signature that starts in data[start:end] and return a list
+# of (byte offset, signature) pairs sorted by offset.  Every signature is
+# matched in the same pass over the chunk, and a match may run up to three
+# bytes past end.
+def scanChunk(data, start, end):
+  limit = min(end + 3, len(data))
+  return [(match.start(), match.group()) for match in RECORD_SIGNATURE_PATTERN.finditer(data, start, limit)]
+
+# Scan the decoded project data for records in a single pass, returning sorted
+# (byte offset, signature) pairs.  If an executor is provided then the chunks
+# are scanned in parallel; each task is given a copy of its chunk so that
+# process pools can be used as well as thread pools.
+def scanRecordOffsets(data, executor=None, chunkSize=SCAN_CHUNK_SIZE):
+  offsetList = []
+  chunkStarts = range(0, len(data), chunkSize)
+  if(executor is None):
+    for start in chunkStarts:
+      offsetList.extend(scanChunk(data, start, start + chunkSize))
+      releaseMappedPages(data, start, start + chunkSize)
+    return offsetList
+
+  futures = [executor.submit(scanChunk, bytes(data[start:start + chunkSize + 3]), 0, chunkSize) for start in chunkStarts]
+  for start, future in zip(chunkStarts, futures):
+    offsetList.extend((offset + start, signature) for offset, signature in future.result())
+  return offsetList
+
+# Encode a MIDI variable length quantity.  As with MIDIUtil, nothing is written
+# for a negative value
+def encodeVarLength(value):
+  if(value < 0x80):
+    return SMF_VAR_LENGTHS[value] if value >= 0 else b''
+  varLength = bytearray((value & 0x7F,))
+  value >>= 7
+  while value > 0:
+    varLength.append((value & 0x7F) | 0x80)
+    value >>= 7
+  varLength.reverse()
+  return bytes(varLength)
+
+SMF_VAR_LENGTHS = [bytes((value,)) for value in range(0, 0x80)]
+
+# Encode sorted (tick, order, insertion order, message) events with the time of
+# each as the delta from the one before
+def encodeSMFEvents(events, previousTick):
+  trackData = bytearray()
+  for tick, order, insertionOrder, message in events:
+    delta = tick - previousTick
+    trackData += SMF_VAR_LENGTHS[delta] if 0 <= delta < 0x80 else encodeVarLength(delta)
+    trackData += message
+    previousTick = tick
+  return trackData
+
+# Yields every combination of indexes for lists of these sizes in reflected
+# Gray code order, so only one index changes by one at each step.  The last
+# index changes fastest, as with itertools.product()
+def grayCodePermutations(sizes):
+  permutation = [0] * len(sizes)
+  directions = [1] * len(sizes)
+  yield tuple(permutation)
+  while True:
+    for i in range(len(sizes) - 1, -1, -1):
+      nextIndex = permutation[i] + directions[i]
+      if(0 <= nextIndex < sizes[i]):
+        permutation[i] = nextIndex
+        yield tuple(permutation)
+        break
+      directions[i] = -directions[i]
+    else:
+      return
+
+# Yields every combination of indexes for lists of these sizes in a random
+# order, without repeats.  The order only depends on the seed.  Small sets of
+# combinations are shuffled as they are yielded and large ones are sampled.
+def randomPermutations(sizes, seed):
+  rnd = random.Random(seed)
+  total = 1
+  for size in sizes:
+    total *= size
+  if(total <= RANDOM_SHUFFLE_LIMIT):
+    indexes = list(range(total))
+    for i in range(total):
+      j = rnd.randrange(i, total)
+      indexes[i], indexes[j] = indexes[j], indexes[i]
+      yield getPermutation(indexes[i], sizes)
+  else:
+    seen = set()
+    while len(seen) < total:
+      index = rnd.randrange(total)
+      if(index not in seen):
+        seen.add(index)
+        yield getPermutation(index, sizes)
+
+# Yields the fewest combinations of indexes for lists of these sizes which use
+# every index of every list at least once
+def coveringPermutations(sizes):
+  for i in range(max(sizes, default=0)):
+    yield tuple(i % size for size in sizes)
+
+# Returns the combination of indexes at this position in itertools.product()
+# order
+def getPermutation(index, sizes):
+  permutation = []
+  for size in reversed(sizes):
+    index, element = divmod(index, size)
+    permutation.append(element)
+  return tuple(reversed(permutation))
+
+# Returns a digest of the events in an EventStore
+def getEventsDigest(midiEvents):
+  return hashlib.blake2b(midiEvents.toBytes(), digest_size=16).digest()
+
+# MIDIUtil matches note offs to note ons using the pitch and channel written
+# as one string, so some pairs share a key, e.g. pitch 1 on channel 12 and
+# pitch 11 on channel 2.  This maps [channel][pitch] to the number of its key.
+def getSMFNoteKeys():
+  keyNumbers = dict()
+  return [[keyNumbers.setdefault(str(pitch) + str(channel), len(keyNumbers)) for pitch in range(0, 256)] for channel in range(0, 16)]
+
+SMF_NOTE_KEYS = getSMFNoteKeys()
+
+def millisecondsToTicks(bpm, msDuration):
+  return ((bpm * PPQN) / 60000) * msDuration
+
+def createDir(path):
+  try:
+    os.mkdir(path)
+  except OSError:
+    raise GBExtractorError("ERROR: Could not create directory {}".format(path))
+
+def writeOutputFile(filePath, data):
+  with open(filePath, "wb") as outputFile:
+    outputFile.write(data)
+
+# Delete the file at outputPath, a "/" separated path relative to rootDir, and
+# the directories that this leaves empty.  Files that have already gone are
+# ignored.
+def removeOutputFile(rootDir, outputPath):
+  path = os.path.join(rootDir, *outputPath.split("/"))
+  try:
+    os.remove(path)
+    path = os.path.dirname(path)
+    while(path != rootDir and not os.listdir(path)):
+      os.rmdir(path)
+      path = os.path.dirname(path)
+  except OSError:
+    pass
+
+def createPath(path):
+  try:
+    # Render jobs running at the same time may create the same directories
+    os.makedirs(path, exist_ok=True)
+  except OSError:
+    raise GBExtractorError("ERROR: Could not create path {}".format(path))
+
+# Update digest, or a new SHA-256 digest, with the contents of the file at path
+def hashFile(path, digest=None):
+  digest = digest or hashlib.sha256()
+  with open(path, "rb") as dataFile:
+    for chunk in iter(lambda: dataFile.read(HASH_CHUNK_SIZE), b""):
+      digest.update(chunk)
+  return digest
+
+# Returns how a file should be compressed in a zip file.  Audio which is
+# already compressed is stored as it is.
+def getZipCompression(filename):
+  if(os.path.splitext(filename)[1].lower() in COMPRESSED_AUDIO_EXTENSIONS):
+    return zipfile.ZIP_STORED
+  return zipfile.ZIP_DEFLATED
+
+# Copy the audio files, as given by GBProject.getAudioFiles(), to rootDir using
+# a pool of audioWorkers threads.  If bCompressAudio is set then audio.zip is
+# written from the project's copies of the files while they are being copied.
+# If bSkipUnchangedAudio is set then the manifest left by the last export to
+# rootDir is used to skip files, and audio.zip, that have not changed.  The
+# manifest needs a hash of every file copied, which means reading it again, so
+# it is only kept if bIncrementalOutput is set or rootDir already has one, as
+# otherwise rootDir is a new directory that will not be exported to again.
+# The copies of files in the manifest that are no longer in the project are
+# deleted.  What is copied is counted in metrics, if given.
+def exportAudio(rootDir, audioFiles, bIncrementalOutput=False, metrics=None):
+  metrics = metrics or Metrics()
+  manifestPath = os.path.join(rootDir, AUDIO_MANIFEST_NAME)
+  bKeepManifest = bSkipUnchangedAudio and (bIncrementalOutput or os.path.isfile(manifestPath))
+  manifest = loadAudioManifest(manifestPath) if bKeepManifest else {}
+  oldFiles = manifest.get("files", {})
+  staleFiles = sorted(set(oldFiles) - set("/".join(path + [filename]) for path, filename, sourcePath in audioFiles))
+  for path in set(tuple(path) for path, filename, sourcePath in audioFiles):
+    createPath(os.path.join(rootDir, *path))
+
+  def exportFile(audioFile):
+    path, filename, sourcePath = audioFile
+    return exportAudioFile(sourcePath, os.path.join(rootDir, *path, filename),
+                           oldFiles.get("/".join(path + [filename])), bKeepManifest)
+
+  zipPath = os.path.join(rootDir, "audio.zip")
+  oldZip = manifest.get("zip")
+  bZipChanged = bool(audioFiles) and (bool(staleFiles) or not(oldZip and getFileState(zipPath) == oldZip))
+  files = dict()
+  copied = 0
+  with concurrent.futures.ThreadPoolExecutor(max(1, audioWorkers)) as executor:
+    results = executor.map(exportFile, audioFiles)
+    # Nothing is written to audio.zip until a file turns out to have changed,
+    # then it is rewritten from the start
+    zipFiles = []
+    audioZip = None
+    try:
+      for audioFile, (fileState, bCopied) in zip(audioFiles, results):
+        path, filename, sourcePath = audioFile
+        files["/".join(path + [filename])] = fileState
+        copied += bCopied
+        if(bCopied):
+          metrics.count("audioBytesCopied", fileState[0])
+        bZipChanged = bZipChanged or bCopied
+        if(not bCompressAudio):
+          continue
+        zipFiles.append(audioFile)
+        if(bZipChanged):
+          if(audioZip is None):
+            audioZip = zipfile.ZipFile(zipPath + ".tmp", "w")
+          for zipPathParts, zipFilename, zipSourcePath in zipFiles:
+            audioZip.write(zipSourcePath, "/".join(zipPathParts[1:] + [zipFilename]), getZipCompression(zipFilename))
+          zipFiles = []
+      if(audioZip is not None):
+        audioZip.close()
+        os.replace(zipPath + ".tmp", zipPath)
+        audioZip = None
+    except OSError:
+      raise GBExtractorError("ERROR: Could not write {}".format(zipPath))
+    finally:
+      if(audioZip is not None):
+        audioZip.close()
+        os.remove(zipPath + ".tmp")
+
+  for outputPath in staleFiles:
+    trace("audio", "Removing {}", outputPath)
+    removeOutputFile(rootDir, outputPath)
+  # The zip of the last export is left over if the project has no audio now
+  if(oldZip and not audioFiles):
+    removeOutputFile(rootDir, "audio.zip")
+
+  metrics.count("audioFiles", len(audioFiles))
+  metrics.count("audioFilesCopied", copied)
+  if(audioFiles or staleFiles):
+    print("Extracted {} audio files, {} unchanged, {} removed".format(len(audioFiles), len(audioFiles) - copied, len(staleFiles)))
+  if(bKeepManifest and not audioFiles):
+    removeOutputFile(rootDir, AUDIO_MANIFEST_NAME)
+  elif(bKeepManifest):
+    manifest = {"version": AUDIO_MANIFEST_VERSION, "files": files,
+                "zip": getFileState(zipPath) if bCompressAudio else None}
+    try:
+      with open(manifestPath + ".tmp", "w") as manifestFile:
+        json.dump(manifest, manifestFile)
+      os.replace(manifestPath + ".tmp", manifestPath)
+    except OSError:
+      raise GBExtractorError("ERROR: Could not write {}".format(manifestPath))
+
+# Returns the manifest of the last audio export, or an empty one if there is
+# no usable manifest
+def loadAudioManifest(manifestPath):
+  try:
+    with open(manifestPath) as manifestFile:
+      manifest = json.load(manifestFile)
+  except (OSError, ValueError):
+    return {}
+  if(not isinstance(manifest, dict) or manifest.get("version") != AUDIO_MANIFEST_VERSION):
+    return {}
+  return manifest
+
+# Returns [size, modification time in nanoseconds] for the file at path, or
+# None if it does not exist
+def getFileState(path):
+  try:
+    fileStat = os.stat(path)
+  except OSError:
+    return None
+  return [fileStat.st_size, fileStat.st_mtime_ns]
+
+# Copy the audio file at sourcePath to destPath unless oldState, the state of
+# the file when it was last exported as [size, modification time, SHA-256],
+# shows that the copy already there is the same.  A file that has been touched
+# but not changed is compared by hash.  The hash of a copied file is only
+# worked out if bHash is set.  Returns the new state and whether the file was
+# copied.
+def exportAudioFile(sourcePath, destPath, oldState, bHash=True):
+  try:
+    sourceStat = os.stat(sourcePath)
+    fileState = [sourceStat.st_size, sourceStat.st_mtime_ns, None]
+    destState = getFileState(destPath)
+    if(oldState and destState and oldState[0] == sourceStat.st_size and destState[0] == sourceStat.st_size):
+      if(oldState[1] == sourceStat.st_mtime_ns):
+        return oldState, False
+      fileState[2] = hashFile(sourcePath).hexdigest()
+      if(oldState[2] == fileState[2]):
+        return fileState, False
+    trace("audio", "Copying {} to {}", sourcePath, destPath)
+    copyAudioFile(sourcePath, destPath)
+    if(bHash and fileState[2] is None):
+      fileState[2] = hashFile(sourcePath).hexdigest()
+  except OSError:
+    raise GBExtractorError("ERROR: Could not copy {}".format(sourcePath))
+  return fileState, True
+
+# Copy the file at sourcePath to destPath as set by audioCopyMode
+def copyAudioFile(sourcePath, destPath):
+  # Never write over the old copy as it may be a hard link to the project
+  if(os.path.lexists(destPath)):
+    os.remove(destPath)
+  if(audioCopyMode == "hardlink"):
+    try:
+      os.link(sourcePath, destPath)
+      return
+    except OSError:
+      pass
+  elif(audioCopyMode == "reflink" and fcntl is not None):
+    try:
+      with open(sourcePath, "rb") as sourceFile, open(destPath, "wb") as destFile:
+        fcntl.ioctl(destFile.fileno(), FICLONE, sourceFile.fileno())
+      shutil.copymode(sourcePath, destPath)
+      return
+    except OSError:
+      pass
+  shutil.copy(sourcePath, destPath)
+
+def initMultiTakeChoices(multiTakes):
+  multiTakeChoices = dict()
+  for multiTake in multiTakes:
+    multiTakeChoices[multiTake.record.recordNumber] = 0
+  return multiTakeChoices
+
+# Write a MIDI file to the directories in path of outputDir, which is a
+# directory path or an output sink, and count it in metrics
+def writeMIDI(outputDir, path, filename, midiFileData, metrics):
+  print("Writing MIDI to {}".format(filename))
+  midiFile = io.BytesIO()
+  midiFileData.writeFile(midiFile)
+  getOutputSink(outputDir).addFile(path, filename, midiFile.getvalue())
+  metrics.count("filesWritten")
+  metrics.count("bytesWritten", len(midiFile.getvalue()))
+
+# Read the projectData plist and return the decoded NS.data payload.  The file
+# is memory mapped and the base64 text is decoded in bounded chunks into one
+# preallocated buffer, so the whole XML document and the whole base64 string are
+# never held in memory.  Files that do not have the expected layout are read
+# with ElementTree instead.
+# If outputFile is given then the decoded data is written to it instead and the
+# number of bytes written is returned.
+def readProjectData(pathToGBFile, outputFile=None):
+  if not os.path.exists(pathToGBFile):
+    raise GBExtractorError("ERROR: File does not exist: {}".format(pathToGBFile))
+
+  decodedData = None
+  with open(pathToGBFile, "rb") as gbFile:
+    try:
+      mappedFile = mmap.mmap(gbFile.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+      mappedFile = None # Empty files cannot be mapped
+    if(mappedFile is not None):
+      with mappedFile:
+        decodedData = decodeNSData(mappedFile, outputFile)
+  
+  if(decodedData is None):
+    decodedData = readProjectDataFromTree(pathToGBFile)
+    if(outputFile is not None):
+      outputFile.seek(0)
+      outputFile.truncate()
+      outputFile.write(decodedData)
+      decodedData = len(decodedData)
+  return decodedData
+
+# Decode the projectData file at pathToGBFile into an anonymous temporary file
+# and return a read only memory map of it, which the parser reads like the
+# decoded bytes.  The file is deleted when the map is closed.
+def readProjectDataToMap(pathToGBFile):
+  with tempfile.TemporaryFile() as decodedFile:
+    decodedLength = readProjectData(pathToGBFile, decodedFile)
+    decodedFile.flush()
+    # Empty files cannot be mapped
+    if(decodedLength == 0):
+      return b""
+    return mmap.mmap(decodedFile.fileno(), 0, access=mmap.ACCESS_READ)
+  
+# Let the OS drop the pages of data[start:end] from this process if data is a
+# map from readProjectDataToMap().  They are read back from the page cache if
+# they are needed again.
+def releaseMappedPages(data, start=0, end=None):
+  if(not isinstance(data, mmap.mmap) or not hasattr(data, "madvise") or not hasattr(mmap, "MADV_DONTNEED")):
+    return
+  end = len(data) if end is None else min(end, len(data))
+  releaseStart = start - (start % mmap.PAGESIZE)
+  releaseEnd = end - (end % mmap.PAGESIZE) if end < len(data) else end
+  if(releaseEnd > releaseStart):
+    data.madvise(mmap.MADV_DONTNEED, releaseStart, releaseEnd - releaseStart)
+
+# Yield the (offset, signature) pairs of offsetList, letting the OS drop the
+# pages of data that are behind them, see releaseMappedPages()
+def iterReleasingPages(offsetList, data):
+  releasedOffset = 0
+  for thisOffset, signature in offsetList:
+    if(thisOffset - releasedOffset >= SCAN_CHUNK_SIZE):
+      releaseMappedPages(data, releasedOffset, thisOffset)
+      releasedOffset = thisOffset
+    yield thisOffset, signature
+    
+# Find the base64 <data> value of the NS.data key in a projectData file and
+# decode it.  Returns None if the value cannot be located this way.  If
+# outputFile is given then the decoded data is written to it one chunk at a
+# time and the number of bytes written is returned.
+def decodeNSData(mappedFile, outputFile=None):
+  keyTag = b"<key>NS.data</key>"
+  keyOffset = mappedFile.find(keyTag)
+  if(keyOffset == -1):
+    return None
+  keyEnd = keyOffset + len(keyTag)
+  textStart = mappedFile.find(b"<data>", keyEnd)
+  if(textStart == -1 or mappedFile[keyEnd:textStart].strip(BASE64_WHITESPACE)):
+    return None
+  textStart += len(b"<data>")
+    
+  # The end of the text is not known until it is found, so size the buffer for
+  # the rest of the file and trim it afterwards
+  decodedData = bytearray((len(mappedFile) - textStart) // 4 * 3 + 3) if outputFile is None else None
+  decodedLength = 0
+  leftOver = b""
+  chunkStart = textStart
+  bFoundEnd = False
+  bCanRelease = hasattr(mappedFile, "madvise") and hasattr(mmap, "MADV_DONTNEED")
+  try:
+    while not bFoundEnd:
+      chunkEnd = min(chunkStart + BASE64_CHUNK_SIZE, len(mappedFile))
+      encodedChunk = mappedFile[chunkStart:chunkEnd]
+      # Base64 text cannot contain '<' so the first one is the closing tag
+      tagOffset = encodedChunk.find(b"<")
+      if(tagOffset != -1):
+        if(mappedFile[chunkStart + tagOffset:chunkStart + tagOffset + 7] != b"</data>"):
+          return None
+        encodedChunk = encodedChunk[:tagOffset]
+        bFoundEnd = True
+      elif(chunkEnd == len(mappedFile)):
+        return None
+      # Entities would need the XML parser
+      if(b"&" in encodedChunk):
+        return None
+    
+      encodedChunk = leftOver + encodedChunk.translate(None, BASE64_WHITESPACE)
+      # Only decode whole groups of four characters, the rest go with the next chunk
+      usableLength = len(encodedChunk) if bFoundEnd else len(encodedChunk) - (len(encodedChunk) % 4)
+      leftOver = encodedChunk[usableLength:]
+      decodedChunk = binascii.a2b_base64(encodedChunk[:usableLength])
+      if(outputFile is None):
+        decodedData[decodedLength:decodedLength + len(decodedChunk)] = decodedChunk
+      else:
+        outputFile.write(decodedChunk)
+      decodedLength += len(decodedChunk)
+    
+      # Let the OS drop the pages of the file that have been decoded
+      if(bCanRelease):
+        releaseStart = chunkStart - (chunkStart % mmap.PAGESIZE)
+        releaseEnd = chunkEnd - (chunkEnd % mmap.PAGESIZE)
+        if(releaseEnd > releaseStart):
+          mappedFile.madvise(mmap.MADV_DONTNEED, releaseStart, releaseEnd - releaseStart)
+      chunkStart = chunkEnd
+  except binascii.Error as ex:
+    print(str(ex))
+    raise GBExtractorError("ERROR: Failed to decode data")
+
+  if(outputFile is not None):
+    return decodedLength
+  del decodedData[decodedLength:]
+  return decodedData
+      
+# Read the NS.data payload by parsing the whole plist with ElementTree
+def readProjectDataFromTree(pathToGBFile):
+  try:
+    parseDataFile = ET.parse(pathToGBFile)
+    xmlRoot = parseDataFile.getroot()
+  except ET.ParseError as ex:
+    raise GBExtractorError("ERROR: Could not parse {}: {}".format(pathToGBFile, ex))
+      
+  # Decode the base64 data in the projectData file.  Drop the XML tree first so
+  # that it is not alive at the same time as the decoded data
+  nsData = xmlRoot.find(".//*[key='NS.data']/data")
+  if(nsData is None or nsData.text is None):
+    raise GBExtractorError("ERROR: No NS.data found in {}".format(pathToGBFile))
+  encodedText = nsData.text
+  del parseDataFile, xmlRoot, nsData
+  try:
+    return base64.b64decode(encodedText)
+  except Exception as ex:
+    print(str(ex))
+    raise GBExtractorError("ERROR: Failed to decode data")
   
 def quitWithError(errorString):
   print(errorString)
@@ -730,33 +3740,208 @@ def getNoteName(note):
 def createKey(partA, partB):    
   return "{}:{}".format(str(partA), str(partB))
   
-def debugPrint(stringToPrint):
-  if(bDebug): print(stringToPrint)
+# Returns True if debug runs write trace records of category at level, see
+# traceCategories and traceLevel.  Loops call this once and then only call
+# trace() if it is True, so that they cost nothing extra when not tracing.
+def isTracing(category, level=TRACE_DEBUG):
+  return bDebug and level >= TRACE_LEVELS[traceLevel] and (not traceCategories or category in traceCategories)
+
+# Write a trace record of category if it is being traced.  The message is only
+# formatted with args, as by str.format(), once the record is known to be written.
+def trace(category, message, *args, level=TRACE_DEBUG):
+  if(not isTracing(category, level)):
+    return
+  if(args):
+    message = message.format(*args)
+  if(traceFile is None):
+    print("{}: {}{}".format(category, "WARN: " if level >= TRACE_WARN else "", message))
+    return
+  writeTraceRecord({"time": time.time(), "pid": os.getpid(), "level": TRACE_LEVEL_NAMES.get(level, level),
+                    "category": category, "message": message, "args": args})
+
+# Write a trace record with a hex dump of the next dataLength bytes of a reader
+def traceHex(category, dataLength, s):
+  if(isTracing(category, TRACE_DUMP)):
+    trace(category, formatHex(dataLength, s), level=TRACE_DUMP)
+
+# Trace records waiting to be added to traceFile and the process that they
+# belong to
+traceBuffer = []
+traceBufferPid = None
+traceEncoder = json.JSONEncoder(default=str)
+
+def writeTraceRecord(record):
+  global traceBufferPid
+  # A worker process starts with a copy of its parent's records, which are the
+  # parent's to write
+  if(traceBufferPid != record["pid"]):
+    del traceBuffer[:]
+    traceBufferPid = record["pid"]
+    atexit.register(flushTrace)
+  traceBuffer.append(traceEncoder.encode(record) + "\n")
+  if(len(traceBuffer) >= TRACE_BUFFER_SIZE):
+    flushTrace()
+
+# Add the trace records of this process to traceFile.  Worker processes do not
+# run atexit handlers so they call this when they finish a job.
+def flushTrace():
+  if(traceBuffer and traceBufferPid == os.getpid()):
+    with open(traceFile, "a") as traceOutput:
+      traceOutput.write("".join(traceBuffer))
+    del traceBuffer[:]
 
 def dumphex(dataLength, s):
+  print(formatHex(dataLength, s))
+
+# Returns a hex dump of the next dataLength bytes of a reader, leaving its
+# position where it was.  Lines are numbered from the reader's position.
+def formatHex(dataLength, s):
   originalPosition = s.pos
-  byteCounter = 0
-  hexDump = ""
-  for lineOffset in range(0, dataLength, 16):
-    hexString = ""
-    asciiString = ""
+  lines = []
+  addHexLines(lines, s.readBytes(dataLength), 0, dataLength, {})
+  s.pos = originalPosition
+  return "".join(lines)
     
-    bytesToRead = min(16, dataLength - lineOffset)
+# Add the hex dump lines of data[segmentStart:segmentEnd] to lines, 16 bytes to
+# a line, followed by the annotation of each line that has one in annotations.
+# firstAnnotation goes before the annotation of the first line.
+def addHexLines(lines, data, segmentStart, segmentEnd, annotations, firstAnnotation=None):
+  segment = bytes(data[segmentStart:segmentEnd])
+  hexText = segment.hex(" ").upper()
+  asciiText = segment.translate(HEX_DUMP_ASCII).decode("ascii")
+  for lineStart in range(0, len(segment), 16):
+    annotation = annotations.get(segmentStart + lineStart)
+    if(lineStart == 0 and firstAnnotation):
+      annotation = firstAnnotation + ": " + annotation if annotation else firstAnnotation
+    lines.append("0x{:08X} | {:48}| {:16} |{}\n".format(segmentStart + lineStart, hexText[lineStart * 3:lineStart * 3 + 48],
+                 asciiText[lineStart:lineStart + 16], " " + annotation if annotation else ""))
     
-    for byte in s.readlist("{}*uint:8".format(bytesToRead)):      
-      if(byte in canBePrinted):
-        asciiString += chr(byte)
+# The records found in decoded project data, for annotating hex dumps.  Each
+# record is a tuple of its offset, data start and data end.  marks holds the
+# annotations of the offsets where records and their data start and end, which
+# also start a new line.  MIDI blocks are (data start, data end) pairs.
+class RecordMap:
+  def __init__(self, data):
+    self.records = []
+    self.marks = dict()
+    self.midiBlocks = []
+    for offset, signature in scanRecordOffsets(data):
+      try:
+        identity, recordType, recordSubType, recordNumber, recordMidiID, dataLength = RECORD_HEADER.unpack_from(data, offset)
+      except struct.error:
+        continue
+      dataStart = offset + RECORD_HEADER.size
+      dataEnd = min(dataStart + dataLength, len(data))
+      self.records.append((offset, dataStart, dataEnd))
+      self.addMark(offset, "{} type {}/{} record {} MIDI ID {}, {} bytes{}".format(identity.decode("ascii", "replace"), recordType, recordSubType,
+                   recordNumber, recordMidiID, dataLength, self.getRecordName(data, identity, recordType, dataStart, dataEnd)))
+      blockType = bytes(data[dataStart:dataStart + 2])
+      if(recordType != 1):
+        kind = ""
+      elif(blockType == b'\x20\x00' or blockType == b'\x24\x00'):
+        kind = " (folder)"
       else:
-        asciiString += "."
+        kind = " (MIDI)"
+        self.midiBlocks.append((dataStart, dataEnd))
+      self.addMark(dataStart, "data of record {}{}".format(recordNumber, kind))
+      if(dataEnd < len(data)):
+        self.addMark(dataEnd, "end of record {}".format(recordNumber))
+    self.breaks = sorted(self.marks)
+    self.midiBlockStarts = [dataStart for dataStart, dataEnd in self.midiBlocks]
         
-      hexString += "{:02X} ".format(byte)
+  def addMark(self, offset, annotation):
+    self.marks[offset] = self.marks[offset] + " / " + annotation if offset in self.marks else annotation
       
-      byteCounter += 1
-      if (byteCounter == dataLength):
-        break        
-    hexDump += "0x{:08X} | {:48}| {:16} |\n".format(lineOffset, hexString, asciiString)
-  s.pos = originalPosition
-  print(hexDump)
+  # Returns the name of a section header or track name record, as read by
+  # processOffsetList(), for its annotation
+  def getRecordName(self, data, identity, recordType, dataStart, dataEnd):
+    if(identity == b'qSxT' and dataEnd - dataStart > 98):
+      name = bytes(data[dataStart + 98:dataEnd]).split(b"\x00")[0]
+    elif(recordType == 2 and dataEnd - dataStart >= 3 + SECTION_HEADER.size):
+      associatedMidiID, sectionNameLength = SECTION_HEADER.unpack_from(data, dataStart + 3)
+      nameStart = dataStart + 3 + SECTION_HEADER.size
+      name = bytes(data[nameStart:min(nameStart + sectionNameLength, dataEnd)])
+    else:
+      return ""
+    return " \"{}\"".format(name.decode("utf-8", "replace"))
+
+  # Returns the (data start, data end) of the MIDI block that offset is in, or None
+  def getMIDIBlock(self, offset):
+    i = bisect.bisect_right(self.midiBlockStarts, offset) - 1
+    if(i >= 0 and offset < self.midiBlocks[i][1]):
+      return self.midiBlocks[i]
+    return None
+
+# Returns the names of the MIDI block commands, following the comments in
+# processMIDI()
+def getMIDICommandName(midiCmd):
+  if(midiCmd >= 0x90 and midiCmd <= 0x9F): return "note"
+  if(midiCmd >= 0xB0 and midiCmd <= 0xBF): return "CC"
+  if(midiCmd >= 0xD0 and midiCmd <= 0xDF): return "channel pressure"
+  if(midiCmd >= 0xE0 and midiCmd <= 0xEF): return "pitch bend"
+  if(midiCmd >= 0xA0 and midiCmd <= 0xAF): return "polyphonic key pressure"
+  if((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF): return "internal"
+  if(midiCmd >= 0x20 and midiCmd <= 0x2F): return "bank change"
+  if(midiCmd == 0x40): return "sustain"
+  if(midiCmd == 0x50): return "controller"
+  if(midiCmd >= 0x70 and midiCmd <= 0x7F): return "smart drums"
+  if(midiCmd == 0xF1): return "end of buffer"
+  return "unknown"
+
+MIDI_COMMAND_NAMES = tuple(getMIDICommandName(midiCmd) for midiCmd in range(0, 256))
+
+# Returns the annotation of the first row of each event in a MIDI block, found
+# by stepping through the events as processMIDI() does
+def getMIDIRowLabels(data, dataStart, dataEnd):
+  rowLabels = dict()
+  offset = dataStart
+  while offset < dataEnd:
+    midiCmd = data[offset]
+    rowLabels[offset] = "{:02X} {}".format(midiCmd, MIDI_COMMAND_NAMES[midiCmd])
+    rowKind = MIDI_ROW_KINDS[midiCmd]
+    if(rowKind == MIDI_ROW_DOUBLE or (midiCmd >= 0x60 and midiCmd <= 0x6F and dataEnd - dataStart == 48)):
+      offset += 2 * MIDI_ROW_SIZE
+    elif(rowKind == MIDI_ROW_SINGLE):
+      offset += MIDI_ROW_SIZE
+    else:
+      break
+  return rowLabels
+
+# Write a hex dump of length bytes of decoded project data from offset start,
+# or to the end, to a text file object.  The dump is formatted and written
+# HEX_DUMP_CHUNK_SIZE bytes at a time.  If a RecordMap is given then every record
+# header and record data starts on a new line, annotated with the header fields,
+# and each event of a MIDI block is annotated with its command.
+def writeHexDump(output, data, start=0, length=None, recordMap=None):
+  end = len(data) if length is None else min(len(data), start + length)
+  marks = recordMap.marks if recordMap else {}
+  breaks = recordMap.breaks if recordMap else []
+  breakIndex = bisect.bisect_right(breaks, start)
+  midiBlock = None
+  rowLabels = {}
+  if(recordMap):
+    # Start on a row of the MIDI block that start is in
+    midiBlock = recordMap.getMIDIBlock(start)
+    if(midiBlock):
+      start -= (start - midiBlock[0]) % MIDI_ROW_SIZE
+      rowLabels = getMIDIRowLabels(data, *midiBlock)
+
+  position = start
+  while position < end:
+    if(position in marks):
+      newMIDIBlock = recordMap.getMIDIBlock(position)
+      if(newMIDIBlock != midiBlock):
+        midiBlock = newMIDIBlock
+        rowLabels = getMIDIRowLabels(data, *midiBlock) if midiBlock else {}
+      while(breakIndex < len(breaks) and breaks[breakIndex] <= position):
+        breakIndex += 1
+    segmentEnd = min(end, position + HEX_DUMP_CHUNK_SIZE)
+    if(breakIndex < len(breaks)):
+      segmentEnd = min(segmentEnd, breaks[breakIndex])
+    lines = []
+    addHexLines(lines, data, position, segmentEnd, rowLabels, marks.get(position))
+    output.write("".join(lines))
+    position = segmentEnd
 
 # Removes some characters from a string to make it more suitable for use as a filename
 # Also limits the string to 24 characters
@@ -767,539 +3952,369 @@ def cleanStringForFile(stringToClean):
     cleanedString = cleanedString[:24]
   return cleanedString
 
-def processOffsetList(s):
-  for thisOffset in sorted_offset_list:
-    s.pos = thisOffset
-
-    if bDebug:
-      debugPrint("Byte offset {}".format(thisOffset))
-      dumphex(64, s)
-    
-    identity, recordType, recordSubType, recordNumber, recordMidiID, dataLength = s.readlist("bytes:4, uintle:16, uintle:32, uintle:32, uintle:32, 2*pad:32, pad:16, uintle:32, pad:32")
-    
-    # We are now at the start of the data so save this position for later...
-    dataStart = s.pos
-    
-    if bDebug:
-      debugPrint("Data length is: {} Type is: {}/{} Record no: {} MIDI ID: {} ".format(dataLength, identity, recordType, recordNumber, recordMidiID))
-      if(recordType == 1 or recordType == 2 or recordType == 4 or recordType == 5): dumphex(dataLength, s)
-  
-    # Test for a MIDI block header
-    blockType = s.read("bytes:2")
-    s.read("bytes:1")
-  
-    debugPrint("BlockType is {}".format(blockType.hex()))
-
-    if(identity == b'qSxT'):
-      s.pos = dataStart
-      sectionLength = s.read("uintle:32")
-      debugPrint("Section length {}".format(sectionLength))
-      if(sectionLength < 98):
-        quitWithError("ERROR: section length invalid {}".format(sectionLength))
-      s.read("bytes:94")
-      nameStart = s.pos
-      i = 0
-      for i in range(0, sectionLength - 98):
-        thisChar = s.read("uintle:8")
-        if(thisChar == 0):
-          break  
-      debugPrint("Found track section name length {}".format(i))
-      s.pos = nameStart
-      if(i > 0):
-        trackName = s.read("bytes:{}".format(str(i))).decode("utf-8")
-        debugPrint("trackName is {}".format(trackName))
-        trackNameLookup[recordNumber] = trackName
-      else:
-        debugPrint("No track name")
-      continue
-      
-    # Is this a section header?
-    if(recordType == 2):
-      associatedMidiID, sectionNameLength = s.readlist("pad:40, uintle:32, pad:32, uintle:16")
-      if(sectionNameLength == 0):
-        continue
-        
-      # Create a key from the record + associated midi ID
-      hashKey = createKey(str(recordNumber), str(associatedMidiID))
-      origSectionName = s.read("bytes:{}".format(str(sectionNameLength))).decode("utf-8")
-      
-      # Strip out filename unfriendly characters
-      sectionName = "".join(thisChar for thisChar in origSectionName if (thisChar.isalnum() or thisChar in "._- "))      
-      
-      debugPrint("Section name is {} (orig {}), hash key is {}".format(sectionName, origSectionName, hashKey))
-      # Nothing to guide us here
-      sectionLength = None
-      sectionStart = 0
-      for i in range(0, 100):
-        thisByte = s.read("uintle:8")
-        if(thisByte == 0x20):
-          if bDebug: dumphex(45, s)
-          s.read("bytes:39")
-          sectionLength = s.read("uintle:24")
-          s.read("bytes:161")
-          sectionStart = s.read("uintle:24")
-          break
-          
-      if(sectionLength == None):
-        quitWithError("ERROR: Did not find section length")
-      
-      debugPrint("Section length is {} {} start is {} ({})".format(sectionLength, hex(sectionLength), sectionStart, hex(sectionStart)))  
-      
-      existingRecord = recordHash.get(hashKey)
-      # Validation - The key should be unique
-      if(existingRecord != None):
-        quitWithError("ERROR: Found second record for key {}".format(hashKey))
-  
-      midiSection = MIDISection(sectionName, associatedMidiID, recordNumber, sectionLength, sectionStart)
-      recordHash[hashKey] = midiSection
-    elif(recordType == 1): # MIDI data block
-      hashKey = createKey(str(recordNumber), str(recordMidiID))    
-      debugPrint("Hash key is {}".format(hashKey))    
-      # Have we seen a section header with this MIDI ID?
-      midiSection = recordHash.get(hashKey)
-      if(midiSection != None):
-        debugPrint("Found MIDI data for section {} blockType {}".format(midiSection.label, blockType.hex()))
-        midiEvents = None
-        
-        if(blockType.hex() == "2000" or blockType.hex() == "2400"):
-          debugPrint("Found Folder")
-          if(midiSection.label != "Automation"):
-            processFolder(s, midiSection, dataStart, dataLength)
-          else:
-            debugPrint("TODO: Automation folders.  Ignoring for now.")
-        else:
-          midiEvents = processMIDI(s, midiSection, baseTime, recordNumber, recordMidiID, dataStart, dataLength)     
-        
-        midiSection.midiEvents = midiEvents
-    elif(midiSection != None and midiSection.label == "Root Folder" and recordType == 4 and identity == b'karT'):
-      s.pos = dataStart
-      s.read("bytes:4")
-      trackNameBlock = s.read("uintle:32")
-      trackId = s.read("uintle:32")
-      if(not trackId in trackLookup.keys() and trackNameBlock != 0):
-        trackLookup[trackId] = trackNameBlock
-        debugPrint("set key {} to {}".format(trackId, trackNameBlock))
-      debugPrint("trackNameBlock: {} ({}) trackId: {} ({})".format(trackNameBlock, hex(trackNameBlock), trackId, hex(trackId)))
-      
-def processFolder(s, midiSection, dataStart, dataLength):
-  s.pos = dataStart
-  folder = None
-  if(midiSection.label == "Root Folder"):
-    folder = rootFolder
-    folder.record = Record(midiSection.recordNumber, 0)
-  else:
-    # Find this section, it must be in the root folder
-    for thisFolder in rootFolder.folderContents:
-      if(thisFolder.record.recordNumber == midiSection.recordNumber):
-        folder = thisFolder
-      
-  # This must be a reference to an existing section    
-  if(folder == None):
-    debugPrint("Found folder by reference")
-    folder = rootFolder
-
-  while True:
-    # Read in the next command byte
-    midiCmd = s.read('uintle:8')
-    debugPrint('Command is {} ({})'.format(midiCmd, hex(midiCmd)))
-    
-    if (midiCmd == 0xF1):
-      debugPrint("Found end of buffer")
-      break
-  
-    if(midiCmd == 0x20):
-      # 0x00000050 | 20 00 00 00 40 44 03 00 00 00 00 00 00 05 00 80 | ....@D.......... |
-      # 0x00000060 | 64 00 00 00 01 00 00 89 00 00 00 00 FF FF FF 3F | d..............? |
-      # 0x00000070 | 1C 00 00 00 00 00 00 88 00 00 00 00 00 00 00 00 | ................ |
-      
-      s.read("bytes:3")
-      timeStamp = s.read('uintle:32')
-      s.read("bytes:8")
-      folderRecordNumber = s.read('uintle:32')
-      index = s.read('uintle:16') # might be 24 but that would be a lot of takes!
-      debugPrint("Index is {}".format(index))
-      s.read("bytes:10")
-      recordNumber = s.read('uintle:32')
-      debugPrint("Record number is {}".format(recordNumber))
-      s.read("bytes:44")
-      
-      newFolder = Folder(index)
-      newRecord = Record(recordNumber, timeStamp)
-      newFolder.record = newRecord
-      newFolder.folderRecordNumber = folderRecordNumber
-      folder.folderContents.append(newFolder)
-    elif (midiCmd & 0xF0 == 0x50): # Possibly some onscreen dial setup?
-      debugPrint("Found 0x5x, skipping")
-      s.read("bytes:15")
-    elif (midiCmd == 0x00):
-      debugPrint("Null block")
-      s.read("bytes:63")
-    elif (midiCmd == 0x24): # Audio section, skip for now
-      debugPrint("Found 0x24 audio section, skipping")
-      s.read("bytes:79")
-    else: # Unknown section, skip for now
-      debugPrint("Unknown command {}".format(midiCmd, hex(midiCmd)))
-      s.read("bytes:79")
-    
-    # Check we have not exceeded the length of the data in this block
-    bufferUsed = s.pos - dataStart
-    totalBufferSize = (dataLength * 8)
-    debugPrint("Buffer used so far: {} out of: {}".format(bufferUsed, totalBufferSize))
-    
-    if(bufferUsed > totalBufferSize):
-      quitWithError("ERROR: Went past end of buffer.")
-      
-    if(bufferUsed == totalBufferSize):
-      debugPrint("Used full buffer")
-      break  
-  
-def getRecord(recordNumber):
-  for topLevelFolder in rootFolder.folderContents:
-    if(topLevelFolder.record.recordNumber == recordNumber):
-      return topLevelFolder.record
-         
-      for subFolder in topLevelFolder.folderContents:
-        if(subFolder.record.recordNumber == recordNumber):
-          return subFolder.record
-      
-  return None
-
-def readTwoPartEvent(bitStream):
-  bitStream.read("bytes:3")
-  eventTime = bitStream.read("uintle:32")
-  bitStream.read("bytes:3")
-  eventValueA = bitStream.read("uintle:8")
-  eventValueB = bitStream.read("uintle:8")
-  debugPrint("eventValueA {}({}) eventValueB {}({})".format(eventValueA, hex(eventValueA), eventValueB, hex(eventValueB)))
-  bitStream.read("bytes:3")  
+def readTwoPartEvent(s, bTrace=False):
+  eventTime, eventValueA, eventValueB = s.unpack(TWO_PART_EVENT)
+  if(bTrace): trace("midi", "eventValueA {0}({0:#x}) eventValueB {1}({1:#x})", eventValueA, eventValueB)
   return TwoPartEvent(eventTime, eventValueA, eventValueB)
 
-def processMIDI(s, midiSection, baseTime, recordNumber, recordMidiID, dataStart, dataLength):
-  eventList = []
-  lastNoteEvent = None 
-  s.pos = dataStart
-  
-  sectionEnd = baseTime + midiSection.sectionLength
-  
-  while True:
-    # Read in the next command byte
-    midiCmd = s.read('uintle:8')
-    debugPrint('Command is {} ({})'.format(midiCmd, hex(midiCmd)))
-    
-    midiChl = midiCmd & 0x0F
-    
-    if(midiCmd >= 0x90 and midiCmd <= 0x9F): # Note on/off event
-      # 0x00000000 | 90 00 00 00 00 96 00 00 00 00 00 7D 24 00 00 00 | ...........}$...
-      # 0x00000010 | 80 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | ................
-      s.read("bytes:3")
-      noteStart = s.read("uintle:32")
-      s.read("bytes:3")      
-      midiEventNote = MIDIEventNote(*s.readlist('uintle:8, uintle:8'))
-      s.read("bytes:3")
-      s.read("bytes:7")
-      
-      midiCmd = s.read('uintle:8')
-      if(midiCmd >= 0x80 and midiCmd <= 0x8F): # Note Off event then set note duration event
-        # 0x00000580 | 40 00 00 00 00 00 00 89 00 00 00 00 F0 00 00 00 | @...............
-        # 0x00000590 | 00 00 00 00 00 00 00 A7 00 00 00 00 00 00 00 00 | ................
-        # 0x000005A0 | 90 00 00 00 53 BD 00 00 00 00 00 73 24 00 00 00 | ....S......s$...
-  
-        extendedBytes = s.read("uintle:32")
-        # Duration spans at least 3, probably 4 bytes.  We'll go for 4 for now!
-        midiEventNote.duration = s.read("uintle:32")
-        
-        if(baseTime is None):
-          baseTime = noteStart
-           
-        bAddNote = True
-        
-        sectionEnd = baseTime + midiSection.sectionLength
-        noteEnd = noteStart + midiEventNote.duration
-        
-        debugPrint(":Event time is {} logical section start is {} ({}) section length is {} basetime {} datastart {} dataLength {}".format(noteStart, midiSection.sectionStart, midiSection.sectionStart + baseTime, midiSection.sectionLength, baseTime, dataStart, dataLength))
-        debugPrint(":event is {} in to the section.  It goes from {} to {} and the end of the section is {}".format(noteStart-baseTime, noteStart, noteEnd, sectionEnd))
-        
-        # Try and work around duplicate note bug https://github.com/MarkCWirt/MIDIUtil/issues/24
-        if(lastNoteEvent is not None):
-          if(lastNoteEvent.note == midiEventNote.note and
-             lastNoteEvent.timeStamp == noteStart):
-             bAddNote = False
-        
-        if(noteStart >= sectionEnd):
-          debugPrint("Note starts at or past logical end of the section so ignoring it")
-          bAddNote = False        	      
-        elif(noteEnd > sectionEnd):
-          midiEventNote.duration = sectionEnd - noteStart
-          debugPrint("Duration corrected to {}".format(midiEventNote.duration))
-        
-        if(bAddNote):                    
-          eventList.append(MIDIEvent(MIDI_EVENT_NOTE, noteStart, midiChl, midiEventNote))
-          lastNoteEvent = LastNoteEvent(midiEventNote.note, noteStart)
-                      
-        if(extendedBytes > 0):
-          debugPrint('Found extended bytes {} '.format(hex(extendedBytes)))
-          
-      else: # Did not find expected 0x8x before note duration data
-        quitWithError('ERROR: Unknown command {} ({})'.format(midiCmd, hex(midiCmd)))
-    elif ((midiCmd >= 0x00 and midiCmd <= 0x0A) or midiCmd == 0xFF): # internal commands/screen elements?
-      # 00 00 00 00 00 00 01 B5 00 00 00 00 00 00 00 00. button on? 01 on 02 off
-      s.read('bytes:6')
-      midiCmd = s.read('uintle:8')
-      if (midiCmd != 0xA8 and midiCmd != 0xA7 and midiCmd != 0xB5):
-        debugPrint('WARN: Unknown command {} ({})'.format(midiCmd, hex(midiCmd)))            
-      s.read('bytes:8')
-    elif (midiCmd >= 0x20 and midiCmd <= 0x2F): # cc bank change
-      # 20 3D 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-      s.read("bytes:15")
-    elif (midiCmd == 0x40): # cc sustain ?
-      # 40 2F 01 00 00 00 00 A8 00 00 00 00 A2 83 00 00
-      s.read("bytes:15")
-    elif (midiCmd == 0x50): # cc general purpose controller, synth knobs 0x00-0x0b pads CA-CD
-      # 50 40 00 00 00 96 00 00 10 58 39 0E 00 01 00 01 # knob top left synth 00 
-      # 50 40 00 00 00 96 00 00 45 B6 D3 0C 01 01 00 01 # knob bottom left 01
-      # 50 40 00 00 00 96 00 00 00 00 00 7F 02 01 00 01 # knob top right 02
-      # 50 40 00 00 00 96 00 00 00 00 00 00 07 01 00 01 # knob bottom right 07
-      
-      thisEvent = readTwoPartEvent(s)
-    
-      # It feels like program change, e.g. patch change in synth is implemented like this but GB does not respond
-      # so disabling this for now.
-      if(False and thisEvent.valueB & 0xC0 == 0xC0):
-        ctrlChl = thisEvent.valueB & 0x0F
-        debugPrint("Adding program change")
-    elif (midiCmd >= 0x60 and midiCmd <= 0x6F): # Do not know what this is. Seen with Grand Piano, possibly where smart piano is being touched?
-      # 60 9B 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-      # Special case the start of a 48 byte block
-      if(dataLength == 48):
-        s.read("bytes:31")
-      else: 
-        s.read("bytes:15")
-    elif (midiCmd >= 0x70 and midiCmd <= 0x7F): # can be triggered by manually adding and moving percussion with smart drums while recording
-      # 70 00 00 00 00 96 00 00 00 00 00 01 36 00 00 00
-      # 09 00 02 06 00 00 00 A8 00 00 00 00 21 00 09 00            
-      s.read("bytes:31")
-    elif (midiCmd >= 0x80 and midiCmd <= 0x8F): # Do not know what this is. Seen with synth, not a note-off though as it uses the same bytes each time.
-      # 80 AE 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-      s.read("bytes:15")
-    elif (midiCmd >= 0xA0 and midiCmd <= 0xAF): # polyphonic key pressure unsupported in MIDIUtil API :(
-      # A0 11 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-      debugPrint("Polyphonic key pressure (unsupported) {}({})".format(midiCmd, hex(midiCmd)))
-      s.read("bytes:15")
-    elif (midiCmd >= 0xB0 and midiCmd <= 0xBF): # MIDI CC
-      # B0 40 00 00 5D 9D 00 00 00 00 00 00 40 00 00 01 cc sustain off 00 40 ch 0 40 is cc val
-      # B0 40 00 00 5D 9D 00 00 00 00 00 7F 40 00 00 01 cc sus on 7F 40 ch 0
-      # 0 (to 63) is off. 127 (to 64) is on.
-      # B0 40 00 00 40 9A 00 00 00 00 00 00 01 00 00 01 cc mod wheel zero
-      
-      thisEvent = readTwoPartEvent(s)
-      if(thisEvent.time > sectionEnd):
-        debugPrint("CC event starts ({}) past logical end of the section ({})".format(thisEvent.time, sectionEnd))
-      else:
-        eventList.append(MIDIEvent(MIDI_EVENT_CC, thisEvent.time, midiChl, MIDIEventCC(thisEvent.valueA, thisEvent.valueB)))
-    elif (midiCmd >= 0xC0 and midiCmd <= 0xCF): # Should be program change but don't think it is 
-      # C0 03 01 00 00 00 00 A8 00 00 00 00 A5 83 00 00
-      s.read("bytes:15")
-    elif (midiCmd >= 0xD0 and midiCmd <= 0xDF): # channel pressure
-      # D3 40 00 00 81 A1 00 00 00 00 00 00 00 00 00 01 channel pressure 0
-      # D5 40 00 00 C4 BA 00 00 00 00 00 1F 1F 00 00 01 channel pressure 1F
-      
-      thisEvent = readTwoPartEvent(s)
-
-      if(thisEvent.time > sectionEnd):
-        debugPrint("Pressure event starts ({}) past logical end of the section ({})".format(thisEvent.time, sectionEnd))
-      else:  
-        eventList.append(MIDIEvent(MIDI_EVENT_CHANNEL_PRESSURE, thisEvent.time, midiChl, MIDIEventPressure(thisEvent.valueA)))      
-    elif (midiCmd >= 0xE0 and midiCmd <= 0xEF): # pitch bend
-      # E8 40 00 00 19 A0 00 00 00 00 00 40 17 00 00 01 pitch bend ch 8 val 40 17
-      # E4 40 00 00 41 9A 00 00 00 00 00 40 00 00 00 01 pitch bend 0
-      
-      thisEvent = readTwoPartEvent(s)
-      
-      pb = 0
-      pb = (pb << 7) + (thisEvent.valueA & 0x7F)
-      pb = (pb << 7) + (thisEvent.valueB & 0x7F)
-      pitchWheelValue = -8192 + pb
-  
-      if(bOverridePitchBend):
-        pitchWheelValue *= pitchBendMultiplier
-        # Correct any overshoot
-        if(pitchWheelValue < -8192): pitchWheelValue = -8192
-        if(pitchWheelValue > 8191): pitchWheelValue = 8191
-        debugPrint("Adjusted pitchWheelValue is: {}({})".format(pitchWheelValue, hex(pitchWheelValue)))
-  
-      if(thisEvent.time > sectionEnd):
-        debugPrint("PitchWheel event starts past logical end of the section")
-      else:
-        eventList.append(MIDIEvent(MIDI_EVENT_PITCH_WHEEL, thisEvent.time, midiChl, MIDIEventPitchWheel(pitchWheelValue)))
-    elif (midiCmd == 0xF1):
-      debugPrint("Found end of buffer")
-      break
-    elif ((midiCmd >= 0x30 and midiCmd <= 0x3F) or
-           midiCmd == 0x11 or 
-           midiCmd == 0x12):
-      # These tend to be at the start of blocks we are not interested in
-      debugPrint("Unknown bytes: {}".format(hex(midiCmd)))
-      break
-    else:
-      # Not seen this command byte before so dump some context for debugging
-      # purposes then exit
-      s.pos -= (96 * 8)
-      dumphex(100, s)
-      quitWithError("Unrecognised command: {}".format(midiCmd))
-      break # Unreachable
-  
-    # Check we have not exceeded the length of the data in this block
-    bufferUsed = s.pos - dataStart
-    totalBufferSize = (dataLength * 8)
-    debugPrint("Buffer used so far: {} out of: {}".format(bufferUsed, totalBufferSize))
-    
-    if(bufferUsed > totalBufferSize):
-      quitWithError("ERROR: Went past end of buffer.")
-      
-    if(bufferUsed == totalBufferSize):
-      debugPrint("Used full buffer")
-      break
-  return eventList
-
-trackCounter = 0
-trackDict = dict()
-recordHash = dict()
-
 try:
   import dialogs
   import console
   bIsPythonista = True
-  debugPrint("Running inside of Pythonista")
+  trace("main", "Running inside of Pythonista")
 except:
   bIsPythonista = False
-  debugPrint("Running outside of Pythonista")
-
-if bIsPythonista: 
-  # Show iOS file picker to select GB file
-  fp = dialogs.pick_document(types=["public.item"])
-elif os.name == 'nt':# If the OS is Windows
-  root=tk.Tk()
-  root.withdraw()
-  fp = filedialog.askopenfilename().replace('/projectData','') # Select the Project Data file for Windows as it opens up the folder
-  debugPrint(fp)
-else:
-  if(len(sys.argv) == 2):
-    fp = sys.argv[1]
+  trace("main", "Running outside of Pythonista")
+
+# Ask the user for the project to extract, unless projectPath was given on the
+# command line.  Returns the path to the project.band directory
+def selectProject(projectPath):
+  fp = None
+  if bIsPythonista:
+    # Show iOS file picker to select GB file
+    fp = dialogs.pick_document(types=["public.item"])
+  elif os.name == 'nt':# If the OS is Windows
+    root=tk.Tk()
+    root.withdraw()
+    fp = filedialog.askopenfilename().replace('/projectData','') # Select the Project Data file for Windows as it opens up the folder
+    trace("main", "Selected {}", fp)
   else:
-    quitWithError("ERROR: Expects a single argument which is the path to the GB project.band directory")
+    if(projectPath is not None):
+      fp = projectPath
+    else:
+      quitWithError("ERROR: Expects a single argument which is the path to the GB project.band directory, or \"batch\" followed by a directory of projects")
 
-if (fp != None):
-  projectName = os.path.splitext(os.path.basename(fp))[0]
-  pathToGBFile = os.path.join(fp, "projectData")
-else:
-  quitWithError("ERROR: No file selected.")
+  if (fp == None):
+    quitWithError("ERROR: No file selected.")
+  return fp
 
-WORKING_DIR = os.path.join(ROOT_DIR, "{}_{}".format(time.strftime("%Y%m%d-%H%M%S"), projectName))
+# Extract everything that is enabled by the user-configurable parameters from
+# the project at gbPath into workingDir, which is a directory path or an output
+# sink.  The views and a TrackFilter may be given to override outputViews,
+# includeTracks and excludeTracks, bStream to override bStreamTracks, workers
+# to override renderWorkers and bCache to override bCacheModels.  The metrics
+# of the extraction are added to metrics, if given, which is also the metrics
+# of the project that is returned.
+def extractProject(gbPath, workingDir, views=None, trackFilter=None, bStream=None, metrics=None, workers=None, bCache=None):
+  views = views if views is not None else outputViews
+  workers = renderWorkers if workers is None else workers
+  bCache = bCacheModels if bCache is None else bCache
+  trackFilter = trackFilter or createTrackFilter(includeTracks, excludeTracks)
+  bStream = bStreamTracks if bStream is None else bStream
+  bKeepDecodedData = bDumpDecodedData or bDumpFile
+  project = GBProject.open(gbPath, bKeepDecodedData=bKeepDecodedData, modelCache=createModelCache() if bCache and not bStream else None,
+                           trackFilter=trackFilter, bStream=bStream, metrics=metrics)
+  metrics = project.metrics
+  try:
+    project.countModel(metrics)
+    if(bDumpDecodedData):
+      project.dumpDecodedData(workingDir)
 
-canBePrinted = bytes(string.ascii_letters + string.digits + string.punctuation, 'ascii')
+    project.debugPrintModel()
+
+    if(bExtractAudio):
+      with metrics.phase("audio"):
+        project.extractAudio(workingDir)
+
+    with metrics.phase("render"):
+      if(bStream):
+        project.streamTracks(workingDir, workers, views=views, trackFilter=trackFilter)
+      else:
+        project.dumpAll(workingDir, workers, views=views, trackFilter=trackFilter)
+      if(isinstance(workingDir, DirectorySink)):
+        workingDir.flush()
+  finally:
+    if(bStream and not bKeepDecodedData):
+      project.closeStream()
+  # Files are only removed by extractions that write every view and track, so
+  # that extracting some of them leaves the rest alone
+  if(isinstance(workingDir, IncrementalSink) and views is None and trackFilter is None):
+    with metrics.phase("removeStaleOutputs"):
+      workingDir.removeStaleOutputs()
+  return project
+
+# Returns the sorted paths of the .band directories under rootDir.  The
+# contents of a project are not searched
+def findProjects(rootDir):
+  if(rootDir.endswith(".band") and os.path.isdir(rootDir)):
+    return [rootDir]
+
+  projects = []
+  for dirPath, dirNames, fileNames in os.walk(rootDir):
+    for dirName in list(dirNames):
+      if(dirName.endswith(".band")):
+        projects.append(os.path.join(dirPath, dirName))
+        dirNames.remove(dirName)
+  projects.sort()
+  return projects
+
+# Extract one project of a batch.  Runs in a worker process so everything the
+# project prints goes to the log file in its own output directory and errors
+# are returned rather than raised, so one bad project does not stop the batch.
+# The metrics report of the project is returned if bMetrics is set.
+def extractBatchProject(task):
+  gbPath, workingDir, format, bIncremental, views, trackFilter, bMetrics, bStream, bCache = task
+  startTime = time.time()
+  metrics = Metrics()
+  errorString = None
+  try:
+    sink = createOutputSink(os.path.dirname(workingDir), os.path.basename(workingDir), format, bIncremental=bIncremental)
+    try:
+      # Archives get the log added once the project has been extracted
+      if(isinstance(sink, DirectorySink)):
+        logFile = open(os.path.join(workingDir, "GB_Extract_Log.txt"), "w")
+      else:
+        logFile = io.StringIO()
+      with contextlib.redirect_stdout(logFile):
+        try:
+          extractProject(gbPath, sink, views, trackFilter, bStream, metrics, bCache=bCache)
+        except GBExtractorError as ex:
+          errorString = str(ex)
+        except Exception as ex:
+          errorString = "{}: {}".format(type(ex).__name__, ex)
+        print(errorString if errorString else "File processing complete")
+      if(isinstance(logFile, io.StringIO)):
+        sink.addFile([], "GB_Extract_Log.txt", logFile.getvalue().encode("utf-8"))
+      logFile.close()
+    finally:
+      sink.close()
+  except (GBExtractorError, OSError, zipfile.BadZipFile, tarfile.TarError) as ex:
+    errorString = errorString or str(ex)
+  flushTrace()
+  report = None
+  if(bMetrics):
+    report = metrics.getReport(os.path.splitext(os.path.basename(gbPath))[0])
+    report["path"] = gbPath
+    report["error"] = errorString
+  return (gbPath, errorString, time.time() - startTime, report)
+
+# Add the option that turns on the model cache
+def addCacheArgument(parser):
+  parser.add_argument("--cache", action="store_true", default=bCacheModels, help="cache the parsed projects in {}, so that extracting them again is faster".format(modelCacheDir or "the user cache directory"))
 
-createAndChDir(WORKING_DIR)
+# Add the options that choose which views and tracks are written
+def addSelectionArguments(parser):
+  parser.add_argument("--view", action="append", dest="views", choices=VIEW_NAMES, help="only write this view, may be given more than once")
+  parser.add_argument("--track", action="append", dest="includeTracks", metavar="TRACK", help="only write the tracks with this number or name, or whose name matches this regular expression, may be given more than once")
+  parser.add_argument("--exclude-track", action="append", dest="excludeTracks", metavar="TRACK", help="do not write the tracks with this number, name or regular expression, may be given more than once")
 
-# Should we redirect stdout to a log file?
-if bWriteToFile:
+# Returns the views and TrackFilter chosen by the options added by
+# addSelectionArguments(), or None for those that were not given
+def getSelection(options):
+  return options.views, createTrackFilter(options.includeTracks, options.excludeTracks)
+
+# Extract every .band project under a directory.  Each project is written to
+# a directory under the output directory that mirrors its path under the
+# input directory, and projects are shared between a pool of worker processes.
+def batchMain(args):
+  parser = argparse.ArgumentParser(prog="gbextractor.py batch", description="Extract every GarageBand project under a directory")
+  parser.add_argument("inputDir", help="directory to search for .band projects")
+  parser.add_argument("outputDir", nargs="?", help="directory to write to, by default a new directory in the current directory")
+  parser.add_argument("-j", "--workers", type=int, default=batchWorkers or os.cpu_count() or 1, help="number of projects to extract at the same time")
+  parser.add_argument("-f", "--format", choices=["directory", "zip", "tar"], default=outputFormat, help="write each project to a directory, zip file or tar file")
+  parser.add_argument("-i", "--incremental", action="store_true", default=bIncremental, help="update the directories written by an earlier run, only writing files whose sections have changed")
+  parser.add_argument("--metrics", action="store_true", default=bWriteMetrics, help="write the timings and counters of every project to {} in the output directory".format(BATCH_METRICS_NAME))
+  parser.add_argument("--stream", action="store_true", default=bStreamTracks, help="decode and write a few tracks at a time, so that large projects need less memory")
+  addCacheArgument(parser)
+  addSelectionArguments(parser)
+  options = parser.parse_args(args)
+  views, trackFilter = getSelection(options)
+
+  inputDir = os.path.normpath(options.inputDir)
+  projects = findProjects(inputDir)
+  if(not projects):
+    quitWithError("ERROR: No .band projects found in {}".format(inputDir))
+
+  outputDir = options.outputDir
+  if(outputDir is None):
+    outputDir = os.path.join(os.getcwd(), "{}_batch".format(time.strftime("%Y%m%d-%H%M%S")))
+  tasks = []
+  for gbPath in projects:
+    relativePath = os.path.relpath(gbPath, inputDir)
+    if(relativePath == os.curdir):
+      relativePath = os.path.basename(gbPath)
+    tasks.append((gbPath, os.path.join(outputDir, os.path.splitext(relativePath)[0]), options.format, options.incremental, views, trackFilter, options.metrics, options.stream, options.cache))
+
+  workers = max(1, min(options.workers, len(tasks)))
+  print("Extracting {} projects to {} with {} workers".format(len(tasks), outputDir, workers))
+  startTime = time.time()
+  batchMetrics = Metrics()
+  reports = []
+  failures = []
+  if(workers == 1):
+    results = map(extractBatchProject, tasks)
+    pool = None
+  else:
+    pool = multiprocessing.Pool(workers)
+    results = pool.imap_unordered(extractBatchProject, tasks)
+  try:
+    for count, (gbPath, errorString, elapsed, report) in enumerate(results, 1):
+      print("[{}/{}] {} {} ({:.2f}s)".format(count, len(tasks), "FAILED" if errorString else "OK", gbPath, elapsed))
+      if(errorString):
+        failures.append((gbPath, errorString))
+      if(report is not None):
+        reports.append(report)
+  finally:
+    if(pool is not None):
+      pool.close()
+      pool.join()
+
+  if(options.metrics):
+    batchMetrics.count("projects", len(tasks))
+    batchMetrics.count("projectsFailed", len(failures))
+    batchReport = batchMetrics.getReport()
+    batchReport["workers"] = workers
+    batchReport["projects"] = sorted(reports, key=lambda report: report["path"])
+    metricsPath = os.path.join(outputDir, BATCH_METRICS_NAME)
+    try:
+      createPath(outputDir)
+      with open(metricsPath, "w") as metricsFile:
+        json.dump(batchReport, metricsFile, indent=2)
+    except OSError:
+      print("ERROR: Could not write {}".format(metricsPath))
+
+  print("Extracted {} of {} projects in {:.2f}s".format(len(tasks) - len(failures), len(tasks), time.time() - startTime))
+  for gbPath, errorString in failures:
+    print("  {}: {}".format(gbPath, errorString))
+  if(failures):
+    sys.exit(1)
+
+# Parse a decimal or 0x prefixed hexadecimal number from the command line
+def parseNumber(value):
+  return int(value, 0)
+
+# Write an annotated hex dump of the decoded data of a project, or of a file
+# written by bDumpDecodedData, for working out the format of new records
+def inspectMain(args):
+  parser = argparse.ArgumentParser(prog="gbextractor.py inspect", description="Write an annotated hex dump of the decoded data of a GarageBand project")
+  parser.add_argument("project", help="the project.band directory, its projectData file or a decoded.bin file")
+  parser.add_argument("-o", "--output", help="file to write the dump to, by default standard output")
+  parser.add_argument("--offset", type=parseNumber, default=0, help="offset of the first byte to dump, which may be given in hex as 0x...")
+  parser.add_argument("--length", type=parseNumber, help="number of bytes to dump, by default up to the end")
+  parser.add_argument("--no-annotate", dest="bAnnotate", action="store_false", help="do not find the records to annotate the dump with")
+  options = parser.parse_args(args)
+
+  try:
+    if(os.path.isdir(options.project)):
+      decodedData = readProjectData(os.path.join(options.project, "projectData"))
+    elif(os.path.basename(options.project) == "projectData"):
+      decodedData = readProjectData(options.project)
+    else:
+      with open(options.project, "rb") as decodedFile:
+        decodedData = decodedFile.read()
+  except OSError as ex:
+    quitWithError("ERROR: Could not read {}: {}".format(options.project, ex.strerror))
+  except GBExtractorError as ex:
+    quitWithError(str(ex))
+
+  recordMap = RecordMap(decodedData) if options.bAnnotate else None
+  try:
+    output = open(options.output, "w") if options.output else sys.stdout
+  except OSError as ex:
+    quitWithError("ERROR: Could not create {}: {}".format(options.output, ex.strerror))
+  try:
+    with output if options.output else contextlib.nullcontext():
+      writeHexDump(output, decodedData, options.offset, options.length, recordMap)
+  except BrokenPipeError:
+    # The dump was piped to a command such as head which has stopped reading
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return
+  except OSError as ex:
+    quitWithError("ERROR: Could not write the hex dump: {}".format(ex.strerror))
+  if(options.output):
+    print("Wrote a hex dump of {} to {}{}".format(options.project, options.output,
+          ", {} records found".format(len(recordMap.records)) if recordMap else ""))
+
+def main():
+  if(not bIsPythonista and len(sys.argv) > 1 and sys.argv[1] == "batch"):
+    batchMain(sys.argv[2:])
+    return
+  if(not bIsPythonista and len(sys.argv) > 1 and sys.argv[1] == "inspect"):
+    inspectMain(sys.argv[2:])
+    return
+
+  views = trackFilter = projectPath = None
+  bMetrics = bWriteMetrics
+  bStream = bStreamTracks
+  bCache = bCacheModels
+  if(not bIsPythonista):
+    parser = argparse.ArgumentParser(prog="gbextractor.py", description="Extract the MIDI in a GarageBand project",
+                                     epilog="Use \"gbextractor.py batch -h\" for extracting a directory of projects and \"gbextractor.py inspect -h\" for hex dumps")
+    parser.add_argument("project", nargs="?", help="the project.band directory")
+    parser.add_argument("--metrics", action="store_true", default=bWriteMetrics, help="write the timings and counters of the extraction to {} in the output".format(METRICS_NAME))
+    parser.add_argument("--stream", action="store_true", default=bStreamTracks, help="decode and write a few tracks at a time, so that large projects need less memory")
+    addCacheArgument(parser)
+    addSelectionArguments(parser)
+    options = parser.parse_args(sys.argv[1:])
+    projectPath = options.project
+    bMetrics = options.metrics
+    bStream = options.stream
+    bCache = options.cache
+    views, trackFilter = getSelection(options)
+
+  fp = selectProject(projectPath)
+  metrics = Metrics()
+  projectName = os.path.splitext(os.path.basename(fp))[0]
+  # Incremental output is updated in place so its name does not change
+  bIncrementalOutput = bIncremental and outputFormat == "directory"
+  if(bIncrementalOutput):
+    workingName = projectName
+  else:
+    workingName = "{}_{}".format(time.strftime("%Y%m%d-%H%M%S"), projectName)
+
+  try:
+    if(outputFormat == "directory" and not bIncrementalOutput):
+      createDir(os.path.join(os.getcwd(), workingName))
+    sink = createOutputSink(os.getcwd(), workingName, bTarToStdout=not bIsPythonista, bIncremental=bIncrementalOutput)
+  except GBExtractorError as ex:
+    quitWithError(str(ex))
+
+  # A tar stream is written to stdout so messages go to stderr instead
   origStdout = sys.stdout
-  newStdout = open("GB_Extract_Log.txt", 'w')
-  sys.stdout = newStdout
+  if(outputFormat == "tar" and not bIsPythonista):
+    origStdout = sys.stdout = sys.stderr
+
+  # Should we redirect stdout to a log file?  Archives get the log added at
+  # the end
+  if bWriteToFile:
+    if(isinstance(sink, DirectorySink)):
+      newStdout = open(os.path.join(sink.rootDir, "GB_Extract_Log.txt"), 'w')
+    else:
+      newStdout = io.StringIO()
+    sys.stdout = newStdout
+
+  # If anything goes wrong the sink is aborted, so an unfinished archive is
+  # deleted rather than left behind
+  try:
+    try:
+      project = extractProject(fp, sink, views, trackFilter, bStream, metrics, bCache=bCache)
+    except GBExtractorError as ex:
+      quitWithError(str(ex))
   
-if os.path.exists(pathToGBFile):
-  parseDataFile = ET.parse(pathToGBFile)
-  xmlRoot = parseDataFile.getroot()
-else:
-  quitWithError("ERROR: File does not exist: {}".format(pathToGBFile))
-
-# Decode the base64 data in the projectData file
-nsData = xmlRoot.find(".//*[key='NS.data']/data")
-encodedText = nsData.text
-try:
-  decodedData = base64.b64decode(encodedText)
-  with open("decoded.bin","wb") as binOut:
-    binOut.write(decodedData)
-except Exception as ex:
-  print(str(ex))
-  quitWithError("ERROR: Failed to decode data")
-
-# Open the decoded binary file for parsing
-s = ConstBitStream(filename='decoded.bin')
-s.pos = 0
-
-if bDebug: dumphex(0x800, s)
-
-# Pull out the tempo, offset is number of BITS
-s.pos = TEMPO_OFFSET
-preciseBPM = s.read('uintle:24')
-songTempo = preciseBPM/10000
-debugPrint("Tempo BPM is {} ({})".format(songTempo, hex(preciseBPM)))
-
-# Pull out the time signature 
-s.pos = TIME_SIGNATURE_OFFSET
-numerator = s.read('uintle:8')
-denominator = s.read('uintle:8')
-debugPrint("Time signature is {}/{}".format(numerator, 2**denominator))
-
-durationAsTicks = millisecondsToTicks(songTempo, durationMin)
-
-# Generate an ordered list of offsets pointing to bits of the 
-# binary data that we are interested in
-offset_list = list(s.findall('0x71537645', bytealigned = True)) #qSvE
-offset_list.extend(list(s.findall('0x7165534D', bytealigned = True))) #qeSM
-offset_list.extend(list(s.findall('0x71537854', bytealigned = True))) #qSxT
-
-offset_list.extend(list(s.findall('0x6B617254', bytealigned = True)))
-offset_list.extend(list(s.findall('0x74536e49', bytealigned = True)))
-offset_list.extend(list(s.findall('0x74537854', bytealigned = True)))
-offset_list.extend(list(s.findall('0x69766e45', bytealigned = True)))
-sorted_offset_list = sorted(offset_list)
-
-processOffsetList(s)
-
-associateMIDIEvents(recordHash)
-
-debugPrint("trackLookup items:")
-for key, lookup in trackLookup.items():
-  debugPrint("key {} lookup {}".format(key, lookup))
-
-debugPrint("trackNameLookup items:")
-for key, lookup in trackNameLookup.items():
-  debugPrint("key {} lookup {}".format(key, lookup))
-
-debugPrint("Root folder:")
-for thisFolder in rootFolder.folderContents:
-  debugPrint("  Top level folder: idx {} record number {} folder id {} trackName {}".format(thisFolder.index, thisFolder.record.recordNumber, thisFolder.folderRecordNumber, thisFolder.trackName))
-  for subFolder in thisFolder.folderContents:
-    debugPrint("   Sub Folder: idx {} record number {} folder id {} trackName {}".format(subFolder.index, subFolder.record.recordNumber, subFolder.folderRecordNumber, subFolder.trackName))
-
-if(bExtractAudio):
-  extractAudio(fp)
-
-dumpTracks()
-dumpSong()
-dumpTrackStems()
-
-if(bEnableCutUp):
-  dumpCutUps()
-
-dumpSectionStems()
-dumpSections()
-
-if(bFilterNotes):
-  dumpSectionsFiltered()
-
-if(bDumpFile):
-  s.pos = 0
-  fileSize = os.path.getsize('decoded.bin')
-  debugPrint("fileSize is {}".format(fileSize))
-  dumphex(fileSize, s)
-
-if bWriteToFile:
-  newStdout.close()
-  sys.stdout = origStdout
-
-if bIsPythonista:
-  console.hud_alert("File processing complete", 'success', 1)
-else:
-  print("File processing complete")
+    if(bDumpFile):
+      fileSize = len(project.decodedData)
+      trace("main", "fileSize is {}", fileSize)
+      writeHexDump(sys.stdout, project.decodedData, recordMap=RecordMap(project.decodedData))
+
+    if bWriteToFile:
+      if(isinstance(newStdout, io.StringIO)):
+        sink.addFile([], "GB_Extract_Log.txt", newStdout.getvalue().encode("utf-8"))
+      newStdout.close()
+      sys.stdout = origStdout
+    if(bMetrics):
+      writeMetrics(sink, projectName, metrics)
+  except BaseException:
+    sink.abort()
+    raise
+  try:
+    sink.close()
+  except GBExtractorError as ex:
+    quitWithError(str(ex))
+
+  if bIsPythonista:
+    console.hud_alert("File processing complete", 'success', 1)
+  else:
+    print("File processing complete")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,94 @@
+# Checks that exportAudio() only copies the audio that has changed since the
+# last export to the same directory and that the copies of audio that has been
+# removed from the project are deleted.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import json
+import time
+import zipfile
+import contextlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import gbextractor
+
+class AudioExportTest(unittest.TestCase):
+  def setUp(self):
+    self.tempDir = tempfile.TemporaryDirectory()
+    self.sourceDir = os.path.join(self.tempDir.name, "source")
+    self.rootDir = os.path.join(self.tempDir.name, "output")
+    os.makedirs(self.sourceDir)
+    os.makedirs(self.rootDir)
+    self.settings = gbextractor.getSettings()
+    gbextractor.bSkipUnchangedAudio = True
+    gbextractor.bCompressAudio = True
+
+  def tearDown(self):
+    gbextractor.applySettings(self.settings)
+    self.tempDir.cleanup()
+
+  # Returns the audio file list entry for a source file with the given data
+  def addSource(self, filename, data):
+    sourcePath = os.path.join(self.sourceDir, filename)
+    with open(sourcePath, "wb") as sourceFile:
+      sourceFile.write(data)
+    return (["audio", "media"], filename, sourcePath)
+
+  # Run exportAudio() and return what it printed
+  def export(self, audioFiles, bIncrementalOutput=True):
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+      gbextractor.exportAudio(self.rootDir, audioFiles, bIncrementalOutput)
+    return log.getvalue()
+
+  def readZip(self):
+    with zipfile.ZipFile(os.path.join(self.rootDir, "audio.zip")) as audioZip:
+      return {name: audioZip.read(name) for name in audioZip.namelist()}
+
+  def readManifest(self):
+    with open(os.path.join(self.rootDir, gbextractor.AUDIO_MANIFEST_NAME)) as manifestFile:
+      return json.load(manifestFile)
+
+  def testUnchanged(self):
+    audioFiles = [self.addSource("a.wav", b"a" * 100), self.addSource("b.wav", b"b" * 100)]
+    self.assertIn("2 audio files, 0 unchanged", self.export(audioFiles))
+    zipState = gbextractor.getFileState(os.path.join(self.rootDir, "audio.zip"))
+    self.assertIn("2 audio files, 2 unchanged", self.export(audioFiles))
+    self.assertEqual(gbextractor.getFileState(os.path.join(self.rootDir, "audio.zip")), zipState)
+    self.assertEqual(self.readZip(), {"media/a.wav": b"a" * 100, "media/b.wav": b"b" * 100})
+
+  def testChanged(self):
+    audioFiles = [self.addSource("a.wav", b"a" * 100), self.addSource("b.wav", b"b" * 100)]
+    self.export(audioFiles)
+    time.sleep(0.01)
+    self.addSource("b.wav", b"c" * 100)
+    self.assertIn("2 audio files, 1 unchanged", self.export(audioFiles))
+    with open(os.path.join(self.rootDir, "audio", "media", "b.wav"), "rb") as copyFile:
+      self.assertEqual(copyFile.read(), b"c" * 100)
+    self.assertEqual(self.readZip(), {"media/a.wav": b"a" * 100, "media/b.wav": b"c" * 100})
+
+  def testRemoved(self):
+    audioFiles = [self.addSource("a.wav", b"a" * 100), self.addSource("b.wav", b"b" * 100)]
+    self.export(audioFiles)
+    self.assertIn("1 audio files, 1 unchanged, 1 removed", self.export(audioFiles[:1]))
+    self.assertFalse(os.path.exists(os.path.join(self.rootDir, "audio", "media", "b.wav")))
+    self.assertEqual(self.readZip(), {"media/a.wav": b"a" * 100})
+    self.assertEqual(list(self.readManifest()["files"]), ["audio/media/a.wav"])
+
+  def testAllRemoved(self):
+    self.export([self.addSource("a.wav", b"a" * 100)])
+    self.export([])
+    self.assertEqual(os.listdir(self.rootDir), [])
+
+  # A new directory that is not extracted to again does not get a manifest
+  def testNoManifest(self):
+    self.export([self.addSource("a.wav", b"a" * 100)], False)
+    self.assertEqual(sorted(os.listdir(self.rootDir)), ["audio", "audio.zip"])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,111 @@
+# Checks that an IncrementalSink leaves the files of an earlier extraction that
+# are still current alone, deletes the ones that are no longer made and only
+# records the keys of the files that it has written.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import json
+import contextlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+# Returns the paths of the files under rootDir, apart from the manifest
+def listFiles(rootDir):
+  files = set()
+  for dirPath, dirNames, fileNames in os.walk(rootDir):
+    for fileName in fileNames:
+      if(fileName != gbextractor.OUTPUT_MANIFEST_NAME):
+        files.add(os.path.relpath(os.path.join(dirPath, fileName), rootDir).replace(os.sep, "/"))
+  return files
+
+def loadManifest(rootDir):
+  with open(os.path.join(rootDir, gbextractor.OUTPUT_MANIFEST_NAME)) as manifestFile:
+    return json.load(manifestFile)["outputs"]
+
+class IncrementalSinkTest(unittest.TestCase):
+  def setUp(self):
+    self.tempDir = tempfile.TemporaryDirectory()
+    self.gbPath = os.path.join(self.tempDir.name, "Incremental.band")
+    self.outputDir = os.path.join(self.tempDir.name, "output")
+    self.settings = gbextractor.getSettings()
+    gbextractor.bExtractAudio = False
+    gbextractor.bEnableCutUp = True
+
+  def tearDown(self):
+    gbextractor.applySettings(self.settings)
+    self.tempDir.cleanup()
+
+  # Extract the project into sink, or an IncrementalSink of outputDir, and
+  # return what was printed
+  def extract(self, sink=None, views=None):
+    sink = sink or gbextractor.IncrementalSink(self.outputDir)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+      gbextractor.extractProject(self.gbPath, sink, views=views, workers=1)
+    sink.close()
+    return log.getvalue()
+
+  def testUnchanged(self):
+    generate.generateProject(self.gbPath, tracks=2, sections=4, takes=2, events=100)
+    self.extract()
+    files = listFiles(self.outputDir)
+    manifest = loadManifest(self.outputDir)
+    self.assertEqual(set(manifest), files)
+    for outputPath in files:
+      os.utime(os.path.join(self.outputDir, *outputPath.split("/")), (1000, 1000))
+    log = self.extract()
+    self.assertIn("{} files unchanged, 0 removed".format(len(files)), log)
+    self.assertEqual(loadManifest(self.outputDir), manifest)
+    for outputPath in files:
+      self.assertEqual(os.path.getmtime(os.path.join(self.outputDir, *outputPath.split("/"))), 1000)
+
+  # The files of a track that has gone are deleted, leaving the same files as
+  # extracting the new project from scratch
+  def testStale(self):
+    generate.generateProject(self.gbPath, tracks=3, sections=4, takes=2, events=100)
+    self.extract()
+    oldFiles = listFiles(self.outputDir)
+    generate.generateProject(self.gbPath, tracks=2, sections=4, takes=2, events=100)
+    log = self.extract()
+    freshDir = os.path.join(self.tempDir.name, "fresh")
+    self.extract(gbextractor.DirectorySink(freshDir))
+    files = listFiles(self.outputDir)
+    self.assertEqual(files, listFiles(freshDir))
+    self.assertLess(len(files), len(oldFiles))
+    self.assertIn("{} removed".format(len(oldFiles - files)), log)
+    self.assertEqual(set(loadManifest(self.outputDir)), files)
+
+  # Extracting some of the views does not remove the others
+  def testSomeViews(self):
+    generate.generateProject(self.gbPath, tracks=3, sections=4, takes=2, events=100)
+    self.extract()
+    files = listFiles(self.outputDir)
+    generate.generateProject(self.gbPath, tracks=2, sections=4, takes=2, events=100)
+    log = self.extract(views=["song"])
+    self.assertNotIn("removed", log)
+    self.assertEqual(listFiles(self.outputDir), files)
+
+  # A file that was not written is left out of the manifest, so it is not
+  # taken to be current next time
+  def testUnwritten(self):
+    sink = gbextractor.IncrementalSink(self.outputDir)
+    self.assertFalse(sink.isCurrent(["full"], "Written.mid", "a"))
+    sink.addFile(["full"], "Written.mid", b"MThd")
+    self.assertFalse(sink.isCurrent(["full"], "Unwritten.mid", "b"))
+    sink.close()
+    self.assertEqual(loadManifest(self.outputDir), {"full/Written.mid": "a"})
+    sink = gbextractor.IncrementalSink(self.outputDir)
+    self.assertTrue(sink.isCurrent(["full"], "Written.mid", "a"))
+    self.assertFalse(sink.isCurrent(["full"], "Written.mid", "c"))
+    self.assertFalse(sink.isCurrent(["full"], "Unwritten.mid", "b"))
+
+if __name__ == "__main__":
+  unittest.main()
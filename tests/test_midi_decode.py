@@ -0,0 +1,101 @@
+# Checks that the NumPy decoder, decodeMIDIBlock(), gives the same events as
+# decoding one event at a time with GBProject.processMIDI(), including
+# dropping repeated notes and clipping notes at the end of the section.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import types
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+# Returns the two 16 byte rows of a note
+def createNote(channel, timeStamp, velocity, pitch, duration):
+  event = bytearray(32)
+  event[0] = 0x90 | channel
+  event[4:8] = struct.pack("<I", timeStamp)
+  event[11] = velocity
+  event[12] = pitch
+  event[16] = 0x80
+  event[23] = 0x89
+  event[28:32] = struct.pack("<I", duration)
+  return bytes(event)
+
+# Returns the row of a CC, channel pressure or pitch bend event
+def createTwoPartEvent(command, timeStamp, valueA, valueB=0):
+  event = bytearray(16)
+  event[0] = command
+  event[4:8] = struct.pack("<I", timeStamp)
+  event[11] = valueA
+  event[12] = valueB
+  return bytes(event)
+
+def getColumns(eventList):
+  return [list(getattr(eventList, name)) for name, typeCode in gbextractor.EVENT_STORE_COLUMNS]
+
+@unittest.skipIf(gbextractor.np is None, "needs NumPy")
+class DecodeMIDIBlockTest(unittest.TestCase):
+  def setUp(self):
+    self.settings = gbextractor.getSettings()
+
+  def tearDown(self):
+    gbextractor.applySettings(self.settings)
+
+  # Decode data both ways, as a section of sectionLength ticks from baseTime
+  def checkBlock(self, data, baseTime, sectionLength):
+    eventList = gbextractor.decodeMIDIBlock(data, 0, len(data), baseTime + sectionLength)
+    self.assertIsNotNone(eventList)
+    gbextractor.bVectorizedMIDI = False
+    project = gbextractor.GBProject("Test")
+    project.decodedData = data
+    midiSection = types.SimpleNamespace(sectionStart=0, sectionLength=sectionLength)
+    expected = project.processMIDI(gbextractor.createReader(data), midiSection, baseTime, 1, 10, 0, len(data))
+    self.assertEqual(getColumns(eventList), getColumns(expected))
+    return eventList
+
+  def testRepeatedNotes(self):
+    data = (createNote(0, 1000, 100, 60, 200) + createNote(0, 1000, 90, 60, 300) +
+            createNote(1, 1000, 80, 64, 200) + createNote(0, 1200, 70, 60, 100) +
+            createNote(0, 1200, 70, 60, 100))
+    eventList = self.checkBlock(data, 1000, 5000)
+    self.assertEqual(list(eventList.data2), [60, 64, 60])
+    self.assertEqual(list(eventList.data1), [100, 80, 70])
+
+  def testSectionEnd(self):
+    data = (createNote(0, 1000, 100, 60, 500) + createNote(0, 1800, 100, 62, 500) +
+            createTwoPartEvent(0xB0, 1900, 7, 64) + createTwoPartEvent(0xD1, 2000, 50) +
+            createTwoPartEvent(0xE2, 2001, 0x40, 0x10) + createNote(0, 2000, 100, 64, 10))
+    eventList = self.checkBlock(data, 1000, 1000)
+    self.assertEqual(list(eventList.values)[:2], [500, 200])
+
+  def testPitchBendMultiplier(self):
+    gbextractor.bOverridePitchBend = True
+    gbextractor.pitchBendMultiplier = 3
+    data = b"".join(createTwoPartEvent(0xE0, 1000 + i, i * 8, 127 - i) for i in range(0, 16))
+    self.checkBlock(data, 1000, 5000)
+
+  # Every block of a generated project, which has repeated notes and notes
+  # past the end of their sections, is decoded the same way
+  def testGeneratedProject(self):
+    with tempfile.TemporaryDirectory() as tempDir:
+      gbPath = os.path.join(tempDir, "Decode.band")
+      generate.generateProject(gbPath, tracks=2, sections=4, takes=2, events=300)
+      projects = []
+      for bVectorizedMIDI in (True, False):
+        gbextractor.bVectorizedMIDI = bVectorizedMIDI
+        projects.append(gbextractor.GBProject.open(gbPath))
+    records = sorted(projects[0].recordIndex)
+    self.assertEqual(sorted(projects[1].recordIndex), records)
+    for recordNumber in records:
+      self.assertEqual(getColumns(projects[0].getRecord(recordNumber).midiEvents),
+                       getColumns(projects[1].getRecord(recordNumber).midiEvents))
+
+if __name__ == "__main__":
+  unittest.main()
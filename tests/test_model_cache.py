@@ -0,0 +1,89 @@
+# Checks that a project loaded from the ModelCache writes the same files as one
+# that has just been parsed and that the least recently used models are
+# evicted once the cache is too large.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import contextlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+class ModelCacheTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.tempDir = tempfile.TemporaryDirectory()
+    cls.gbPath = os.path.join(cls.tempDir.name, "Cache.band")
+    generate.generateProject(cls.gbPath, tracks=3, sections=4, takes=2, events=150)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tempDir.cleanup()
+
+  def setUp(self):
+    self.cacheDir = tempfile.TemporaryDirectory()
+    self.settings = gbextractor.getSettings()
+    gbextractor.bEnableCutUp = True
+
+  def tearDown(self):
+    gbextractor.applySettings(self.settings)
+    self.cacheDir.cleanup()
+
+  def render(self, project):
+    sink = gbextractor.MemorySink()
+    with contextlib.redirect_stdout(io.StringIO()):
+      project.dumpAll(sink)
+    return sorted(("/".join(path), filename, data) for path, filename, data in sink.files)
+
+  def getModels(self):
+    return sorted(name for name in os.listdir(self.cacheDir.name) if name.endswith(".gbmodel"))
+
+  def testRoundTrip(self):
+    modelCache = gbextractor.ModelCache(self.cacheDir.name, 1 << 30)
+    parsed = gbextractor.GBProject.open(self.gbPath, modelCache=modelCache)
+    self.assertEqual(len(self.getModels()), 1)
+    self.assertNotIn("modelCacheHits", parsed.metrics.counters)
+    cached = gbextractor.GBProject.open(self.gbPath, modelCache=modelCache)
+    self.assertEqual(cached.metrics.counters["modelCacheHits"], 1)
+    self.assertEqual(cached.gbPath, self.gbPath)
+    self.assertEqual(self.render(cached), self.render(parsed))
+
+  # Models are keyed by the options that change what the parser produces
+  def testKey(self):
+    modelCache = gbextractor.ModelCache(self.cacheDir.name, 1 << 30)
+    dataPath = os.path.join(self.gbPath, "projectData")
+    key = modelCache.getKey(dataPath)
+    self.assertEqual(modelCache.getKey(dataPath), key)
+    gbextractor.bOverridePitchBend = not gbextractor.bOverridePitchBend
+    self.assertNotEqual(modelCache.getKey(dataPath), key)
+
+  def testUnreadableModel(self):
+    modelCache = gbextractor.ModelCache(self.cacheDir.name, 1 << 30)
+    with open(modelCache.getPath("bad"), "wb") as modelFile:
+      modelFile.write(b"not a model")
+    self.assertIsNone(modelCache.load("bad", "Cache"))
+    self.assertEqual(self.getModels(), [])
+
+  def testEviction(self):
+    project = gbextractor.GBProject.open(self.gbPath)
+    modelCache = gbextractor.ModelCache(self.cacheDir.name, 1 << 30)
+    modelCache.store("a", project)
+    modelSize = os.path.getsize(modelCache.getPath("a"))
+    modelCache.maxSize = modelSize * 2
+    modelCache.store("b", project)
+    os.utime(modelCache.getPath("a"), (1000, 1000))
+    os.utime(modelCache.getPath("b"), (2000, 2000))
+    # Reading "a" makes "b" the least recently used
+    self.assertIsNotNone(modelCache.load("a", "Cache"))
+    modelCache.store("c", project)
+    self.assertEqual(self.getModels(), ["a.gbmodel", "c.gbmodel"])
+
+if __name__ == "__main__":
+  unittest.main()
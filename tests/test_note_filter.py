@@ -0,0 +1,97 @@
+# Checks the NoteRules of the note filter and how MIDIFilter.partition() splits
+# the events of a section into the notes that are kept and those that are
+# rejected.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import gbextractor
+
+NOTE = gbextractor.MIDI_EVENT_NOTE
+KEPT = gbextractor.FILTER_KEPT
+REJECTED = gbextractor.FILTER_REJECTED
+
+# Returns an EventStore with (channel, note, velocity, duration) notes
+def createNotes(*notes):
+  midiEvents = gbextractor.EventStore()
+  for timeStamp, (channel, note, velocity, duration) in enumerate(notes):
+    midiEvents.append(NOTE, timeStamp, channel, velocity, note, duration)
+  return midiEvents
+
+class NoteRuleTest(unittest.TestCase):
+  def testCovers(self):
+    rule = gbextractor.NoteRule(20, 127, 10, (42, 46), [9])
+    self.assertTrue(rule.covers(9, 42))
+    self.assertTrue(rule.covers(9, 46))
+    self.assertFalse(rule.covers(9, 47))
+    self.assertFalse(rule.covers(0, 44))
+    everything = gbextractor.NoteRule(20, 127, 10)
+    self.assertTrue(everything.covers(15, 127))
+
+  def testPasses(self):
+    rule = gbextractor.NoteRule(20, 100, 10)
+    self.assertTrue(rule.passes(20, 10))
+    self.assertTrue(rule.passes(100, 500))
+    self.assertFalse(rule.passes(19, 500))
+    self.assertFalse(rule.passes(101, 500))
+    self.assertFalse(rule.passes(50, 9))
+
+class MIDIFilterTest(unittest.TestCase):
+  # The first rule that covers a note decides, so quiet hi-hats are kept
+  # while other quiet notes are not
+  def testFirstRuleDecides(self):
+    midiFilter = gbextractor.MIDIFilter([gbextractor.NoteRule(5, 127, 0, (42, 46)), gbextractor.NoteRule(20, 127, 10)])
+    self.assertTrue(midiFilter.keepsNote(9, 42, 10, 1))
+    self.assertFalse(midiFilter.keepsNote(9, 41, 10, 100))
+    self.assertTrue(midiFilter.keepsNote(9, 41, 30, 100))
+
+  def testNoRuleKeeps(self):
+    midiFilter = gbextractor.MIDIFilter([gbextractor.NoteRule(20, 127, 10, channels=[9])])
+    self.assertTrue(midiFilter.keepsNote(0, 60, 1, 1))
+    self.assertFalse(midiFilter.keepsNote(9, 60, 1, 1))
+
+  def testInvert(self):
+    midiFilter = gbextractor.MIDIFilter([gbextractor.NoteRule(20, 127, 10)], bInvert=True)
+    self.assertTrue(midiFilter.keepsNote(0, 60, 1, 1))
+    self.assertFalse(midiFilter.keepsNote(0, 60, 64, 100))
+
+  # Events other than notes belong to both partitions
+  def testPartition(self):
+    midiFilter = gbextractor.MIDIFilter([gbextractor.NoteRule(5, 127, 0, (42, 46)), gbextractor.NoteRule(20, 127, 10)])
+    midiEvents = createNotes((9, 42, 10, 1), (9, 41, 10, 100), (0, 60, 64, 5), (0, 60, 64, 50))
+    midiEvents.append(gbextractor.MIDI_EVENT_CC, 10, 0, 64, 127, 0)
+    midiEvents.append(gbextractor.MIDI_EVENT_PITCH_WHEEL, 11, 0, 0, 0, -100)
+    self.assertEqual(list(midiFilter.partition(midiEvents)), [KEPT, REJECTED, REJECTED, KEPT, KEPT | REJECTED, KEPT | REJECTED])
+
+  def testPartitionEmpty(self):
+    self.assertEqual(list(gbextractor.MIDIFilter([]).partition(gbextractor.EventStore())), [])
+
+class GetMIDIFilterTest(unittest.TestCase):
+  def setUp(self):
+    self.settings = gbextractor.getSettings()
+
+  def tearDown(self):
+    gbextractor.applySettings(self.settings)
+
+  # noteFilterRules come before the limits for every note and take the limits
+  # that they do not give from them
+  def testRules(self):
+    gbextractor.velocityMin = 30
+    gbextractor.velocityMax = 120
+    gbextractor.durationMin = 40
+    gbextractor.noteFilterRules = [{"notes": (42, 46), "velocityMin": 5}, {"channels": [3], "durationMin": 0}]
+    project = gbextractor.GBProject("Filter")
+    project.songTempo = 120
+    project.durationAsTicks = gbextractor.millisecondsToTicks(120, gbextractor.durationMin)
+    rules = project.getMIDIFilter().rules
+    self.assertEqual([(rule.velMin, rule.velMax, rule.durMin, rule.notes) for rule in rules],
+                     [(5, 120, project.durationAsTicks, (42, 46)), (30, 120, 0, None), (30, 120, project.durationAsTicks, None)])
+    self.assertEqual(rules[1].channels, frozenset([3]))
+    self.assertIsNone(rules[2].channels)
+
+if __name__ == "__main__":
+  unittest.main()
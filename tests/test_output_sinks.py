@@ -0,0 +1,92 @@
+# Checks that the files written to a ZipSink or a TarSink read back the same as
+# those written to a directory, and that an aborted archive is deleted.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import tarfile
+import zipfile
+import contextlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+# A file object that cannot seek, like a pipe
+class StreamFile(io.BytesIO):
+  def seekable(self):
+    return False
+
+  def seek(self, *args):
+    raise io.UnsupportedOperation("seek")
+
+  def tell(self):
+    raise io.UnsupportedOperation("tell")
+
+class OutputSinkTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.tempDir = tempfile.TemporaryDirectory()
+    cls.gbPath = os.path.join(cls.tempDir.name, "Sink.band")
+    generate.generateProject(cls.gbPath, tracks=2, sections=4, takes=2, events=100)
+    cls.project = gbextractor.GBProject.open(cls.gbPath)
+    cls.sourcePath = os.path.join(cls.tempDir.name, "take1.m4a")
+    with open(cls.sourcePath, "wb") as sourceFile:
+      sourceFile.write(b"audio" * 100)
+    directory = os.path.join(cls.tempDir.name, "directory")
+    cls.render(gbextractor.DirectorySink(directory))
+    cls.expected = dict()
+    for dirPath, dirNames, fileNames in os.walk(directory):
+      for fileName in fileNames:
+        with open(os.path.join(dirPath, fileName), "rb") as outputFile:
+          cls.expected[os.path.relpath(os.path.join(dirPath, fileName), directory).replace(os.sep, "/")] = outputFile.read()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tempDir.cleanup()
+
+  # Write every view and an audio file to sink
+  @classmethod
+  def render(cls, sink):
+    with contextlib.redirect_stdout(io.StringIO()):
+      cls.project.dumpAll(sink)
+    sink.addPath(["audio", "media"], "take1.m4a", cls.sourcePath)
+    sink.close()
+
+  def testZip(self):
+    archiveFile = io.BytesIO()
+    self.render(gbextractor.ZipSink(archiveFile, "Sink", False))
+    with zipfile.ZipFile(io.BytesIO(archiveFile.getvalue())) as archive:
+      self.assertIsNone(archive.testzip())
+      files = {name[len("Sink/"):]: archive.read(name) for name in archive.namelist()}
+      self.assertEqual(archive.getinfo("Sink/audio/media/take1.m4a").compress_type, zipfile.ZIP_STORED)
+    self.assertEqual(files, self.expected)
+
+  # The tar stream is written without seeking
+  def testTar(self):
+    archiveFile = StreamFile()
+    self.render(gbextractor.TarSink(archiveFile, "Sink", False))
+    files = dict()
+    with tarfile.open(fileobj=io.BytesIO(archiveFile.getvalue())) as archive:
+      for member in archive.getmembers():
+        self.assertTrue(member.name.startswith("Sink/"))
+        files[member.name[len("Sink/"):]] = archive.extractfile(member).read()
+    self.assertEqual(files, self.expected)
+
+  def testAbort(self):
+    for format in ("zip", "tar"):
+      sink = gbextractor.createOutputSink(self.tempDir.name, "Aborted", format)
+      sink.addFile(["full"], "Aborted.mid", b"MThd")
+      archivePath = os.path.join(self.tempDir.name, "Aborted.{}".format(format))
+      self.assertTrue(os.path.isfile(archivePath))
+      sink.abort()
+      self.assertFalse(os.path.exists(archivePath))
+      self.assertTrue(sink.fileObject.closed)
+
+if __name__ == "__main__":
+  unittest.main()
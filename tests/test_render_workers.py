@@ -0,0 +1,77 @@
+# Checks that the files written by render worker processes do not depend on
+# the number of workers when the workers are spawned rather than forked, as
+# they are by default on macOS and Windows.  Spawned workers import
+# gbextractor again, so they only see what the parent passes on to them.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import contextlib
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+class SpawnedRenderWorkersTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.tempDir = tempfile.TemporaryDirectory()
+    cls.gbPath = os.path.join(cls.tempDir.name, "Spawn.band")
+    generate.generateProject(cls.gbPath, tracks=3, sections=4, takes=2, events=150)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tempDir.cleanup()
+
+  def setUp(self):
+    self.startMethod = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method("spawn", force=True)
+    self.settings = gbextractor.getSettings()
+
+  def tearDown(self):
+    multiprocessing.set_start_method(self.startMethod, force=True)
+    gbextractor.applySettings(self.settings)
+
+  # Returns the files of every view written by the given number of workers
+  def render(self, workers, project=None):
+    project = project or gbextractor.GBProject.open(self.gbPath)
+    sink = gbextractor.MemorySink()
+    with contextlib.redirect_stdout(io.StringIO()):
+      project.dumpAll(sink, workers=workers)
+    return sorted(("/".join(path), filename, data) for path, filename, data in sink.files)
+
+  # Returns the files written in streaming mode by the given number of workers
+  def stream(self, workers):
+    project = gbextractor.GBProject.open(self.gbPath, bStream=True)
+    sink = gbextractor.MemorySink()
+    try:
+      with contextlib.redirect_stdout(io.StringIO()):
+        project.streamTracks(sink, workers=workers)
+    finally:
+      project.closeStream()
+    return sorted(("/".join(path), filename, data) for path, filename, data in sink.files)
+
+  def testSettingsChangedAtRunTime(self):
+    gbextractor.bFilterNotes = True
+    gbextractor.bEnableCutUp = True
+    gbextractor.velocityMin = 90
+    gbextractor.durationMin = 50
+    files = self.render(1)
+    self.assertTrue(files)
+    self.assertEqual(self.render(3), files)
+
+  # The project in streaming mode holds a memory map, which cannot be passed to
+  # a spawned worker
+  def testStreamingMode(self):
+    gbextractor.streamMemoryLimit = 1
+    files = self.render(1)
+    self.assertEqual(self.stream(3), files)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,58 @@
+# Checks that scanRecordOffsets() finds the same records as the bitstring
+# findall() scan that the parser used before, whatever the chunk size and
+# whether or not the chunks are scanned in parallel.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import unittest
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+# Returns the sorted byte offsets of every record signature in data, found as
+# the parser used to with one findall() per signature
+def findallOffsets(data):
+  s = gbextractor.ConstBitStream(data)
+  offsets = []
+  for signature in gbextractor.RECORD_SIGNATURES:
+    offsets.extend(offset // 8 for offset in s.findall(signature, bytealigned=True))
+  return sorted(offsets)
+
+@unittest.skipIf(gbextractor.ConstBitStream is None, "needs the bitstring package")
+class ScanRecordOffsetsTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    # Signatures next to each other and at the very end as well as those of
+    # a generated project
+    cls.data = generate.generateProjectData(tracks=3, sections=4, takes=2, events=100) + b"qSvEkarTxqeSMivnE"
+
+  def checkOffsets(self, offsetList):
+    self.assertEqual([offset for offset, signature in offsetList], findallOffsets(self.data))
+    for offset, signature in offsetList:
+      self.assertEqual(self.data[offset:offset + 4], signature)
+
+  def testSerial(self):
+    self.checkOffsets(gbextractor.scanRecordOffsets(self.data))
+
+  # Chunks this small split most of the signatures between two chunks
+  def testSmallChunks(self):
+    for chunkSize in (1, 2, 3, 5, 4096):
+      self.checkOffsets(gbextractor.scanRecordOffsets(self.data, chunkSize=chunkSize))
+
+  def testExecutor(self):
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+      self.checkOffsets(gbextractor.scanRecordOffsets(self.data, executor, 1000))
+
+  def testScanChunk(self):
+    data = b"qSvEqSvE..tSnI"
+    self.assertEqual(gbextractor.scanChunk(data, 0, 4), [(0, b"qSvE")])
+    self.assertEqual(gbextractor.scanChunk(data, 1, 5), [(4, b"qSvE")])
+    self.assertEqual(gbextractor.scanChunk(data, 5, len(data)), [(10, b"tSnI")])
+
+if __name__ == "__main__":
+  unittest.main()
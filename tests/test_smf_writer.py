@@ -0,0 +1,100 @@
+# Checks that the native MIDI writer, SMFWriter, writes exactly the same bytes
+# as MIDIUtil, both for events added one at a time and for every file written
+# from a generated project.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import random
+import contextlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+def getBytes(midiFileData):
+  midiFile = io.BytesIO()
+  midiFileData.writeFile(midiFile)
+  return midiFile.getvalue()
+
+@unittest.skipIf(gbextractor.MIDIFile is None, "needs the MIDIUtil package")
+class SMFWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.settings = gbextractor.getSettings()
+
+  def tearDown(self):
+    gbextractor.applySettings(self.settings)
+
+  # Add the same events to a SMFWriter and a MIDIFile and compare their files
+  def checkEvents(self, numTracks, addEvents):
+    files = []
+    for midiFileData in (gbextractor.SMFWriter(numTracks=numTracks, ticks_per_quarternote=960, file_format=1),
+                         gbextractor.MIDIFile(numTracks=numTracks, ticks_per_quarternote=960, eventtime_is_ticks=True, file_format=1)):
+      midiFileData.addTimeSignature(0, 0, 4, 2, clocks_per_tick=24, notes_per_quarter=8)
+      midiFileData.addTempo(0, 0, 97)
+      addEvents(midiFileData)
+      files.append(getBytes(midiFileData))
+    self.assertEqual(files[0], files[1])
+
+  # Overlapping notes of the same pitch, repeated events and events at the
+  # same time in an order that has to be sorted
+  def testOverlappingNotes(self):
+    def addEvents(midiFileData):
+      midiFileData.addTrackName(0, 0, "Überspur")
+      midiFileData.addNote(0, 0, 60, 100, 500, 90)
+      midiFileData.addNote(0, 0, 60, 300, 500, 80)
+      midiFileData.addNote(0, 0, 60, 300, 500, 80)
+      midiFileData.addNote(0, 1, 62, 0, 1, 70)
+      midiFileData.addControllerEvent(0, 0, 300, 64, 127)
+      midiFileData.addControllerEvent(0, 0, 300, 64, 127)
+      midiFileData.addPitchWheelEvent(0, 2, 200, -8192)
+      midiFileData.addPitchWheelEvent(0, 2, 250, 8191)
+      midiFileData.addChannelPressure(0, 3, 100, 40)
+    self.checkEvents(1, addEvents)
+
+  def testRandomEvents(self):
+    def addEvents(midiFileData):
+      rng = random.Random(2)
+      for track in range(0, 3):
+        midiFileData.addTrackName(track, 0, "Track {}".format(track))
+        for i in range(0, 300):
+          kind = rng.randrange(4)
+          channel = rng.randrange(16)
+          time = rng.randrange(0, 20000)
+          if(kind == 0):
+            midiFileData.addNote(track, channel, rng.randrange(40, 50), time, rng.randrange(1, 3000), rng.randrange(1, 128))
+          elif(kind == 1):
+            midiFileData.addControllerEvent(track, channel, time, rng.choice([1, 7, 64]), rng.randrange(128))
+          elif(kind == 2):
+            midiFileData.addPitchWheelEvent(track, channel, time, rng.randrange(-8192, 8192))
+          else:
+            midiFileData.addChannelPressure(track, channel, time, rng.randrange(128))
+    self.checkEvents(3, addEvents)
+
+  # Every view of a generated project, including cut-ups and filtered sections
+  def testGeneratedProject(self):
+    gbextractor.bEnableCutUp = True
+    gbextractor.bFilterNotes = True
+    gbextractor.bOverridePitchBend = True
+    with tempfile.TemporaryDirectory() as tempDir:
+      gbPath = os.path.join(tempDir, "Writer.band")
+      generate.generateProject(gbPath, tracks=2, sections=4, takes=2, events=150)
+      project = gbextractor.GBProject.open(gbPath)
+    outputs = []
+    for midiWriter in ("native", "midiutil"):
+      gbextractor.midiWriter = midiWriter
+      project.settingsDigest = None
+      sink = gbextractor.MemorySink()
+      with contextlib.redirect_stdout(io.StringIO()):
+        project.dumpAll(sink)
+      outputs.append(sorted(("/".join(path), filename, data) for path, filename, data in sink.files))
+    self.assertTrue(outputs[0])
+    self.assertEqual(outputs[0], outputs[1])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,68 @@
+# Checks how the selectors of a TrackFilter pick tracks by number, name or
+# pattern, and that only the tracks that it picks are extracted.
+#
+# python3 -m pytest tests
+
+import os
+import sys
+import io
+import contextlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks"))
+import gbextractor
+import generate
+
+TRACKS = [(1, "Drums"), (2, "Bass"), (3, "Piano Left"), (4, "Piano Right"), (5, None), (12, "12")]
+
+# Returns the tracks of TRACKS that trackFilter matches
+def selectTracks(trackFilter):
+  return [track for track, trackName in TRACKS if trackFilter.matches(track, trackName)]
+
+class TrackFilterTest(unittest.TestCase):
+  def testNumber(self):
+    self.assertEqual(selectTracks(gbextractor.TrackFilter([2, 5])), [2, 5])
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["3"])), [3])
+
+  # A digit string is both a track number and a name
+  def testDigitString(self):
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["12"])), [12])
+    self.assertEqual(selectTracks(gbextractor.TrackFilter([12])), [12])
+
+  def testName(self):
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["drums", "BASS"])), [1, 2])
+    # A name has to match the whole track name
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["Piano"])), [])
+
+  def testPattern(self):
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["piano.*"])), [3, 4])
+    self.assertEqual(selectTracks(gbextractor.TrackFilter([".*(left|right)"])), [3, 4])
+    # A selector that is not a valid pattern is still a name
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["piano ("])), [])
+
+  def testExclude(self):
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(excludeTracks=["Piano.*", 1])), [2, 5, 12])
+    self.assertEqual(selectTracks(gbextractor.TrackFilter(["Piano.*", "Bass"], ["piano right"])), [2, 3])
+
+  def testCreateTrackFilter(self):
+    self.assertIsNone(gbextractor.createTrackFilter([], None))
+    self.assertEqual(selectTracks(gbextractor.createTrackFilter(None, ["Drums"])), [2, 3, 4, 5, 12])
+
+  # Only the files of the selected tracks are written
+  def testExtract(self):
+    with tempfile.TemporaryDirectory() as tempDir:
+      gbPath = os.path.join(tempDir, "Filter.band")
+      generate.generateProject(gbPath, tracks=3, sections=2, takes=2, events=50)
+      project = gbextractor.GBProject.open(gbPath)
+    trackFilter = gbextractor.createTrackFilter(["Track [13] Piano"], None)
+    self.assertEqual(project.selectTracks(trackFilter), [1, 3])
+    sink = gbextractor.MemorySink()
+    with contextlib.redirect_stdout(io.StringIO()):
+      project.dumpAll(sink, views=["tracks"], trackFilter=trackFilter)
+    self.assertEqual(sorted("/".join(path + [filename]) for path, filename, data in sink.files),
+                     ["tracks/1_Track1Piano/1-Track1Piano.mid", "tracks/3_Track3Piano/3-Track3Piano.mid"])
+
+if __name__ == "__main__":
+  unittest.main()